@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, logging
+import os, logging, array
 import cffi
 
 
@@ -18,7 +18,8 @@ COMPILE_ARGS = ("-Wall -g -O2 -shared -fPIC"
 SSE_FLAGS = "-mfpmath=sse -msse2"
 SOURCE_FILES = [
     'pyhelper.c', 'serialqueue.c', 'stepcompress.c', 'itersolve.c', 'trapq.c',
-    'pollreactor.c', 'msgblock.c', 'trdispatch.c',
+    'pollreactor.c', 'msgblock.c', 'trdispatch.c', 'lookahead.c',
+    'steppool.c', 'histogram.c', 'bulkqueue.c',
     'kin_cartesian.c', 'kin_corexy.c', 'kin_corexz.c', 'kin_delta.c',
     'kin_polar.c', 'kin_rotary_delta.c', 'kin_winch.c', 'kin_extruder.c',
     'kin_shaper.c',
@@ -26,7 +27,7 @@ SOURCE_FILES = [
 DEST_LIB = "c_helper.so"
 OTHER_FILES = [
     'list.h', 'serialqueue.h', 'stepcompress.h', 'itersolve.h', 'pyhelper.h',
-    'trapq.h', 'pollreactor.h', 'msgblock.h'
+    'trapq.h', 'pollreactor.h', 'msgblock.h', 'histogram.h'
 ]
 
 defs_stepcompress = """
@@ -74,6 +75,12 @@ defs_itersolve = """
     void itersolve_set_position(struct stepper_kinematics *sk
         , double x, double y, double z);
     double itersolve_get_commanded_pos(struct stepper_kinematics *sk);
+
+    struct steppool *steppool_alloc(int num_threads);
+    void steppool_free(struct steppool *sp);
+    int32_t steppool_generate_steps(struct steppool *sp
+        , struct stepper_kinematics **sk_list, int sk_count
+        , double flush_time);
 """
 
 defs_trapq = """
@@ -89,6 +96,7 @@ defs_trapq = """
         , double start_pos_x, double start_pos_y, double start_pos_z
         , double axes_r_x, double axes_r_y, double axes_r_z
         , double start_v, double cruise_v, double accel);
+    void trapq_append_batch(struct trapq *tq, double *moves, int count);
     struct trapq *trapq_alloc(void);
     void trapq_free(struct trapq *tq);
     void trapq_finalize_moves(struct trapq *tq, double print_time);
@@ -98,6 +106,16 @@ defs_trapq = """
         , double start_time, double end_time);
 """
 
+defs_lookahead = """
+    struct lookahead_junction {
+        double start_v2, cruise_v2, end_v2;
+        int is_set;
+    };
+
+    int lookahead_plan(double *move_limits, int count, int lazy
+        , struct lookahead_junction *junctions);
+"""
+
 defs_kin_cartesian = """
     struct stepper_kinematics *cartesian_stepper_alloc(char axis);
     struct stepper_kinematics *cartesian_reverse_stepper_alloc(char axis);
@@ -158,6 +176,19 @@ defs_kin_shaper = """
     struct stepper_kinematics * input_shaper_alloc(void);
 """
 
+defs_histogram = """
+    struct histogram {
+        uint32_t counts[16];
+        uint32_t count, negative;
+        double sum, min, max;
+    };
+
+    struct histogram *histogram_alloc(void);
+    void histogram_free(struct histogram *h);
+    void histogram_reset(struct histogram *h);
+    void histogram_add(struct histogram *h, double value);
+"""
+
 defs_serialqueue = """
     #define MESSAGE_MAX 64
     struct pull_queue_message {
@@ -176,6 +207,9 @@ defs_serialqueue = """
     void serialqueue_send(struct serialqueue *sq, struct command_queue *cq
         , uint8_t *msg, int len, uint64_t min_clock, uint64_t req_clock
         , uint64_t notify_id);
+    void serialqueue_send_multi(struct serialqueue *sq
+        , struct command_queue *cq, uint8_t *msgs, int *lens, int count
+        , uint64_t min_clock, uint64_t req_clock, uint64_t notify_id);
     void serialqueue_pull(struct serialqueue *sq
         , struct pull_queue_message *pqm);
     void serialqueue_set_baud_adjust(struct serialqueue *sq
@@ -185,6 +219,8 @@ defs_serialqueue = """
     void serialqueue_set_clock_est(struct serialqueue *sq, double est_freq
         , double conv_time, uint64_t conv_clock, uint64_t last_clock);
     void serialqueue_get_stats(struct serialqueue *sq, char *buf, int len);
+    int serialqueue_get_histograms(struct serialqueue *sq
+        , struct histogram *h, int max);
     int serialqueue_extract_old(struct serialqueue *sq, int sentq
         , struct pull_queue_message *q, int max);
 """
@@ -202,6 +238,24 @@ defs_trdispatch = """
         , uint64_t expire_ticks, uint64_t min_extend_ticks);
 """
 
+defs_bulkqueue = """
+    struct bulkqueue_view {
+        uint8_t *data, *lengths;
+        uint32_t *sequences;
+        uint32_t block_size, block_count;
+        uint32_t pos, count;
+        uint32_t gaps, missing, overflows, invalid;
+    };
+
+    struct bulkqueue *bulkqueue_alloc(struct serialqueue *sq, uint32_t msgtag
+        , uint32_t oid, uint32_t block_size, uint32_t block_count);
+    void bulkqueue_free(struct bulkqueue *bq);
+    void bulkqueue_start(struct bulkqueue *bq, uint32_t next_sequence);
+    void bulkqueue_stop(struct bulkqueue *bq);
+    void bulkqueue_pull(struct bulkqueue *bq, struct bulkqueue_view *v);
+    void bulkqueue_release(struct bulkqueue *bq, uint32_t count);
+"""
+
 defs_pyhelper = """
     void set_python_logging_callback(void (*func)(const char *));
     double get_monotonic(void);
@@ -212,8 +266,9 @@ defs_std = """
 """
 
 defs_all = [
-    defs_pyhelper, defs_serialqueue, defs_std, defs_stepcompress,
-    defs_itersolve, defs_trapq, defs_trdispatch,
+    defs_pyhelper, defs_histogram, defs_serialqueue, defs_std,
+    defs_stepcompress, defs_itersolve, defs_trapq, defs_trdispatch,
+    defs_bulkqueue, defs_lookahead,
     defs_kin_cartesian, defs_kin_corexy, defs_kin_corexz, defs_kin_delta,
     defs_kin_polar, defs_kin_rotary_delta, defs_kin_winch, defs_kin_extruder,
     defs_kin_shaper,
@@ -286,6 +341,48 @@ def get_ffi():
     return FFI_main, FFI_lib
 
 
+######################################################################
+# Batched trapq moves and parallel step generation
+######################################################################
+
+TRAPQ_MOVE_SIZE = 13
+
+# Pack trapq_append() parameters into an array and add them in one call
+class TrapqBuffer:
+    def __init__(self, trapq):
+        self.trapq = trapq
+        self.ffi_main, self.ffi_lib = get_ffi()
+        self.moves = array.array('d')
+    def flush(self):
+        moves = self.moves
+        if not moves:
+            return
+        self.ffi_lib.trapq_append_batch(
+            self.trapq, self.ffi_main.cast("double *",
+                                           self.ffi_main.from_buffer(moves)),
+            len(moves) // TRAPQ_MOVE_SIZE)
+        del moves[:]
+
+
+# Generate the steps of several steppers using a pool of C threads
+class StepGenPool:
+    def __init__(self, num_threads):
+        self.ffi_main, self.ffi_lib = get_ffi()
+        self.pool = self.ffi_main.gc(self.ffi_lib.steppool_alloc(num_threads),
+                                     self.ffi_lib.steppool_free)
+        self.sk_list = []
+    def queue(self, sk):
+        self.sk_list.append(sk)
+    def generate_steps(self, flush_time):
+        sk_list = self.sk_list
+        if not sk_list:
+            return 0
+        self.sk_list = []
+        sk_array = self.ffi_main.new("struct stepper_kinematics *[]", sk_list)
+        return self.ffi_lib.steppool_generate_steps(
+            self.pool, sk_array, len(sk_list), flush_time)
+
+
 ######################################################################
 # hub-ctrl hub power controller
 ######################################################################
@@ -0,0 +1,199 @@
+// Bulk sensor data queue filled directly from the serial thread
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <pthread.h> // pthread_mutex_lock
+#include <stddef.h> // offsetof
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "compiler.h" // ARRAY_SIZE
+#include "pyhelper.h" // report_errno
+#include "serialqueue.h" // serialqueue_add_fastreader
+
+// Messages of the form "<name> oid=%c sequence=%hu data=%*s" are
+// stored in a ring of fixed size blocks instead of being passed to the
+// host code one message at a time.  The 16bit message sequence is
+// extended to 32bits and gaps in the sequence are counted.
+
+struct bulkqueue {
+    struct fastreader fr;
+    struct serialqueue *sq;
+    int is_active;
+    uint32_t block_size, block_count;
+    uint8_t *data, *lengths;
+    uint32_t *sequences;
+
+    pthread_mutex_t lock; // protects variables below
+    uint64_t head, tail;
+    uint32_t next_sequence;
+    uint32_t gaps, missing, overflows, invalid;
+};
+
+struct bulkqueue_view {
+    uint8_t *data, *lengths;
+    uint32_t *sequences;
+    uint32_t block_size, block_count;
+    uint32_t pos, count;
+    uint32_t gaps, missing, overflows, invalid;
+};
+
+// Handle a bulk data message (callback from serialqueue fastreader)
+static int
+handle_bulk_data(struct fastreader *fr, uint8_t *data, int len)
+{
+    struct bulkqueue *bq = container_of(fr, struct bulkqueue, fr);
+
+    // Parse: <name> oid=%c sequence=%hu data=%*s
+    uint8_t *p = &data[MESSAGE_HEADER_SIZE + fr->prefix_len];
+    uint8_t *end = &data[len - MESSAGE_TRAILER_SIZE];
+    if (p >= end)
+        return 0;
+    uint16_t seq16 = msgblock_parse_int(&p);
+    if (p >= end)
+        return 0;
+    uint32_t dlen = *p++;
+    if (p + dlen != end)
+        // Not a lone bulk message - let the host code handle it
+        return 0;
+
+    pthread_mutex_lock(&bq->lock);
+    if (dlen > bq->block_size) {
+        bq->invalid++;
+        goto done;
+    }
+    int16_t seq_diff = seq16 - (uint16_t)bq->next_sequence;
+    uint32_t sequence = bq->next_sequence + seq_diff;
+    if (seq_diff > 0) {
+        bq->gaps++;
+        bq->missing += seq_diff;
+    } else if (seq_diff < 0) {
+        // Duplicate or out of order block
+        bq->invalid++;
+        goto done;
+    }
+    bq->next_sequence = sequence + 1;
+    if (bq->head - bq->tail >= bq->block_count) {
+        bq->overflows++;
+        goto done;
+    }
+    uint32_t pos = bq->head % bq->block_count;
+    memcpy(&bq->data[pos * bq->block_size], p, dlen);
+    bq->lengths[pos] = dlen;
+    bq->sequences[pos] = sequence;
+    bq->head++;
+done:
+    pthread_mutex_unlock(&bq->lock);
+    return 1;
+}
+
+// Begin storing messages (starting with the given message sequence)
+void __visible
+bulkqueue_start(struct bulkqueue *bq, uint32_t next_sequence)
+{
+    pthread_mutex_lock(&bq->lock);
+    bq->head = bq->tail = 0;
+    bq->next_sequence = next_sequence;
+    bq->gaps = bq->missing = bq->overflows = bq->invalid = 0;
+    pthread_mutex_unlock(&bq->lock);
+    if (bq->is_active)
+        return;
+    bq->is_active = 1;
+    serialqueue_add_fastreader(bq->sq, &bq->fr);
+}
+
+// Stop storing messages
+void __visible
+bulkqueue_stop(struct bulkqueue *bq)
+{
+    if (!bq->is_active)
+        return;
+    bq->is_active = 0;
+    serialqueue_rm_fastreader(bq->sq, &bq->fr);
+}
+
+// Report the oldest unread blocks (that are contiguous in the ring)
+void __visible
+bulkqueue_pull(struct bulkqueue *bq, struct bulkqueue_view *v)
+{
+    v->data = bq->data;
+    v->lengths = bq->lengths;
+    v->sequences = bq->sequences;
+    v->block_size = bq->block_size;
+    v->block_count = bq->block_count;
+    pthread_mutex_lock(&bq->lock);
+    v->pos = bq->tail % bq->block_count;
+    v->count = bq->head - bq->tail;
+    if (v->pos + v->count > bq->block_count)
+        v->count = bq->block_count - v->pos;
+    v->gaps = bq->gaps;
+    v->missing = bq->missing;
+    v->overflows = bq->overflows;
+    v->invalid = bq->invalid;
+    pthread_mutex_unlock(&bq->lock);
+}
+
+// Free space in the ring after blocks reported by bulkqueue_pull are read
+void __visible
+bulkqueue_release(struct bulkqueue *bq, uint32_t count)
+{
+    pthread_mutex_lock(&bq->lock);
+    if (count > bq->head - bq->tail)
+        count = bq->head - bq->tail;
+    bq->tail += count;
+    pthread_mutex_unlock(&bq->lock);
+}
+
+// Create a new 'struct bulkqueue' object
+struct bulkqueue * __visible
+bulkqueue_alloc(struct serialqueue *sq, uint32_t msgtag, uint32_t oid
+                , uint32_t block_size, uint32_t block_count)
+{
+    struct bulkqueue *bq = malloc(sizeof(*bq));
+    if (!bq)
+        return NULL;
+    memset(bq, 0, sizeof(*bq));
+    bq->sq = sq;
+    bq->block_size = block_size;
+    bq->block_count = block_count;
+    bq->data = malloc(block_size * block_count);
+    bq->lengths = malloc(block_count);
+    bq->sequences = malloc(block_count * sizeof(*bq->sequences));
+    if (!bq->data || !bq->lengths || !bq->sequences)
+        goto fail;
+
+    int ret = pthread_mutex_init(&bq->lock, NULL);
+    if (ret) {
+        report_errno("bulkqueue_alloc pthread_mutex_init", ret);
+        goto fail;
+    }
+
+    // Setup fastreader to match the bulk data messages
+    uint32_t prefix[] = {msgtag, oid};
+    struct queue_message *dummy = message_alloc_and_encode(
+        prefix, ARRAY_SIZE(prefix));
+    memcpy(bq->fr.prefix, dummy->msg, dummy->len);
+    bq->fr.prefix_len = dummy->len;
+    free(dummy);
+    bq->fr.func = handle_bulk_data;
+    return bq;
+
+fail:
+    free(bq->data);
+    free(bq->lengths);
+    free(bq->sequences);
+    free(bq);
+    return NULL;
+}
+
+// Free memory associated with a 'struct bulkqueue' object
+void __visible
+bulkqueue_free(struct bulkqueue *bq)
+{
+    if (!bq)
+        return;
+    bulkqueue_stop(bq);
+    free(bq->data);
+    free(bq->lengths);
+    free(bq->sequences);
+    free(bq);
+}
@@ -0,0 +1,60 @@
+// Latency histograms with fixed (power of two) buckets
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "compiler.h" // __visible
+#include "histogram.h" // struct histogram
+
+// Bucket 0 counts values below HISTOGRAM_BASE, and the upper bound of
+// each following bucket is double that of the previous bucket.  The
+// last bucket counts all larger values.  Negative values (for example,
+// a message sent after its requested time) are counted in bucket 0 and
+// in 'negative'.
+
+// Allocate a new 'histogram' object
+struct histogram * __visible
+histogram_alloc(void)
+{
+    struct histogram *h = malloc(sizeof(*h));
+    if (!h)
+        return NULL;
+    histogram_reset(h);
+    return h;
+}
+
+// Free memory associated with a 'histogram' object
+void __visible
+histogram_free(struct histogram *h)
+{
+    free(h);
+}
+
+// Clear all samples
+void __visible
+histogram_reset(struct histogram *h)
+{
+    memset(h, 0, sizeof(*h));
+}
+
+// Add a sample (in seconds)
+void __visible
+histogram_add(struct histogram *h, double value)
+{
+    if (!h->count || value < h->min)
+        h->min = value;
+    if (!h->count || value > h->max)
+        h->max = value;
+    h->count++;
+    h->sum += value;
+    if (value < 0.)
+        h->negative++;
+    int bucket = 0;
+    double limit = HISTOGRAM_BASE;
+    while (value >= limit && bucket < HISTOGRAM_BUCKETS - 1) {
+        limit *= 2.;
+        bucket++;
+    }
+    h->counts[bucket]++;
+}
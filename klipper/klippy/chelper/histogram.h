@@ -0,0 +1,20 @@
+#ifndef HISTOGRAM_H
+#define HISTOGRAM_H
+
+#include <stdint.h> // uint32_t
+
+#define HISTOGRAM_BUCKETS 16
+#define HISTOGRAM_BASE 0.0001
+
+struct histogram {
+    uint32_t counts[HISTOGRAM_BUCKETS];
+    uint32_t count, negative;
+    double sum, min, max;
+};
+
+struct histogram *histogram_alloc(void);
+void histogram_free(struct histogram *h);
+void histogram_reset(struct histogram *h);
+void histogram_add(struct histogram *h, double value);
+
+#endif // histogram.h
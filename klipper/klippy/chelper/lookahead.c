@@ -0,0 +1,114 @@
+// Toolhead "look-ahead" junction planning over a batch of queued moves
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <stdlib.h> // malloc
+#include "compiler.h" // __visible
+
+// The planning pass mirrors MoveQueue.flush() in toolhead.py operation
+// for operation so that the results are identical.  The junction limits
+// of the queued moves are packed by the caller into an array of doubles
+// in 'struct lookahead_move' order (see BatchMoveQueue in toolhead.py).
+
+struct lookahead_move {
+    double max_start_v2, max_cruise_v2, delta_v2;
+    double max_smoothed_v2, smooth_delta_v2;
+};
+
+struct lookahead_junction {
+    double start_v2, cruise_v2, end_v2;
+    int is_set;
+};
+
+struct lookahead_delayed {
+    int index;
+    double start_v2, end_v2;
+};
+
+// Same result as the Python min() builtin for two values
+static inline double
+py_min(double a, double b)
+{
+    return b < a ? b : a;
+}
+
+// Traverse the queue from last to first move and determine the
+// junction speeds assuming the toolhead comes to a complete stop after
+// the last move.  Returns the number of moves that may be flushed (zero
+// if no moves are ready, or -1 on error).  The junction of each move
+// that is to be flushed is stored in 'junctions' (which must hold one
+// entry per queued move).
+int __visible
+lookahead_plan(double *move_limits, int count, int lazy
+               , struct lookahead_junction *junctions)
+{
+    struct lookahead_move *moves = (struct lookahead_move *)move_limits;
+    int update_flush_count = lazy, flush_count = count, ndelayed = 0, i;
+    double next_end_v2 = 0., next_smoothed_v2 = 0., peak_cruise_v2 = 0.;
+    struct lookahead_delayed *delayed = malloc(sizeof(*delayed) * (count + 1));
+    if (!delayed)
+        return -1;
+    for (i = 0; i < count; i++)
+        junctions[i].is_set = 0;
+    for (i = count - 1; i >= 0; i--) {
+        struct lookahead_move *m = &moves[i];
+        double reachable_start_v2 = next_end_v2 + m->delta_v2;
+        double start_v2 = py_min(m->max_start_v2, reachable_start_v2);
+        double reachable_smoothed_v2 = next_smoothed_v2 + m->smooth_delta_v2;
+        double smoothed_v2 = py_min(m->max_smoothed_v2, reachable_smoothed_v2);
+        if (smoothed_v2 < reachable_smoothed_v2) {
+            // It's possible for this move to accelerate
+            if (smoothed_v2 + m->smooth_delta_v2 > next_smoothed_v2
+                || ndelayed) {
+                // This move can decelerate or this is a full accel
+                // move after a full decel move
+                if (update_flush_count && peak_cruise_v2) {
+                    flush_count = i;
+                    update_flush_count = 0;
+                }
+                peak_cruise_v2 = py_min(m->max_cruise_v2, (
+                    smoothed_v2 + reachable_smoothed_v2) * .5);
+                if (ndelayed) {
+                    // Propagate peak_cruise_v2 to any delayed moves
+                    if (!update_flush_count && i < flush_count) {
+                        double mc_v2 = peak_cruise_v2;
+                        int j;
+                        for (j = ndelayed - 1; j >= 0; j--) {
+                            struct lookahead_delayed *d = &delayed[j];
+                            struct lookahead_junction *jn
+                                = &junctions[d->index];
+                            mc_v2 = py_min(mc_v2, d->start_v2);
+                            jn->start_v2 = py_min(d->start_v2, mc_v2);
+                            jn->cruise_v2 = mc_v2;
+                            jn->end_v2 = py_min(d->end_v2, mc_v2);
+                            jn->is_set = 1;
+                        }
+                    }
+                    ndelayed = 0;
+                }
+            }
+            if (!update_flush_count && i < flush_count) {
+                double cruise_v2 = py_min(py_min(
+                    (start_v2 + reachable_start_v2) * .5, m->max_cruise_v2)
+                                          , peak_cruise_v2);
+                struct lookahead_junction *jn = &junctions[i];
+                jn->start_v2 = py_min(start_v2, cruise_v2);
+                jn->cruise_v2 = cruise_v2;
+                jn->end_v2 = py_min(next_end_v2, cruise_v2);
+                jn->is_set = 1;
+            }
+        } else {
+            // Delay calculating this move until peak_cruise_v2 is known
+            struct lookahead_delayed *d = &delayed[ndelayed++];
+            d->index = i;
+            d->start_v2 = start_v2;
+            d->end_v2 = next_end_v2;
+        }
+        next_end_v2 = start_v2;
+        next_smoothed_v2 = smoothed_v2;
+    }
+    free(delayed);
+    if (update_flush_count)
+        return 0;
+    return flush_count;
+}
@@ -23,6 +23,7 @@
 #include <termios.h> // tcflush
 #include <unistd.h> // pipe
 #include "compiler.h" // __visible
+#include "histogram.h" // histogram_add
 #include "list.h" // list_add_tail
 #include "msgblock.h" // message_alloc
 #include "pollreactor.h" // pollreactor_alloc
@@ -72,6 +73,7 @@ struct serialqueue {
     struct list_head old_sent, old_receive;
     // Stats
     uint32_t bytes_write, bytes_read, bytes_retransmit, bytes_invalid;
+    struct histogram histograms[SQH_NUM];
 };
 
 #define SQPF_SERIAL 0
@@ -171,6 +173,7 @@ update_receive_seq(struct serialqueue *sq, double eventtime, uint64_t rseq)
         && sq->last_receive_sent_time) {
         // RFC6298 rtt calculations
         double delta = eventtime - sq->last_receive_sent_time;
+        histogram_add(&sq->histograms[SQH_ROUND_TRIP], delta);
         if (!sq->srtt) {
             sq->rttvar = delta / 2.0;
             sq->srtt = delta * 10.0; // use a higher start default
@@ -239,6 +242,7 @@ handle_message(struct serialqueue *sq, double eventtime, int len)
     }
 
     // Process message
+    struct queue_message *qm = NULL;
     if (len == MESSAGE_MIN) {
         // Ack/nak message
         if (sq->last_ack_seq < rseq)
@@ -247,14 +251,12 @@ handle_message(struct serialqueue *sq, double eventtime, int len)
             // Duplicate Ack is a Nak - do fast retransmit
             pollreactor_update_timer(sq->pr, SQPT_RETRANSMIT, PR_NOW);
     } else {
-        // Data message - add to receive queue
-        struct queue_message *qm = message_fill(sq->input_buf, len);
+        // Data message - prepare for the receive queue
+        qm = message_fill(sq->input_buf, len);
         qm->sent_time = (rseq > sq->retransmit_seq
                          ? sq->last_receive_sent_time : 0.);
         qm->receive_time = get_monotonic(); // must be time post read()
         qm->receive_time -= sq->baud_adjust * len;
-        list_add_tail(&qm->node, &sq->receive_queue);
-        must_wake = 1;
     }
 
     // Check fast readers
@@ -269,11 +271,25 @@ handle_message(struct serialqueue *sq, double eventtime, int len)
         if (must_wake)
             check_wake_receive(sq);
         pthread_mutex_unlock(&sq->lock);
-        fr->func(fr, sq->input_buf, len);
+        int consumed = fr->func(fr, sq->input_buf, len);
         pthread_mutex_unlock(&sq->fast_reader_dispatch_lock);
+        if (!qm)
+            return;
+        if (consumed) {
+            message_free(qm);
+            return;
+        }
+        pthread_mutex_lock(&sq->lock);
+        list_add_tail(&qm->node, &sq->receive_queue);
+        check_wake_receive(sq);
+        pthread_mutex_unlock(&sq->lock);
         return;
     }
 
+    if (qm) {
+        list_add_tail(&qm->node, &sq->receive_queue);
+        must_wake = 1;
+    }
     if (must_wake)
         check_wake_receive(sq);
     pthread_mutex_unlock(&sq->lock);
@@ -454,11 +470,33 @@ retransmit_event(struct serialqueue *sq, double eventtime)
     return waketime;
 }
 
+// Record how long a message waited after its min_clock and how far
+// ahead of its req_clock it is transmitted
+static void
+record_send_latency(struct serialqueue *sq, struct queue_message *qm
+                    , uint64_t send_clock, double est_freq)
+{
+    // Skip min_clock values that were derived from req_clock (or
+    // default to zero) in serialqueue_send_batch()
+    if (qm->min_clock && qm->min_clock + (1LL<<31) > qm->req_clock)
+        histogram_add(&sq->histograms[SQH_QUEUE_WAIT]
+                      , (int64_t)(send_clock - qm->min_clock) / est_freq);
+    if (qm->req_clock && qm->req_clock != BACKGROUND_PRIORITY_CLOCK)
+        histogram_add(&sq->histograms[SQH_SEND_MARGIN]
+                      , (int64_t)(qm->req_clock - send_clock) / est_freq);
+}
+
 // Construct a block of data to be sent to the serial port
 static int
 build_and_send_command(struct serialqueue *sq, uint8_t *buf, double eventtime)
 {
     int len = MESSAGE_HEADER_SIZE;
+    // Estimated mcu clock at transmission (for latency statistics)
+    double est_freq = sq->ce.est_freq;
+    uint64_t send_clock = 0;
+    if (est_freq)
+        send_clock = clock_from_time(
+            &sq->ce, eventtime > sq->idle_time ? eventtime : sq->idle_time);
     while (sq->ready_bytes) {
         // Find highest priority message (message with lowest req_clock)
         uint64_t min_clock = MAX_CLOCK;
@@ -484,6 +522,8 @@ build_and_send_command(struct serialqueue *sq, uint8_t *buf, double eventtime)
         memcpy(&buf[len], qm->msg, qm->len);
         len += qm->len;
         sq->ready_bytes -= qm->len;
+        if (est_freq)
+            record_send_latency(sq, qm, send_clock, est_freq);
         if (qm->notify_id) {
             // Message requires notification - add to notify list
             qm->req_clock = sq->send_seq;
@@ -863,6 +903,34 @@ serialqueue_send(struct serialqueue *sq, struct command_queue *cq, uint8_t *msg
     serialqueue_send_one(sq, cq, qm);
 }
 
+// Schedule the transmission of a series of messages (stored back to
+// back in 'msgs' with their lengths in 'lens').  The messages are
+// added to the queue together so that they are densely packed into
+// message blocks.  The notify_id (if any) is reported once the last
+// message is acknowledged.
+void __visible
+serialqueue_send_multi(struct serialqueue *sq, struct command_queue *cq
+                       , uint8_t *msgs, int *lens, int count
+                       , uint64_t min_clock, uint64_t req_clock
+                       , uint64_t notify_id)
+{
+    if (count <= 0)
+        return;
+    struct list_head list;
+    list_init(&list);
+    int i;
+    for (i = 0; i < count; i++) {
+        struct queue_message *qm = message_fill(msgs, lens[i]);
+        qm->min_clock = min_clock;
+        qm->req_clock = req_clock;
+        if (i == count - 1)
+            qm->notify_id = notify_id;
+        list_add_tail(&qm->node, &list);
+        msgs += lens[i];
+    }
+    serialqueue_send_batch(sq, cq, &list);
+}
+
 // Return a message read from the serial port (or wait for one if none
 // available)
 void __visible
@@ -965,6 +1033,18 @@ serialqueue_get_stats(struct serialqueue *sq, char *buf, int len)
              , stats.ready_bytes, stats.stalled_bytes);
 }
 
+// Copy the latency histograms (see SQH_* in serialqueue.h)
+int __visible
+serialqueue_get_histograms(struct serialqueue *sq, struct histogram *h
+                           , int max)
+{
+    int count = max < SQH_NUM ? max : SQH_NUM;
+    pthread_mutex_lock(&sq->lock);
+    memcpy(h, sq->histograms, count * sizeof(*h));
+    pthread_mutex_unlock(&sq->lock);
+    return count;
+}
+
 // Extract old messages stored in the debug queues
 int __visible
 serialqueue_extract_old(struct serialqueue *sq, int sentq
@@ -2,14 +2,20 @@
 #define SERIALQUEUE_H
 
 #include <stdint.h> // uint8_t
+#include "histogram.h" // struct histogram
 #include "list.h" // struct list_head
 #include "msgblock.h" // MESSAGE_MAX
 
 #define MAX_CLOCK 0x7fffffffffffffffLL
 #define BACKGROUND_PRIORITY_CLOCK 0x7fffffff00000000LL
 
+// Latency histograms kept by each serialqueue
+enum { SQH_ROUND_TRIP, SQH_QUEUE_WAIT, SQH_SEND_MARGIN, SQH_NUM };
+
+// Fast reader callbacks return non-zero if the message block was
+// consumed (and should not be placed on the receive queue)
 struct fastreader;
-typedef void (*fastreader_cb)(struct fastreader *fr, uint8_t *data, int len);
+typedef int (*fastreader_cb)(struct fastreader *fr, uint8_t *data, int len);
 
 struct fastreader {
     struct list_node node;
@@ -41,6 +47,10 @@ void serialqueue_send_one(struct serialqueue *sq, struct command_queue *cq
 void serialqueue_send(struct serialqueue *sq, struct command_queue *cq
                       , uint8_t *msg, int len, uint64_t min_clock
                       , uint64_t req_clock, uint64_t notify_id);
+void serialqueue_send_multi(struct serialqueue *sq, struct command_queue *cq
+                            , uint8_t *msgs, int *lens, int count
+                            , uint64_t min_clock, uint64_t req_clock
+                            , uint64_t notify_id);
 void serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm);
 void serialqueue_set_baud_adjust(struct serialqueue *sq, double baud_adjust);
 void serialqueue_set_receive_window(struct serialqueue *sq, int receive_window);
@@ -50,6 +60,8 @@ void serialqueue_set_clock_est(struct serialqueue *sq, double est_freq
 void serialqueue_get_clock_est(struct serialqueue *sq
                                , struct clock_estimate *ce);
 void serialqueue_get_stats(struct serialqueue *sq, char *buf, int len);
+int serialqueue_get_histograms(struct serialqueue *sq, struct histogram *h
+                               , int max);
 int serialqueue_extract_old(struct serialqueue *sq, int sentq
                             , struct pull_queue_message *q, int max);
 
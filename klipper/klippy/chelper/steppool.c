@@ -0,0 +1,156 @@
+// Parallel step generation across steppers using worker threads
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <pthread.h> // pthread_mutex_lock
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "compiler.h" // __visible
+#include "itersolve.h" // itersolve_generate_steps
+#include "pyhelper.h" // report_errno
+
+// Each stepper_kinematics has its own stepcompress queue and only reads
+// from its trapq, so the steppers of a flush window may be generated
+// concurrently.  The calling thread also generates steps and returns
+// once all steppers are complete (before steppersync_flush is called).
+
+struct steppool {
+    pthread_mutex_t lock; // protects variables below
+    pthread_cond_t work_cond, done_cond;
+    pthread_t *threads;
+    int num_threads, must_exit;
+    // Current flush window
+    struct stepper_kinematics **sk_list;
+    int sk_count, next_sk, done_count;
+    double flush_time;
+    int32_t ret;
+};
+
+// Generate steps for the next stepper in the list (called with lock held)
+static void
+steppool_run_one(struct steppool *sp)
+{
+    struct stepper_kinematics *sk = sp->sk_list[sp->next_sk++];
+    double flush_time = sp->flush_time;
+    pthread_mutex_unlock(&sp->lock);
+    int32_t ret = itersolve_generate_steps(sk, flush_time);
+    pthread_mutex_lock(&sp->lock);
+    if (ret && !sp->ret)
+        sp->ret = ret;
+    if (++sp->done_count >= sp->sk_count)
+        pthread_cond_signal(&sp->done_cond);
+}
+
+// Main code for worker threads
+static void *
+steppool_thread(void *data)
+{
+    struct steppool *sp = data;
+    pthread_mutex_lock(&sp->lock);
+    while (!sp->must_exit) {
+        if (sp->next_sk >= sp->sk_count) {
+            pthread_cond_wait(&sp->work_cond, &sp->lock);
+            continue;
+        }
+        steppool_run_one(sp);
+    }
+    pthread_mutex_unlock(&sp->lock);
+    return NULL;
+}
+
+// Signal the worker threads to exit and wait for them
+static void
+steppool_stop_threads(struct steppool *sp)
+{
+    pthread_mutex_lock(&sp->lock);
+    sp->must_exit = 1;
+    pthread_cond_broadcast(&sp->work_cond);
+    pthread_mutex_unlock(&sp->lock);
+    int i;
+    for (i = 0; i < sp->num_threads; i++)
+        pthread_join(sp->threads[i], NULL);
+}
+
+// Create a new 'steppool' object with the given number of worker threads
+struct steppool * __visible
+steppool_alloc(int num_threads)
+{
+    struct steppool *sp = malloc(sizeof(*sp));
+    if (!sp)
+        return NULL;
+    memset(sp, 0, sizeof(*sp));
+    sp->threads = malloc(sizeof(*sp->threads) * (num_threads + 1));
+    if (!sp->threads) {
+        free(sp);
+        return NULL;
+    }
+    int ret = pthread_mutex_init(&sp->lock, NULL);
+    if (ret)
+        goto fail;
+    ret = pthread_cond_init(&sp->work_cond, NULL);
+    if (ret)
+        goto fail;
+    ret = pthread_cond_init(&sp->done_cond, NULL);
+    if (ret)
+        goto fail;
+    int i;
+    for (i = 0; i < num_threads; i++) {
+        ret = pthread_create(&sp->threads[i], NULL, steppool_thread, sp);
+        if (ret) {
+            steppool_stop_threads(sp);
+            goto fail;
+        }
+        sp->num_threads++;
+    }
+    return sp;
+
+fail:
+    report_errno("steppool alloc", ret);
+    free(sp->threads);
+    free(sp);
+    return NULL;
+}
+
+// Stop the worker threads and free memory associated with a 'steppool'
+void __visible
+steppool_free(struct steppool *sp)
+{
+    if (!sp)
+        return;
+    steppool_stop_threads(sp);
+    free(sp->threads);
+    free(sp);
+}
+
+// Generate (and compress) the steps of all the given steppers up to
+// flush_time.  Returns the first error reported by a stepper (or 0).
+int32_t __visible
+steppool_generate_steps(struct steppool *sp, struct stepper_kinematics **sk_list
+                        , int sk_count, double flush_time)
+{
+    if (!sp->num_threads || sk_count <= 1) {
+        int32_t ret = 0;
+        int i;
+        for (i = 0; i < sk_count; i++) {
+            int32_t sk_ret = itersolve_generate_steps(sk_list[i], flush_time);
+            if (sk_ret && !ret)
+                ret = sk_ret;
+        }
+        return ret;
+    }
+    pthread_mutex_lock(&sp->lock);
+    sp->sk_list = sk_list;
+    sp->flush_time = flush_time;
+    sp->next_sk = sp->done_count = sp->ret = 0;
+    sp->sk_count = sk_count;
+    pthread_cond_broadcast(&sp->work_cond);
+    while (sp->next_sk < sp->sk_count)
+        steppool_run_one(sp);
+    while (sp->done_count < sp->sk_count)
+        pthread_cond_wait(&sp->done_cond, &sp->lock);
+    int32_t ret = sp->ret;
+    sp->sk_list = NULL;
+    sp->sk_count = sp->next_sk = 0;
+    pthread_mutex_unlock(&sp->lock);
+    return ret;
+}
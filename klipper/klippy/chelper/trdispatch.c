@@ -59,7 +59,7 @@ send_trsync_set_timeout(struct trdispatch_mcu *tdm)
 }
 
 // Handle a trsync_state message (callback from serialqueue fastreader)
-static void
+static int
 handle_trsync_state(struct fastreader *fr, uint8_t *data, int len)
 {
     struct trdispatch_mcu *tdm = container_of(fr, struct trdispatch_mcu, fr);
@@ -68,7 +68,7 @@ handle_trsync_state(struct fastreader *fr, uint8_t *data, int len)
     uint32_t fields[5];
     int ret = msgblock_decode(fields, ARRAY_SIZE(fields), data, len);
     if (ret || fields[1] != tdm->trsync_oid)
-        return;
+        return 0;
     uint32_t can_trigger=fields[2], clock=fields[4];
 
     // Process message
@@ -120,6 +120,8 @@ handle_trsync_state(struct fastreader *fr, uint8_t *data, int len)
 
 done:
     pthread_mutex_unlock(&td->lock);
+    // Message is also reported to the host code
+    return 0;
 }
 
 // Begin synchronization
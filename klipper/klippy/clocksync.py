@@ -3,14 +3,185 @@
 # Copyright (C) 2016-2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, math
+import logging, math, collections
 
 RTT_AGE = .000010 / (60. * 60.)
 DECAY = 1. / 30.
 TRANSMIT_EXTRA = .001
+QUERY_TIME = .9839
+QUERY_FAST_TIME = .2467
+WINDOW_SIZE = 32
+WINDOW_OUTLIER_SIGMA = 4.
+WINDOW_MAX_REJECTS = 4
+RESIDUAL_COUNT = 64
+
+# Tracking of the error of each clock prediction (the difference
+# between a clock sample and its prediction prior to the sample)
+class ResidualStats:
+    def __init__(self, mcu_freq):
+        self.mcu_freq = mcu_freq
+        self.residuals = collections.deque(maxlen=RESIDUAL_COUNT)
+        self.accepted = self.rejected = self.resets = 0
+    def note(self, diff, status):
+        if status == "reject":
+            self.rejected += 1
+            return
+        if status == "reset":
+            self.resets += 1
+        self.accepted += 1
+        self.residuals.append(diff / self.mcu_freq)
+    def get_stats(self):
+        rms = peak = 0.
+        if self.residuals:
+            rms = math.sqrt(sum([r**2 for r in self.residuals])
+                            / len(self.residuals))
+            peak = max([abs(r) for r in self.residuals])
+        return {'residual_rms': rms, 'residual_max': peak,
+                'accepted': self.accepted, 'rejected': self.rejected,
+                'resets': self.resets}
+
+# Exponentially decaying linear regression of mcu clock and sent_time
+class DecayEstimator:
+    def __init__(self, mcu_freq):
+        self.mcu_freq = mcu_freq
+        self.freq = mcu_freq
+        self.time_avg = self.time_variance = 0.
+        self.clock_avg = self.clock_covariance = 0.
+        self.prediction_variance = 0.
+        self.last_prediction_time = 0.
+    def reset(self, sent_time, clock):
+        self.time_avg = sent_time
+        self.clock_avg = clock
+        self.prediction_variance = (.001 * self.mcu_freq)**2
+    def predict(self, sent_time):
+        return (sent_time - self.time_avg) * self.freq + self.clock_avg
+    def get_query_time(self):
+        return QUERY_TIME
+    def update(self, sent_time, clock, can_ignore=True):
+        # Filter out samples that are extreme outliers
+        status = "accept"
+        exp_clock = self.predict(sent_time)
+        clock_diff2 = (clock - exp_clock)**2
+        if (clock_diff2 > 25. * self.prediction_variance
+            and clock_diff2 > (.000500 * self.mcu_freq)**2):
+            if (clock > exp_clock and can_ignore
+                and sent_time < self.last_prediction_time+10.):
+                logging.debug("Ignoring clock sample %.3f:"
+                              " freq=%d diff=%d stddev=%.3f",
+                              sent_time, self.freq, clock - exp_clock,
+                              math.sqrt(self.prediction_variance))
+                return "reject"
+            logging.info("Resetting prediction variance %.3f:"
+                         " freq=%d diff=%d stddev=%.3f",
+                         sent_time, self.freq, clock - exp_clock,
+                         math.sqrt(self.prediction_variance))
+            self.prediction_variance = (.001 * self.mcu_freq)**2
+            status = "reset"
+        else:
+            self.last_prediction_time = sent_time
+            self.prediction_variance = (
+                (1. - DECAY) * (self.prediction_variance + clock_diff2 * DECAY))
+        # Add clock and sent_time to linear regression
+        diff_sent_time = sent_time - self.time_avg
+        self.time_avg += DECAY * diff_sent_time
+        self.time_variance = (1. - DECAY) * (
+            self.time_variance + diff_sent_time**2 * DECAY)
+        diff_clock = clock - self.clock_avg
+        self.clock_avg += DECAY * diff_clock
+        self.clock_covariance = (1. - DECAY) * (
+            self.clock_covariance + diff_sent_time * diff_clock * DECAY)
+        # Update prediction from linear regression
+        self.freq = self.clock_covariance / self.time_variance
+        return status
+    def get_estimate(self):
+        return (self.time_avg, self.clock_avg, self.freq,
+                math.sqrt(self.prediction_variance))
+    def dump_debug(self):
+        return ("time_avg=%.3f(%.3f) clock_avg=%.3f(%.3f)"
+                " pred_variance=%.3f" % (
+                    self.time_avg, self.time_variance,
+                    self.clock_avg, self.clock_covariance,
+                    self.prediction_variance))
+
+# Least squares fit over a window of recent samples.  Samples that
+# differ from the prediction by more than WINDOW_OUTLIER_SIGMA times the
+# recent prediction error are discarded, and the clock is queried more
+# often while the window is refilling or samples are being discarded.
+class WindowEstimator:
+    def __init__(self, mcu_freq):
+        self.mcu_freq = mcu_freq
+        self.freq = mcu_freq
+        self.samples = collections.deque(maxlen=WINDOW_SIZE)
+        self.errors = collections.deque(maxlen=WINDOW_SIZE)
+        self.time_avg = self.clock_avg = 0.
+        self.pred_stddev = .001 * mcu_freq
+        self.rejects = 0
+    def reset(self, sent_time, clock):
+        self.samples.clear()
+        self.errors.clear()
+        self.samples.append((sent_time, clock))
+        self.time_avg = sent_time
+        self.clock_avg = clock
+        self.pred_stddev = .001 * self.mcu_freq
+        self.rejects = 0
+    def predict(self, sent_time):
+        return (sent_time - self.time_avg) * self.freq + self.clock_avg
+    def get_query_time(self):
+        if self.rejects or len(self.samples) < WINDOW_SIZE // 2:
+            return QUERY_FAST_TIME
+        return QUERY_TIME
+    def update(self, sent_time, clock, can_ignore=True):
+        status = "accept"
+        diff = clock - self.predict(sent_time)
+        limit = max(WINDOW_OUTLIER_SIGMA * self.pred_stddev,
+                    .000500 * self.mcu_freq)
+        if abs(diff) > limit:
+            self.rejects += 1
+            if can_ignore and self.rejects <= WINDOW_MAX_REJECTS:
+                logging.debug("Ignoring clock sample %.3f:"
+                              " freq=%d diff=%d stddev=%.3f",
+                              sent_time, self.freq, diff, self.pred_stddev)
+                return "reject"
+            # Persistent disagreement - restart from recent samples
+            logging.info("Resetting clock window %.3f:"
+                         " freq=%d diff=%d stddev=%.3f",
+                         sent_time, self.freq, diff, self.pred_stddev)
+            self.samples.clear()
+            self.errors.clear()
+            status = "reset"
+        else:
+            self.errors.append(diff**2)
+        self.rejects = 0
+        self.samples.append((sent_time, clock))
+        # Linear regression over the window
+        count = len(self.samples)
+        time_avg = sum([t for t, c in self.samples]) / count
+        clock_avg = sum([c for t, c in self.samples]) / float(count)
+        time_variance = clock_covariance = 0.
+        for t, c in self.samples:
+            diff_time = t - time_avg
+            time_variance += diff_time**2
+            clock_covariance += diff_time * (c - clock_avg)
+        if count >= 2 and time_variance > 0.:
+            self.freq = clock_covariance / time_variance
+        self.time_avg = time_avg
+        self.clock_avg = clock_avg
+        if self.errors:
+            self.pred_stddev = math.sqrt(sum(self.errors) / len(self.errors))
+        else:
+            self.pred_stddev = .001 * self.mcu_freq
+        return status
+    def get_estimate(self):
+        return self.time_avg, self.clock_avg, self.freq, self.pred_stddev
+    def dump_debug(self):
+        return ("time_avg=%.3f clock_avg=%.3f window=%d pred_stddev=%.3f" % (
+            self.time_avg, self.clock_avg, len(self.samples),
+            self.pred_stddev))
+
+ESTIMATORS = {'decay': DecayEstimator, 'window': WindowEstimator}
 
 class ClockSync:
-    def __init__(self, reactor):
+    def __init__(self, reactor, estimator='decay'):
         self.reactor = reactor
         self.serial = None
         self.get_clock_timer = reactor.register_timer(self._get_clock_event)
@@ -22,27 +193,25 @@ class ClockSync:
         # Minimum round-trip-time tracking
         self.min_half_rtt = 999999999.9
         self.min_rtt_time = 0.
-        # Linear regression of mcu clock and system sent_time
-        self.time_avg = self.time_variance = 0.
-        self.clock_avg = self.clock_covariance = 0.
-        self.prediction_variance = 0.
-        self.last_prediction_time = 0.
+        # Estimation of mcu clock from system sent_time
+        self.estimator_class = ESTIMATORS[estimator]
+        self.estimator = self.estimator_class(self.mcu_freq)
+        self.residuals = ResidualStats(self.mcu_freq)
     def connect(self, serial):
         self.serial = serial
         self.mcu_freq = serial.msgparser.get_constant_float('CLOCK_FREQ')
+        self.estimator = self.estimator_class(self.mcu_freq)
+        self.residuals = ResidualStats(self.mcu_freq)
         # Load initial clock and frequency
         params = serial.send_with_response('get_uptime', 'uptime')
         self.last_clock = (params['high'] << 32) | params['clock']
-        self.clock_avg = self.last_clock
-        self.time_avg = params['#sent_time']
-        self.clock_est = (self.time_avg, self.clock_avg, self.mcu_freq)
-        self.prediction_variance = (.001 * self.mcu_freq)**2
+        self.estimator.reset(params['#sent_time'], self.last_clock)
+        self.clock_est = (params['#sent_time'], self.last_clock, self.mcu_freq)
         # Enable periodic get_clock timer
         for i in range(8):
             self.reactor.pause(self.reactor.monotonic() + 0.050)
-            self.last_prediction_time = -9999.
             params = serial.send_with_response('get_clock', 'clock')
-            self._handle_clock(params)
+            self._handle_clock(params, can_ignore=False)
         self.get_clock_cmd = serial.get_msgparser().create_command('get_clock')
         self.cmd_queue = serial.alloc_command_queue()
         serial.register_response(self._handle_clock, 'clock')
@@ -61,8 +230,8 @@ class ClockSync:
         self.queries_pending += 1
         # Use an unusual time for the next event so clock messages
         # don't resonate with other periodic events.
-        return eventtime + .9839
-    def _handle_clock(self, params):
+        return eventtime + self.estimator.get_query_time()
+    def _handle_clock(self, params, can_ignore=True):
         self.queries_pending = 0
         # Extend clock to 64bit
         last_clock = self.last_clock
@@ -75,6 +244,8 @@ class ClockSync:
         if not sent_time:
             return
         receive_time = params['#receive_time']
+        logging.debug("%sclock sample sent=%.6f receive=%.6f clock=%d",
+                      self.serial.warn_prefix, sent_time, receive_time, clock)
         half_rtt = .5 * (receive_time - sent_time)
         aged_rtt = (sent_time - self.min_rtt_time) * RTT_AGE
         if half_rtt < self.min_half_rtt + aged_rtt:
@@ -82,45 +253,19 @@ class ClockSync:
             self.min_rtt_time = sent_time
             logging.debug("new minimum rtt %.3f: hrtt=%.6f freq=%d",
                           sent_time, half_rtt, self.clock_est[2])
-        # Filter out samples that are extreme outliers
-        exp_clock = ((sent_time - self.time_avg) * self.clock_est[2]
-                     + self.clock_avg)
-        clock_diff2 = (clock - exp_clock)**2
-        if (clock_diff2 > 25. * self.prediction_variance
-            and clock_diff2 > (.000500 * self.mcu_freq)**2):
-            if clock > exp_clock and sent_time < self.last_prediction_time+10.:
-                logging.debug("Ignoring clock sample %.3f:"
-                              " freq=%d diff=%d stddev=%.3f",
-                              sent_time, self.clock_est[2], clock - exp_clock,
-                              math.sqrt(self.prediction_variance))
-                return
-            logging.info("Resetting prediction variance %.3f:"
-                         " freq=%d diff=%d stddev=%.3f",
-                         sent_time, self.clock_est[2], clock - exp_clock,
-                         math.sqrt(self.prediction_variance))
-            self.prediction_variance = (.001 * self.mcu_freq)**2
-        else:
-            self.last_prediction_time = sent_time
-            self.prediction_variance = (
-                (1. - DECAY) * (self.prediction_variance + clock_diff2 * DECAY))
-        # Add clock and sent_time to linear regression
-        diff_sent_time = sent_time - self.time_avg
-        self.time_avg += DECAY * diff_sent_time
-        self.time_variance = (1. - DECAY) * (
-            self.time_variance + diff_sent_time**2 * DECAY)
-        diff_clock = clock - self.clock_avg
-        self.clock_avg += DECAY * diff_clock
-        self.clock_covariance = (1. - DECAY) * (
-            self.clock_covariance + diff_sent_time * diff_clock * DECAY)
-        # Update prediction from linear regression
-        new_freq = self.clock_covariance / self.time_variance
-        pred_stddev = math.sqrt(self.prediction_variance)
-        self.serial.set_clock_est(new_freq, self.time_avg + TRANSMIT_EXTRA,
-                                  int(self.clock_avg - 3. * pred_stddev), clock)
-        self.clock_est = (self.time_avg + self.min_half_rtt,
-                          self.clock_avg, new_freq)
+        # Update the estimate
+        diff = clock - self.estimator.predict(sent_time)
+        status = self.estimator.update(sent_time, clock, can_ignore)
+        self.residuals.note(diff, status)
+        if status == "reject":
+            return
+        time_avg, clock_avg, new_freq, pred_stddev = (
+            self.estimator.get_estimate())
+        self.serial.set_clock_est(new_freq, time_avg + TRANSMIT_EXTRA,
+                                  int(clock_avg - 3. * pred_stddev), clock)
+        self.clock_est = (time_avg + self.min_half_rtt, clock_avg, new_freq)
         #logging.debug("regr %.3f: freq=%.3f d=%d(%.3f)",
-        #              sent_time, new_freq, clock - exp_clock, pred_stddev)
+        #              sent_time, new_freq, diff, pred_stddev)
     # clock frequency conversions
     def print_time_to_clock(self, print_time):
         return int(print_time * self.mcu_freq)
@@ -148,24 +293,23 @@ class ClockSync:
         sample_time, clock, freq = self.clock_est
         return ("clocksync state: mcu_freq=%d last_clock=%d"
                 " clock_est=(%.3f %d %.3f) min_half_rtt=%.6f min_rtt_time=%.3f"
-                " time_avg=%.3f(%.3f) clock_avg=%.3f(%.3f)"
-                " pred_variance=%.3f" % (
+                " %s" % (
                     self.mcu_freq, self.last_clock, sample_time, clock, freq,
                     self.min_half_rtt, self.min_rtt_time,
-                    self.time_avg, self.time_variance,
-                    self.clock_avg, self.clock_covariance,
-                    self.prediction_variance))
+                    self.estimator.dump_debug()))
     def stats(self, eventtime):
         sample_time, clock, freq = self.clock_est
-        return "freq=%d" % (freq,)
+        rstats = self.residuals.get_stats()
+        return "freq=%d clock_resid=%.6f clock_rejects=%d" % (
+            freq, rstats['residual_rms'], rstats['rejected'])
     def calibrate_clock(self, print_time, eventtime):
         return (0., self.mcu_freq)
 
 # Clock syncing code for secondary MCUs (whose clocks are sync'ed to a
 # primary MCU)
 class SecondarySync(ClockSync):
-    def __init__(self, reactor, main_sync):
-        ClockSync.__init__(self, reactor)
+    def __init__(self, reactor, main_sync, estimator='decay'):
+        ClockSync.__init__(self, reactor, estimator)
         self.main_sync = main_sync
         self.clock_adj = (0., 1.)
         self.last_sync_time = 0.
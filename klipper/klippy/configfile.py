@@ -141,6 +141,7 @@ class PrinterConfig:
         self.autosave = None
         self.deprecated = {}
         self.status_raw_config = {}
+        self.status_version = 0
         self.status_settings = {}
         self.status_warnings = []
         self.save_config_pending = False
@@ -309,6 +310,7 @@ class PrinterConfig:
     def deprecate(self, section, option, value=None, msg=None):
         self.deprecated[(section, option, value)] = msg
     def _build_status(self, config):
+        self.status_version += 1
         self.status_raw_config.clear()
         for section in config.get_prefix_sections(''):
             self.status_raw_config[section.get_name()] = section_status = {}
@@ -327,6 +329,8 @@ class PrinterConfig:
             res['section'] = section
             res['option'] = option
             self.status_warnings.append(res)
+    def get_status_version(self, eventtime):
+        return (self.status_version, self.save_config_pending)
     def get_status(self, eventtime):
         return {'config': self.status_raw_config,
                 'settings': self.status_settings,
@@ -3,7 +3,7 @@
 # Copyright (C) 2020-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, time, collections, threading, multiprocessing, os
+import logging, time, collections, multiprocessing, os
 from . import bus, motion_report
 
 # ADXL345 registers
@@ -27,6 +27,17 @@ SET_FIFO_CTL = 0x90
 FREEFALL_ACCEL = 9.80665 * 1000.
 SCALE = 0.0039 * FREEFALL_ACCEL # 3.9mg/LSB * Earth gravity in mm/s**2
 
+# Lookup tables of scaled values for each raw 13bit (two's complement)
+# measurement.  This avoids the per sample arithmetic in _extract_samples()
+scale_tables = {}
+def get_scale_table(scale):
+    table = scale_tables.get(scale)
+    if table is None:
+        table = [round((raw - ((raw & 0x1000) << 1)) * scale, 6)
+                 for raw in range(0x2000)]
+        scale_tables[scale] = table
+    return table
+
 Accel_Measurement = collections.namedtuple(
     'Accel_Measurement', ('time', 'accel_x', 'accel_y', 'accel_z'))
 
@@ -212,27 +223,27 @@ class ADXL345:
         if any([a not in am for a in axes_map]):
             raise config.error("Invalid adxl345 axes_map parameter")
         self.axes_map = [am[a.strip()] for a in axes_map]
+        self.axes_tables = [(pos, get_scale_table(scale))
+                            for pos, scale in self.axes_map]
         self.data_rate = config.getint('rate', 3200)
         if self.data_rate not in QUERY_RATES:
             raise config.error("Invalid rate parameter: %d" % (self.data_rate,))
-        # Measurement storage (accessed from background thread)
-        self.lock = threading.Lock()
-        self.raw_samples = []
         # Setup mcu sensor_adxl345 bulk query code
         self.spi = bus.MCU_SPI_from_config(config, 3, default_speed=5000000)
         self.mcu = mcu = self.spi.get_mcu()
         self.oid = oid = mcu.create_oid()
         self.query_adxl345_cmd = self.query_adxl345_end_cmd = None
         self.query_adxl345_status_cmd = None
+        self.bulk_queue = None
         mcu.add_config_cmd("config_adxl345 oid=%d spi_oid=%d"
                            % (oid, self.spi.get_oid()))
         mcu.add_config_cmd("query_adxl345 oid=%d clock=0 rest_ticks=0"
                            % (oid,), on_restart=True)
         mcu.register_config_callback(self._build_config)
-        mcu.register_response(self._handle_adxl345_data, "adxl345_data", oid)
         # Clock tracking
         self.last_sequence = self.max_query_duration = 0
         self.last_limit_count = self.last_error_count = 0
+        self.last_missing_count = 0
         self.clock_sync = ClockSyncRegression(self.mcu, 640)
         # API server endpoints
         self.api_dump = motion_report.APIDumpHelper(
@@ -243,6 +254,10 @@ class ADXL345:
                                  self._handle_dump_adxl345)
     def _build_config(self):
         cmdqueue = self.spi.get_command_queue()
+        # Sample data is stored by the serial thread (see serialhdl.BulkQueue)
+        self.bulk_queue = self.mcu.alloc_bulk_queue(
+            "adxl345_data oid=%c sequence=%hu data=%*s", self.oid,
+            BYTES_PER_SAMPLE * SAMPLES_PER_BLOCK)
         self.query_adxl345_cmd = self.mcu.lookup_command(
             "query_adxl345 oid=%c clock=%u rest_ticks=%u", cq=cmdqueue)
         self.query_adxl345_end_cmd = self.mcu.lookup_query_command(
@@ -269,42 +284,46 @@ class ADXL345:
     # Measurement collection
     def is_measuring(self):
         return self.query_rate > 0
-    def _handle_adxl345_data(self, params):
-        with self.lock:
-            self.raw_samples.append(params)
-    def _extract_samples(self, raw_samples):
+    def _extract_samples(self):
         # Load variables to optimize inner loop below
-        (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = self.axes_map
-        last_sequence = self.last_sequence
+        (x_pos, x_table), (y_pos, y_table), (z_pos, z_table) = self.axes_tables
         time_base, chip_base, inv_freq = self.clock_sync.get_time_translation()
-        # Process every message in raw_samples
-        count = seq = 0
-        samples = [None] * (len(raw_samples) * SAMPLES_PER_BLOCK)
-        for params in raw_samples:
-            seq_diff = (last_sequence - params['sequence']) & 0xffff
-            seq_diff -= (seq_diff & 0x8000) << 1
-            seq = last_sequence - seq_diff
-            d = bytearray(params['data'])
-            msg_cdiff = seq * SAMPLES_PER_BLOCK - chip_base
-            for i in range(len(d) // BYTES_PER_SAMPLE):
-                d_xyz = d[i*BYTES_PER_SAMPLE:(i+1)*BYTES_PER_SAMPLE]
-                xlow, ylow, zlow, xzhigh, yzhigh = d_xyz
-                if yzhigh & 0x80:
-                    self.last_error_count += 1
-                    continue
-                rx = (xlow | ((xzhigh & 0x1f) << 8)) - ((xzhigh & 0x10) << 9)
-                ry = (ylow | ((yzhigh & 0x1f) << 8)) - ((yzhigh & 0x10) << 9)
-                rz = ((zlow | ((xzhigh & 0xe0) << 3) | ((yzhigh & 0xe0) << 6))
-                      - ((yzhigh & 0x40) << 7))
-                raw_xyz = (rx, ry, rz)
-                x = round(raw_xyz[x_pos] * x_scale, 6)
-                y = round(raw_xyz[y_pos] * y_scale, 6)
-                z = round(raw_xyz[z_pos] * z_scale, 6)
-                ptime = round(time_base + (msg_cdiff + i) * inv_freq, 6)
-                samples[count] = (ptime, x, y, z)
-                count += 1
-        self.clock_sync.set_last_chip_clock(seq * SAMPLES_PER_BLOCK + i)
-        del samples[count:]
+        bulk_queue = self.bulk_queue
+        data = bulk_queue.get_buffer()
+        block_size = bulk_queue.block_size
+        # Process every block stored by the bulk queue
+        samples = []
+        error_count = i = 0
+        seq = None
+        while 1:
+            pos, sequences, lengths = bulk_queue.pull()
+            count = len(sequences)
+            if not count:
+                break
+            d = bytearray(data[pos * block_size:(pos + count) * block_size])
+            for j in range(count):
+                seq = sequences[j]
+                msg_cdiff = seq * SAMPLES_PER_BLOCK - chip_base
+                p = j * block_size
+                for i in range(lengths[j] // BYTES_PER_SAMPLE):
+                    xlow, ylow, zlow, xzhigh, yzhigh = d[p:p+BYTES_PER_SAMPLE]
+                    p += BYTES_PER_SAMPLE
+                    if yzhigh & 0x80:
+                        error_count += 1
+                        continue
+                    raw_xyz = (xlow | ((xzhigh & 0x1f) << 8),
+                               ylow | ((yzhigh & 0x1f) << 8),
+                               zlow | ((xzhigh & 0xe0) << 3)
+                               | ((yzhigh & 0x60) << 6))
+                    ptime = round(time_base + (msg_cdiff + i) * inv_freq, 6)
+                    samples.append((ptime, x_table[raw_xyz[x_pos]],
+                                    y_table[raw_xyz[y_pos]],
+                                    z_table[raw_xyz[z_pos]]))
+            bulk_queue.release(count)
+        if seq is not None:
+            self.clock_sync.set_last_chip_clock(seq * SAMPLES_PER_BLOCK + i)
+        self.last_error_count += error_count
+        self.last_missing_count = bulk_queue.get_stats()['missing']
         return samples
     def _update_clock(self, minclock=0):
         # Query current state
@@ -355,9 +374,8 @@ class ADXL345:
         self.set_reg(REG_FIFO_CTL, 0x00)
         self.set_reg(REG_BW_RATE, QUERY_RATES[self.data_rate])
         self.set_reg(REG_FIFO_CTL, SET_FIFO_CTL)
-        # Setup samples
-        with self.lock:
-            self.raw_samples = []
+        # Setup samples (the mcu restarts the message sequence at zero)
+        self.bulk_queue.start(0)
         # Start bulk reading
         systime = self.printer.get_reactor().monotonic()
         print_time = self.mcu.estimated_print_time(systime) + MIN_MSG_TIME
@@ -370,6 +388,7 @@ class ADXL345:
         # Initialize clock tracking
         self.last_sequence = 0
         self.last_limit_count = self.last_error_count = 0
+        self.last_missing_count = 0
         self.clock_sync.reset(reqclock, 0)
         self.max_query_duration = 1 << 31
         self._update_clock(minclock=reqclock)
@@ -380,22 +399,17 @@ class ADXL345:
         # Halt bulk reading
         params = self.query_adxl345_end_cmd.send([self.oid, 0, 0])
         self.query_rate = 0
-        with self.lock:
-            self.raw_samples = []
+        self.bulk_queue.stop()
         logging.info("ADXL345 finished '%s' measurements", self.name)
     # API interface
     def _api_update(self, eventtime):
         self._update_clock()
-        with self.lock:
-            raw_samples = self.raw_samples
-            self.raw_samples = []
-        if not raw_samples:
-            return {}
-        samples = self._extract_samples(raw_samples)
+        samples = self._extract_samples()
         if not samples:
             return {}
         return {'data': samples, 'errors': self.last_error_count,
-                'overflows': self.last_limit_count}
+                'overflows': self.last_limit_count,
+                'missing': self.last_missing_count}
     def _api_startstop(self, is_start):
         if is_start:
             self._start_measurements()
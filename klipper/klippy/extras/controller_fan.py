@@ -45,6 +45,8 @@ class ControllerFan:
         reactor.register_timer(self.callback, reactor.monotonic()+PIN_MIN_TIME)
     def get_status(self, eventtime):
         return self.fan.get_status(eventtime)
+    def get_status_version(self, eventtime):
+        return self.fan.get_status_version(eventtime)
     def callback(self, eventtime):
         speed = 0.
         active = False
@@ -121,6 +121,9 @@ class Fan:
             'speed': self.last_fan_value,
             'rpm': tachometer_status['rpm'],
         }
+    def get_status_version(self, eventtime):
+        return (self.last_fan_value,
+                self.tachometer.get_status_version(eventtime))
 
 class FanTachometer:
     def __init__(self, config):
@@ -142,6 +145,11 @@ class FanTachometer:
         else:
             rpm = None
         return {'rpm': rpm}
+    def get_status_version(self, eventtime):
+        if self._freq_counter is not None:
+            # The measured rpm may change at any time
+            return eventtime
+        return None
 
 class PrinterFan:
     def __init__(self, config):
@@ -153,6 +161,8 @@ class PrinterFan:
         gcode.register_command("M107", self.cmd_M107)
     def get_status(self, eventtime):
         return self.fan.get_status(eventtime)
+    def get_status_version(self, eventtime):
+        return self.fan.get_status_version(eventtime)
     def cmd_M106(self, gcmd):
         # Set fan speed
         value = gcmd.get_float('S', 255., minval=0.) / 255.
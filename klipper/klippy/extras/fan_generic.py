@@ -20,6 +20,8 @@ class PrinterFanGeneric:
 
     def get_status(self, eventtime):
         return self.fan.get_status(eventtime)
+    def get_status_version(self, eventtime):
+        return self.fan.get_status_version(eventtime)
     def cmd_SET_FAN_SPEED(self, gcmd):
         speed = gcmd.get_float('SPEED', 0.)
         self.fan.set_speed_from_command(speed)
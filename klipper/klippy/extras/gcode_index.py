@@ -0,0 +1,207 @@
+# Line and layer index of g-code files for virtual_sdcard
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, re, json, bisect, threading, logging
+
+INDEX_VERSION = 2
+INDEX_CHUNK_SIZE = 256 * 1024
+# Approximate spacing of the line checkpoints (bounds the file read
+# done by GCodeIndex.find_line() in the reactor)
+CHECKPOINT_SIZE = 16 * 1024
+
+# Lines that are not dispatched (and not counted in printed_lineno)
+# by VirtualSD.work_handler, except for the ";LAYER:" markers
+nonprinted_r = re.compile(r'^(?:;|M99123)[^\n]*', re.M)
+
+def get_index_filename(filename):
+    dirname, basename = os.path.split(filename)
+    return os.path.join(dirname, '.' + basename + '.index')
+
+# Summary of a g-code file built from a single pass over its contents
+class GCodeIndex:
+    def __init__(self, filename, data):
+        self.filename = filename
+        self.data = data
+        # Checkpoints are (offset, line, printed_line, comment_bytes)
+        # at a line start about every CHECKPOINT_SIZE bytes of the file
+        self.checkpoint_offsets = [c[0] for c in data['checkpoints']]
+        self.layer_offsets = [l[1] for l in data['layers']]
+        self.layers_by_name = {}
+        for layer in data['layers']:
+            self.layers_by_name.setdefault(layer[0], layer)
+    def get_line_count(self):
+        return self.data['line_count']
+    def get_printed_line_count(self):
+        return self.data['printed_line_count']
+    def get_comment_bytes(self):
+        return self.data['comment_bytes']
+    def get_data_ranges(self):
+        return list(self.data['data_ranges'])
+    def get_layer_count(self):
+        return len(self.data['layers'])
+    def get_z_markers(self):
+        return list(self.data['z_markers'])
+    def find_layer(self, layer):
+        # Return (offset, line, printed_line) of a ";LAYER:" marker
+        res = self.layers_by_name.get(str(layer))
+        if res is None:
+            return None
+        return tuple(res[1:])
+    def get_layer_at(self, offset):
+        # Return the name of the layer being printed at a file offset
+        pos = bisect.bisect_right(self.layer_offsets, offset)
+        if not pos:
+            return None
+        return self.data['layers'][pos - 1][0]
+    def find_line(self, offset):
+        # Return (line, printed_line) of the line starting at offset
+        pos = bisect.bisect_right(self.checkpoint_offsets, offset) - 1
+        start, line, printed, comment_bytes = self.data['checkpoints'][pos]
+        with open(self.filename, 'rb') as f:
+            f.seek(start)
+            data = f.read(offset - start)
+        count = data.count('\n')
+        data = data[:data.rfind('\n') + 1]
+        skip = sum([1 for m in nonprinted_r.finditer(data)
+                    if not m.group().startswith(";LAYER:")])
+        return line + count, printed + count - skip
+
+class _IndexBuilder:
+    def __init__(self):
+        self.checkpoints = []
+        self.layers = []
+        self.z_markers = []
+        self.data_ranges = []
+        self.data_start = None
+        self.offset = self.line = self.printed = self.comment_bytes = 0
+    def add_block(self, data):
+        # Index a block of complete lines starting at self.offset
+        self.checkpoints.append((self.offset, self.line, self.printed,
+                                 self.comment_bytes))
+        count_pos = count_line = 0
+        skip = 0
+        for m in nonprinted_r.finditer(data):
+            text = m.group()
+            count_line += data.count('\n', count_pos, m.start())
+            count_pos = m.start()
+            moffset = self.offset + m.start()
+            mline = self.line + count_line
+            mprinted = self.printed + count_line - skip
+            if not text.startswith(';'):
+                skip += 1
+                continue
+            self.comment_bytes += len(text) + 1
+            if text.startswith(";LAYER:"):
+                self.layers.append((text[7:].strip(), moffset, mline,
+                                    mprinted))
+                continue
+            skip += 1
+            if text.startswith(";Z:"):
+                try:
+                    self.z_markers.append((float(text[3:]), moffset))
+                except ValueError:
+                    pass
+            elif text.startswith(";Data start"):
+                self.data_start = moffset
+            elif text.startswith(";Data end") and self.data_start is not None:
+                self.data_ranges.append((self.data_start, moffset))
+                self.data_start = None
+        count = data.count('\n')
+        self.offset += len(data)
+        self.line += count
+        self.printed += count - skip
+    def add_chunk(self, data):
+        # Split a chunk of complete lines into checkpoint sized blocks
+        pos = 0
+        while pos < len(data):
+            end = data.rfind('\n', pos, pos + CHECKPOINT_SIZE) + 1
+            if end <= pos:
+                # Line longer than CHECKPOINT_SIZE
+                end = data.find('\n', pos + CHECKPOINT_SIZE) + 1
+            self.add_block(data[pos:end])
+            pos = end
+
+def _build_index(filename, st):
+    builder = _IndexBuilder()
+    partial = ""
+    with open(filename, 'rb') as f:
+        while 1:
+            data = f.read(INDEX_CHUNK_SIZE)
+            if not data:
+                break
+            data = partial + data
+            end = data.rfind('\n') + 1
+            partial = data[end:]
+            builder.add_chunk(data[:end])
+    if partial:
+        # Final line without a trailing newline
+        builder.add_block(partial + '\n')
+    if not builder.checkpoints:
+        builder.checkpoints.append((0, 0, 0, 0))
+    return {'version': INDEX_VERSION, 'mtime': st.st_mtime,
+            'size': st.st_size, 'line_count': builder.line,
+            'printed_line_count': builder.printed,
+            'comment_bytes': builder.comment_bytes,
+            'checkpoints': builder.checkpoints, 'layers': builder.layers,
+            'z_markers': builder.z_markers,
+            'data_ranges': builder.data_ranges}
+
+def _load_sidecar(filename, st):
+    try:
+        with open(get_index_filename(filename), 'rb') as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if (data.get('version') != INDEX_VERSION or data.get('size') != st.st_size
+        or data.get('mtime') != st.st_mtime):
+        return None
+    return data
+
+def load_index(filename):
+    st = os.stat(filename)
+    data = _load_sidecar(filename, st)
+    if data is None:
+        data = _build_index(filename, st)
+        try:
+            with open(get_index_filename(filename), 'wb') as f:
+                json.dump(data, f)
+        except (IOError, OSError):
+            logging.info("Unable to write g-code index for %s", filename)
+    return GCodeIndex(filename, data)
+
+# Build (or load cached) indexes in a background thread
+class GCodeIndexer:
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.lock = threading.Lock()
+        self.cache = {}
+    def _bg_thread(self, filename, callback):
+        try:
+            index = load_index(filename)
+        except:
+            logging.exception("g-code index %s", filename)
+            index = None
+        if index is not None:
+            with self.lock:
+                self.cache[filename] = index
+        self.reactor.register_async_callback(
+            (lambda e, cb=callback, i=index: cb(i)))
+    def request(self, filename, callback):
+        # Invoke callback(index) in the reactor once the index is ready
+        with self.lock:
+            index = self.cache.get(filename)
+        if index is not None:
+            st = os.stat(filename)
+            if (index.data['size'] == st.st_size
+                and index.data['mtime'] == st.st_mtime):
+                self.reactor.register_callback(
+                    (lambda e, cb=callback, i=index: cb(i)))
+                return
+        bg_thread = threading.Thread(target=self._bg_thread,
+                                     args=(filename, callback))
+        bg_thread.daemon = True
+        bg_thread.start()
+    def wait(self, filename):
+        completion = self.reactor.completion()
+        self.request(filename, completion.complete)
+        return completion.wait()
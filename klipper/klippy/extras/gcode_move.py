@@ -40,6 +40,7 @@ class GCodeMove:
             desc = getattr(self, 'cmd_' + cmd + '_help', None)
             gcode.register_command(cmd, func, False, desc)
         gcode.register_command('G0', self.cmd_G1)
+        gcode.register_fast_move(self.cmd_G1, self.move_G1)
         gcode.register_command('M114', self.cmd_M114, True)
         gcode.register_command('GET_POSITION', self.cmd_GET_POSITION, True,
                                desc=self.cmd_GET_POSITION_help)
@@ -177,37 +178,40 @@ class GCodeMove:
         # Move
         params = gcmd.get_command_parameters()
         try:
-            for pos, axis in enumerate('XYZ'):
-                if axis in params:
-                    v = float(params[axis])
-                    if not self.absolute_coord:
-                        # value relative to position of last move
-                        self.last_position[pos] += v 
-                    else:
-                        self.last_position[pos] = v + self.base_position[pos]
-                    if axis == 'Z':
-                        move_pos = self._get_gcode_position()
-                        self.nprintf("ZMove:%.2f" % (move_pos[pos]))
-                    # self.nprintf("cur offset %s"%(str(offset)))
-                    # self.nprintf("move to %s %s %s"%(str(self.last_position), str(self.base_position[pos]), str(v)))
-            if 'E' in params:
-                v = float(params['E']) * self.extrude_factor
-                if not self.absolute_coord or not self.absolute_extrude:
-                    # value relative to position of last move
-                    self.last_position[3] += v
-                else:
-                    # value relative to base coordinate position
-                    self.last_position[3] = v + self.base_position[3]
-                self.checkFilamentState()
-            if 'F' in params:
-                gcode_speed = float(params['F'])
-                if gcode_speed <= 0.:
-                    raise gcmd.error("Invalid speed in '%s'"
-                                     % (gcmd.get_commandline(),))
-                self.speed = gcode_speed * self.speed_factor
+            coords = [float(params[axis]) if axis in params else None
+                      for axis in 'XYZEF']
         except ValueError as e:
             raise gcmd.error("Unable to parse move '%s'"
                              % (gcmd.get_commandline(),))
+        if coords[4] is not None and coords[4] <= 0.:
+            raise gcmd.error("Invalid speed in '%s'"
+                             % (gcmd.get_commandline(),))
+        self.move_G1(coords)
+    
+    def move_G1(self, coords):
+        # Move to already parsed [X, Y, Z, E, F] (None if not specified)
+        for pos in range(3):
+            v = coords[pos]
+            if v is not None:
+                if not self.absolute_coord:
+                    # value relative to position of last move
+                    self.last_position[pos] += v 
+                else:
+                    self.last_position[pos] = v + self.base_position[pos]
+                if pos == 2:
+                    move_pos = self._get_gcode_position()
+                    self.nprintf("ZMove:%.2f" % (move_pos[pos]))
+        if coords[3] is not None:
+            v = coords[3] * self.extrude_factor
+            if not self.absolute_coord or not self.absolute_extrude:
+                # value relative to position of last move
+                self.last_position[3] += v
+            else:
+                # value relative to base coordinate position
+                self.last_position[3] = v + self.base_position[3]
+            self.checkFilamentState()
+        if coords[4] is not None:
+            self.speed = coords[4] * self.speed_factor
         self.move_with_transform(self.last_position, self.speed)
     
     def checkFilamentState(self) :
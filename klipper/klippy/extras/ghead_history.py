@@ -0,0 +1,85 @@
+# History of tool head (ghead) temperature, K-sensor and fan readings
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import array
+from . import motion_report
+
+CHANNELS = ('temperature', 'ksensor', 'fan')
+HEADS = ('left', 'right')
+
+# Fixed size ring of (time, value) samples
+class SampleRing:
+    def __init__(self, size):
+        self.size = size
+        self.times = array.array('d', [0.]) * size
+        self.values = array.array('d', [0.]) * size
+        self.count = 0
+    def add(self, sample_time, value):
+        pos = self.count % self.size
+        self.times[pos] = sample_time
+        self.values[pos] = value
+        self.count += 1
+    def get_samples(self, sequence, start_time=0.):
+        # Return samples from 'sequence' onwards (and the next sequence)
+        count = self.count
+        sequence = max(sequence, count - self.size)
+        times, values, size = self.times, self.values, self.size
+        data = [(times[i % size], values[i % size])
+                for i in range(sequence, count)]
+        if start_time:
+            data = [d for d in data if d[0] > start_time]
+        return data, count
+
+class HeadHistory:
+    def __init__(self, printer, head, size):
+        self.printer = printer
+        self.head = head
+        self.rings = {c: SampleRing(size) for c in CHANNELS}
+        self.last_api_sequence = {c: 0 for c in CHANNELS}
+        # API server endpoints
+        self.api_dump = motion_report.APIDumpHelper(
+            printer, self._api_update, self._api_startstop)
+        wh = printer.lookup_object('webhooks')
+        wh.register_mux_endpoint("ghead_history/dump_history", "head", head,
+                                 self._handle_dump_history)
+        wh.register_mux_endpoint("ghead_history/get_history", "head", head,
+                                 self._handle_get_history)
+    def add_sample(self, channel, sample_time, value):
+        self.rings[channel].add(sample_time, value)
+    def _api_startstop(self, is_start):
+        if is_start:
+            for c, ring in self.rings.items():
+                self.last_api_sequence[c] = ring.count
+    def _api_update(self, eventtime):
+        msg = {}
+        for c, ring in self.rings.items():
+            data, self.last_api_sequence[c] = ring.get_samples(
+                self.last_api_sequence[c])
+            if data:
+                msg[c] = data
+        if not msg:
+            return {}
+        return {'data': msg}
+    def _handle_dump_history(self, web_request):
+        self.api_dump.add_client(web_request)
+        web_request.send({'header': ('time', 'value')})
+    def _handle_get_history(self, web_request):
+        start_time = web_request.get_float('start_time', 0.)
+        data = {c: ring.get_samples(0, start_time)[0]
+                for c, ring in self.rings.items()}
+        web_request.send({'header': ('time', 'value'), 'data': data})
+
+class GheadHistory:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        size = config.getint('history_size', 4096, minval=16)
+        self.heads = [HeadHistory(self.printer, h, size) for h in HEADS]
+        mcu = self.printer.lookup_object('mcu')
+        mcu.get_ghead().register_sample_callback(self._handle_sample)
+    def _handle_sample(self, channel, ptr, sample_time, value):
+        # Invoked from background serial thread
+        if ptr < len(self.heads):
+            self.heads[ptr].add_sample(channel, sample_time, value)
+
+def load_config(config):
+    return GheadHistory(config)
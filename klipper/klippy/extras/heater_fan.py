@@ -25,6 +25,8 @@ class PrinterHeaterFan:
         reactor.register_timer(self.callback, reactor.monotonic()+PIN_MIN_TIME)
     def get_status(self, eventtime):
         return self.fan.get_status(eventtime)
+    def get_status_version(self, eventtime):
+        return self.fan.get_status_version(eventtime)
     def callback(self, eventtime):
         speed = 0.
         for heater in self.heaters:
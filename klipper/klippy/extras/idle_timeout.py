@@ -36,6 +36,11 @@ class IdleTimeout:
         if self.state == "Printing":
             printing_time = eventtime - self.last_print_start_systime
         return { "state": self.state, "printing_time": printing_time }
+    def get_status_version(self, eventtime):
+        if self.state == "Printing":
+            # printing_time changes on every query
+            return eventtime
+        return self.state
     def handle_ready(self):
         self.toolhead = self.printer.lookup_object('toolhead')
         self.timeout_timer = self.reactor.register_timer(self.timeout_handler)
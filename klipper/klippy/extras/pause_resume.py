@@ -42,6 +42,8 @@ class PauseResume:
         return {
             'is_paused': self.is_paused
         }
+    def get_status_version(self, eventtime):
+        return self.is_paused
     def is_sd_active(self):
         return self.v_sd is not None and self.v_sd.is_active()
     def send_pause_command(self):
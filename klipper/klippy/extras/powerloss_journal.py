@@ -0,0 +1,194 @@
+# Power-loss recovery journal for virtual_sdcard prints
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, struct, zlib, json, time, threading, logging, Queue as queue
+
+# The journal is a preallocated file holding a header followed by a
+# fixed number of fixed size record slots.  Records are written to the
+# slots in round-robin order with an increasing sequence number, so
+# the newest record is the valid one with the highest sequence.
+JOURNAL_MAGIC = 0x4a4c504b
+JOURNAL_VERSION = 1
+HEADER_FORMAT = "<IIIQ256s"
+HEADER_SIZE = struct.calcsize("<I" + HEADER_FORMAT[1:])
+RECORD_FORMAT = "<IdQI4d4dB3f3f"
+RECORD_SIZE = struct.calcsize("<I" + RECORD_FORMAT[1:])
+
+FSYNC_MODES = ['always', 'interval', 'never']
+
+def _pack(fmt, *args):
+    body = struct.pack(fmt, *args)
+    return struct.pack("<I", zlib.crc32(body) & 0xffffffff) + body
+
+def _unpack(fmt, data):
+    if len(data) != 4 + struct.calcsize(fmt):
+        return None
+    crc, = struct.unpack_from("<I", data)
+    body = data[4:]
+    if crc != zlib.crc32(body) & 0xffffffff:
+        return None
+    return struct.unpack(fmt, body)
+
+# Write journal records from a background thread
+class PowerLossJournal:
+    def __init__(self, filename, record_count=64, fsync_mode='interval',
+                 fsync_interval=1., legacy_filenames=()):
+        self.filename = filename
+        self.record_count = record_count
+        self.fsync_mode = fsync_mode
+        self.fsync_interval = fsync_interval
+        self.legacy_filenames = legacy_filenames
+        self.legacy_index = 0
+        self.legacy_record = {'MODIFYTIME': time.time(), 'SEEKPOSITION': 0}
+        self.fd = None
+        self.sequence = 0
+        self.print_file = None
+        self.last_fsync = 0.
+        self.bg_queue = queue.Queue()
+        self.bg_thread = threading.Thread(target=self._bg_thread)
+        self.bg_thread.daemon = True
+        self.bg_thread.start()
+    # Reactor side interface (never blocks on the filesystem)
+    def start(self, gcode_filename, file_size):
+        self.bg_queue.put_nowait(('start', (gcode_filename, file_size)))
+    def resume(self, gcode_filename, file_size):
+        self.bg_queue.put_nowait(('resume', (gcode_filename, file_size)))
+    def note_position(self, state):
+        self.bg_queue.put_nowait(('record', state))
+    def complete(self):
+        self.bg_queue.put_nowait(('complete', None))
+    def stop(self):
+        self.bg_queue.put_nowait(None)
+        self.bg_thread.join()
+    # Background thread
+    def _bg_thread(self):
+        while 1:
+            ops = [self.bg_queue.get(True)]
+            while 1:
+                try:
+                    ops.append(self.bg_queue.get_nowait())
+                except queue.Empty:
+                    break
+            for i, op in enumerate(ops):
+                if op is None:
+                    self._close()
+                    return
+                action, data = op
+                if (action == 'record' and i + 1 < len(ops)
+                    and ops[i + 1] is not None and ops[i + 1][0] == 'record'):
+                    # Only the newest queued position needs to be stored
+                    continue
+                try:
+                    getattr(self, '_do_' + action)(data)
+                except:
+                    logging.exception("powerloss journal %s", action)
+    def _sync(self, force=False):
+        if self.fsync_mode == 'never':
+            return
+        curtime = time.time()
+        if (force or self.fsync_mode == 'always'
+            or curtime >= self.last_fsync + self.fsync_interval):
+            os.fsync(self.fd)
+            self.last_fsync = curtime
+    def _write_header(self, gcode_filename, file_size):
+        header = _pack(HEADER_FORMAT, JOURNAL_MAGIC, JOURNAL_VERSION,
+                       self.record_count, file_size, gcode_filename)
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        os.write(self.fd, header)
+    def _open(self):
+        if self.fd is None:
+            self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+    def _do_start(self, data):
+        gcode_filename, file_size = data
+        self._open()
+        self._write_header(gcode_filename, file_size)
+        os.write(self.fd, '\0' * (RECORD_SIZE * self.record_count))
+        self.sequence = 0
+        self.print_file = data
+        self._sync(force=True)
+        self.legacy_index = 0
+        self.legacy_record = {'MODIFYTIME': time.time(), 'SEEKPOSITION': 0}
+        for fname in self.legacy_filenames:
+            self._write_legacy(fname)
+    def _do_resume(self, data):
+        if self.fd is not None and self.print_file == data:
+            # Already recording this print
+            return
+        gcode_filename, file_size = data
+        record = read_journal(self.filename)
+        if (record is None or record['filename'] != gcode_filename
+            or record['file_size'] != file_size):
+            self._do_start(data)
+            return
+        # Continue the existing journal (eg, a print recovered after a
+        # power loss) so its newest record remains valid
+        self._open()
+        self.sequence = record['sequence']
+        self.print_file = data
+    def _do_record(self, state):
+        if self.fd is not None:
+            self._write_record(state)
+        if self.legacy_filenames:
+            self.legacy_record.update({'MODIFYTIME': state['time'],
+                                       'SEEKPOSITION': state['file_position'],
+                                       'RECORD_LINE': state['line']})
+            self._write_legacy(self.legacy_filenames[self.legacy_index])
+            self.legacy_index = ((self.legacy_index + 1)
+                                 % len(self.legacy_filenames))
+    def _write_record(self, state):
+        self.sequence += 1
+        slot = self.sequence % self.record_count
+        record = _pack(RECORD_FORMAT, self.sequence, state['time'],
+                       state['file_position'], state['line_number'],
+                       *(list(state['toolhead_position'])
+                         + list(state['gcode_position'])
+                         + [state['extruder']]
+                         + list(state['target_temps'])
+                         + list(state['current_temps'])))
+        os.lseek(self.fd, HEADER_SIZE + slot * RECORD_SIZE, os.SEEK_SET)
+        os.write(self.fd, record)
+        self._sync()
+    def _do_complete(self, data):
+        if self.fd is None:
+            return
+        self.print_file = None
+        self._write_header("", 0)
+        self._sync(force=True)
+    def _write_legacy(self, fname):
+        with open(fname, "w") as json_file:
+            json.dump(self.legacy_record, json_file)
+    def _close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+# Locate the newest valid record in a journal file
+def read_journal(filename):
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return None
+    with f:
+        header = _unpack(HEADER_FORMAT, f.read(HEADER_SIZE))
+        if header is None:
+            logging.info("powerloss journal %s: invalid header", filename)
+            return None
+        magic, version, record_count, file_size, gcode_filename = header
+        gcode_filename = gcode_filename.rstrip('\0')
+        if (magic != JOURNAL_MAGIC or version != JOURNAL_VERSION
+            or not gcode_filename):
+            return None
+        best = None
+        for i in range(record_count):
+            rec = _unpack(RECORD_FORMAT, f.read(RECORD_SIZE))
+            if rec is not None and rec[0] and (best is None
+                                               or rec[0] > best[0]):
+                best = rec
+    if best is None:
+        return None
+    return {'filename': gcode_filename, 'file_size': file_size,
+            'sequence': best[0], 'time': best[1], 'file_position': best[2],
+            'line_number': best[3], 'toolhead_position': list(best[4:8]),
+            'gcode_position': list(best[8:12]), 'extruder': best[12],
+            'target_temps': list(best[13:16]),
+            'current_temps': list(best[16:19])}
@@ -9,6 +9,7 @@ class PrintStats:
         printer = config.get_printer()
         self.gcode_move = printer.load_object(config, 'gcode_move')
         self.reactor = printer.get_reactor()
+        self.status_version = 0
         self.reset()
     def _update_filament_usage(self, eventtime):
         gc_status = self.gcode_move.get_status(eventtime)
@@ -33,6 +34,7 @@ class PrintStats:
         self.last_epos = gc_status['position'].e
         self.state = "printing"
         self.error_message = ""
+        self.status_version += 1
     def note_pause(self):
         if self.last_pause_time is None:
             curtime = self.reactor.monotonic()
@@ -41,6 +43,7 @@ class PrintStats:
             self._update_filament_usage(curtime)
         if self.state != "error":
             self.state = "paused"
+        self.status_version += 1
     def note_complete(self):
         self._note_finish("complete")
     def note_error(self, message):
@@ -57,6 +60,7 @@ class PrintStats:
             self.init_duration = self.total_duration - \
                 self.prev_pause_duration
         self.print_start_time = None
+        self.status_version += 1
     def reset(self):
         self.filename = self.error_message = ""
         self.state = "standby"
@@ -64,6 +68,7 @@ class PrintStats:
         self.filament_used = self.total_duration = 0.
         self.print_start_time = self.last_pause_time = None
         self.init_duration = 0.
+        self.status_version += 1
     def get_status(self, eventtime):
         time_paused = self.prev_pause_duration
         if self.print_start_time is not None:
@@ -86,6 +91,11 @@ class PrintStats:
             'state': self.state,
             'message': self.error_message
         }
+    def get_status_version(self, eventtime):
+        if self.print_start_time is not None:
+            # The durations change on every query during a print
+            return (self.status_version, eventtime)
+        return self.status_version
 
 def load_config(config):
     return PrintStats(config)
@@ -5,10 +5,15 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import os, time, logging
 
+PROFILE_LOG_INTERVAL = 60.
+PROFILE_LOG_COUNT = 10
+
 class PrinterSysStats:
     def __init__(self, config):
         printer = config.get_printer()
+        self.reactor = printer.get_reactor()
         self.last_process_time = self.total_process_time = 0.
+        self.last_timer_latency = {}
         self.last_load_avg = 0.
         self.last_mem_avail = 0
         self.mem_file = None
@@ -29,6 +34,7 @@ class PrinterSysStats:
         if pdiff > 0.:
             self.total_process_time += pdiff
         self.last_load_avg = os.getloadavg()[0]
+        self.last_timer_latency = self.reactor.get_timer_latency()
         msg = "sysload=%.2f cputime=%.3f" % (self.last_load_avg,
                                              self.total_process_time)
         # Get available system memory
@@ -47,27 +53,69 @@ class PrinterSysStats:
     def get_status(self, eventtime):
         return {'sysload': self.last_load_avg,
                 'cputime': self.total_process_time,
-                'memavail': self.last_mem_avail}
+                'memavail': self.last_mem_avail,
+                'timer_latency': self.last_timer_latency}
 
 class PrinterStats:
     def __init__(self, config):
         self.printer = config.get_printer()
         reactor = self.printer.get_reactor()
         self.stats_timer = reactor.register_timer(self.generate_stats)
+        self.profile_timer = reactor.register_timer(self.log_profile)
         self.stats_cb = []
         self.printer.register_event_handler("klippy:ready", self.handle_ready)
+        webhooks = self.printer.lookup_object('webhooks')
+        webhooks.register_endpoint("statistics/latency",
+                                   self._handle_latency)
+        webhooks.register_endpoint("statistics/profile",
+                                   self._handle_profile)
     def handle_ready(self):
         self.stats_cb = [o.stats for n, o in self.printer.lookup_objects()
                          if hasattr(o, 'stats')]
         if self.printer.get_start_args().get('debugoutput') is None:
             reactor = self.printer.get_reactor()
             reactor.update_timer(self.stats_timer, reactor.NOW)
+            reactor.update_timer(self.profile_timer,
+                                 reactor.monotonic() + PROFILE_LOG_INTERVAL)
     def generate_stats(self, eventtime):
         stats = [cb(eventtime) for cb in self.stats_cb]
         if max([s[0] for s in stats]):
             logging.info("Stats %.1f: %s", eventtime,
                          ' '.join([s[1] for s in stats]))
         return eventtime + 1.
+    def log_profile(self, eventtime):
+        profile = self.printer.get_reactor().get_profile()
+        if profile is None:
+            return eventtime + PROFILE_LOG_INTERVAL
+        callbacks = sorted(profile['callbacks'].items(),
+                           key=(lambda i: i[1]['cpu_time']), reverse=True)
+        out = ["Reactor profile %.1f: duration=%.1f greenlet_switches=%d"
+               % (eventtime, profile['duration'],
+                  profile['greenlet_switches'])]
+        for name, s in callbacks[:PROFILE_LOG_COUNT]:
+            out.append("  %s: count=%d cpu=%.3f wall=%.3f max_wall=%.6f"
+                       " max_latency=%.6f"
+                       % (name, s['count'], s['cpu_time'], s['wall_time'],
+                          s['max_wall_time'], s['max_latency']))
+        logging.info("\n".join(out))
+        return eventtime + PROFILE_LOG_INTERVAL
+    def _handle_latency(self, web_request):
+        reactor = self.printer.get_reactor()
+        mcus = {n: m.get_latency_stats()
+                for n, m in self.printer.lookup_objects(module='mcu')}
+        web_request.send({'timer_latency': reactor.get_timer_latency(),
+                          'mcu': mcus})
+    def _handle_profile(self, web_request):
+        reactor = self.printer.get_reactor()
+        enable = web_request.get('enable', None, types=(bool,))
+        if enable is not None:
+            reactor.set_profiling(enable)
+        profile = reactor.get_profile()
+        if profile is None:
+            web_request.send({'enabled': False})
+            return
+        profile['enabled'] = True
+        web_request.send(profile)
 
 def load_config(config):
     config.get_printer().add_object('system_stats', PrinterSysStats(config))
@@ -6,15 +6,93 @@
 # from genericpath import exists
 # from importlib.resources import path
 # -*- coding: utf-8 -*-
-from datetime import datetime
 import math
-import os, logging
-import json
+import os, logging, threading, collections
 import time
 from setuptools import Command
+from . import powerloss_journal, gcode_index
 
 VALID_GCODE_EXTS = ['gcode', 'GCODE', 'g', 'gco']
 POWERLOSS_FILE_NAME = "/opt/Raise3D/gcode-cache/klipper-print.powerloss"
+POWERLOSS_JOURNAL_NAME = POWERLOSS_FILE_NAME + ".journal"
+POWERLOSS_RECORD_TIME = 0.100
+
+READ_AHEAD_CHUNK_SIZE = 8192
+READ_AHEAD_CHUNKS = 64
+
+# Helper thread that reads and splits the print file ahead of the
+# reactor so that slow storage does not stall timers and the move queue
+class GCodeReadAhead:
+    def __init__(self, reactor, filename, position):
+        self.reactor = reactor
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        # Ring of pre-split line chunks (accessed from background thread)
+        self.chunks = collections.deque()
+        self.is_eof = self.is_stopped = False
+        self.error = None
+        self.completion = None
+        self.file = open(filename, 'rb')
+        self.file.seek(position)
+        self.bg_thread = threading.Thread(target=self._bg_thread)
+        self.bg_thread.daemon = True
+        self.bg_thread.start()
+    def _bg_thread(self):
+        partial_input = ""
+        try:
+            while 1:
+                with self.lock:
+                    while (len(self.chunks) >= READ_AHEAD_CHUNKS
+                           and not self.is_stopped):
+                        self.cond.wait()
+                    if self.is_stopped:
+                        break
+                data = self.file.read(READ_AHEAD_CHUNK_SIZE)
+                if not data:
+                    # End of file (an unterminated last line is ignored)
+                    with self.lock:
+                        self.is_eof = True
+                        self._notify()
+                    break
+                lines = data.split('\n')
+                lines[0] = partial_input + lines[0]
+                partial_input = lines.pop()
+                if not lines:
+                    continue
+                with self.lock:
+                    self.chunks.append(lines)
+                    self._notify()
+        except Exception as e:
+            logging.exception("virtual_sdcard read ahead")
+            with self.lock:
+                self.error = e
+                self._notify()
+        self.file.close()
+    def _notify(self):
+        # Wake the reactor greenlet waiting in get_lines() (lock held)
+        completion = self.completion
+        if completion is not None:
+            self.completion = None
+            self.reactor.async_complete(completion, None)
+    def get_lines(self):
+        # Return the next chunk of lines or None at EOF
+        while 1:
+            with self.lock:
+                if self.chunks:
+                    lines = self.chunks.popleft()
+                    self.cond.notify()
+                    return lines
+                if self.error is not None:
+                    raise self.error
+                if self.is_eof:
+                    return None
+                completion = self.completion = self.reactor.completion()
+            completion.wait()
+    def stop(self):
+        with self.lock:
+            self.is_stopped = True
+            self.chunks.clear()
+            self.cond.notify()
 
 class VirtualSD:
     def __init__(self, config):
@@ -36,6 +114,11 @@ class VirtualSD:
         self.must_pause_work = self.cmd_from_sd = False
         self.next_file_position = 0
         self.work_timer = None
+        self.read_ahead = None
+        # Line/layer index of the current file (built in the background)
+        self.indexer = gcode_index.GCodeIndexer(self.reactor)
+        self.file_index = None
+        self.pending_lineno_offset = None
         # Register commands
         self.gcode = printer.lookup_object('gcode')
         for cmd in ['M20', 'M21', 'M23', 'M24', 'M25', 'M26', 'M27', 'M32', 'M38', 'M39']:
@@ -52,12 +135,22 @@ class VirtualSD:
         # printer.register_event_handler("filament:out", self.filament_out_event)
         printer.register_event_handler("ghead:hotend", self.hotend_handle)
         self.printed_pos_z = 0
-        self.powerloss_record_time = datetime.now()
+        self.powerloss_record_time = 0.
         self.is_recover_print = False
-        self.record = {'MODIFYTIME':time.time(), 'SEEKPOSITION':0}
         self.is_start_move = False
         self.powerloss_file_list = [POWERLOSS_FILE_NAME+".0", POWERLOSS_FILE_NAME+".1", POWERLOSS_FILE_NAME+".2", POWERLOSS_FILE_NAME+".3", POWERLOSS_FILE_NAME+".4"]
-        self.powerloss_file_index = 0
+        # Power-loss journal (written from a background thread)
+        self.powerloss_journal_name = config.get('powerloss_journal',
+                                                 POWERLOSS_JOURNAL_NAME)
+        fsync_modes = {m: m for m in powerloss_journal.FSYNC_MODES}
+        self.powerloss_journal = powerloss_journal.PowerLossJournal(
+            self.powerloss_journal_name,
+            config.getint('powerloss_records', 64, minval=2),
+            config.getchoice('powerloss_fsync', fsync_modes, 'interval'),
+            config.getfloat('powerloss_fsync_interval', 1., above=0.),
+            self.powerloss_file_list)
+        printer.register_event_handler("klippy:disconnect",
+                                       self.powerloss_journal.stop)
     
     def hotend_handle(self, hotend_ptr, val):
         toolhead = self.printer.lookup_object('toolhead')
@@ -150,13 +243,24 @@ class VirtualSD:
                 raise self.gcode.error("Unable to get file list")
     
     def get_status(self, eventtime):
-        return {
+        status = {
             'file_path': self.file_path(),
             'progress': self.progress(),
             'is_active': self.is_active(),
             'file_position': self.file_position,
             'file_size': self.file_size,
+            'printed_lines': self.printed_lineno,
         }
+        index = self.file_index
+        if index is not None:
+            status['total_lines'] = index.get_printed_line_count()
+            status['layer_count'] = index.get_layer_count()
+            status['layer'] = index.get_layer_at(self.file_position)
+        return status
+    
+    def get_status_version(self, eventtime):
+        return (self.current_file, self.file_position, self.file_size,
+                self.printed_lineno, self.work_timer, self.file_index)
     
     def file_path(self):
         if self.current_file:
@@ -180,7 +284,7 @@ class VirtualSD:
                 self.gcode._respond_warning(str(pause_reason))
             while self.work_timer is not None and not self.cmd_from_sd:
                 self.reactor.pause(self.reactor.monotonic() + .001)
-                self.powerloss_record_time = datetime.now()
+                self.powerloss_record_time = self.reactor.monotonic()
     
     def do_resume(self, reason=None):
         if self.work_timer is not None:
@@ -189,9 +293,10 @@ class VirtualSD:
         if reason != None:
             self.gcode.respond_raw(str(reason))
         self.printer.send_event("virtul_sd:status",True)
+        self._start_journal()
         self.work_timer = self.reactor.register_timer(
             self.work_handler, self.reactor.NOW)
-        self.powerloss_record_time = datetime.now()
+        self.powerloss_record_time = self.reactor.monotonic()
     
     def do_recover(self, reason=None):
         if self.work_timer is not None:
@@ -199,9 +304,10 @@ class VirtualSD:
         self.must_pause_work = False
         if reason != None:
             self.gcode.respond_raw(str(reason))
+        self._start_journal()
         self.work_timer = self.reactor.register_timer(
             self.work_handler, self.reactor.NOW)
-        self.powerloss_record_time = datetime.now()
+        self.powerloss_record_time = self.reactor.monotonic()
     
     def do_cancel(self):
         if self.current_file is not None:
@@ -210,7 +316,7 @@ class VirtualSD:
             self.current_file = None
             self.print_stats.note_cancel()
         self.file_position = self.file_size = 0.
-        self.powerloss_record_time = datetime.now()
+        self.powerloss_record_time = self.reactor.monotonic()
         self.printer.send_event("virtul_sd:status",False)
     
     # G-Code commands
@@ -244,9 +350,19 @@ class VirtualSD:
             raise gcmd.error("SD busy")
         self._reset_file()
         filename = gcmd.get("FILENAME")
+        layer = gcmd.get("LAYER", None)
         if filename[0] == '/':
             filename = filename[1:]
         self._load_file(gcmd, filename, check_subdirs=True)
+        if layer is not None:
+            # Resume at the start of a layer using the file index
+            index = self.indexer.wait(self.current_file.name)
+            res = None
+            if index is not None:
+                res = index.find_layer(layer)
+            if res is None:
+                raise gcmd.error("Unable to find layer %s" % (layer,))
+            self.file_position, lineno, self.printed_lineno = res
         self.do_resume()
     
     def cmd_M20(self, gcmd):
@@ -289,17 +405,29 @@ class VirtualSD:
     def cmd_M39(self, gcmd):
         if self.work_timer is not None:
             raise gcmd.error("SD busy")
+        lineno = None
         try:
             orig = gcmd.get_commandline()
-            command_line = orig[orig.find("M39") + 4:].split()[0].strip()
+            args = orig[orig.find("M39") + 4:].split()
+            command_line = args[0].strip() if args else ""
             if '*' in command_line:
                 cmd_msg = command_line.split("*")
                 filename = str(cmd_msg[0]).strip()
                 filepos  = int(cmd_msg[1])
                 gcmd.respond_raw("file_name = %s filepos = %d"%(filename,filepos))
             else:
-                gcmd.respond_error("cmd should has pos parameter")
-                return
+                # No explicit position - use the power-loss journal
+                record = powerloss_journal.read_journal(
+                    self.powerloss_journal_name)
+                if record is None or (command_line
+                                      and record['filename'] != command_line):
+                    gcmd.respond_error("cmd should has pos parameter")
+                    return
+                filename = record['filename']
+                filepos = record['file_position']
+                lineno = record['line_number']
+                gcmd.respond_raw("file_name = %s filepos = %d line = %d"
+                                 % (filename, filepos, lineno))
         except:
             raise gcmd.error("Unable to extract filename")
             # check if the file is exist
@@ -313,11 +441,13 @@ class VirtualSD:
         self.print_progress = 0
         self.sdcard_dirname = os.path.normpath(files[0])
         self._load_file(gcmd, files[1], check_subdirs=True)
-        if '*' in command_line:
-            #self.file_position = int(command_line[command_line.find('*') + 1:].strip())
-            self.file_position = filepos
-            # gcmd.respond_raw("get recover print %s %d" %(filename, self.file_position,))
-            # return
+        self.file_position = filepos
+        if lineno is not None:
+            self.printed_lineno = lineno
+        else:
+            # Line count is determined once the file index is ready
+            self.printed_lineno = 0
+            self.pending_lineno_offset = filepos
         try:
             self.current_file.seek(self.file_position)
         except:
@@ -354,35 +484,50 @@ class VirtualSD:
         self.printed_lineno = 0
         self.sdcard_dirname = os.path.normpath(files[0])
         self._load_file(gcmd, files[1], check_subdirs=True)
-        self.start_record(filename,self.file_size)
         gcmd.respond_raw("start print")
         self.is_start_move = False
         self.do_resume()
     
     def start_record(self,file_name,file_size):
-        self.powerloss_file_index = 0
-        self.record["MODIFYTIME"] = time.time()
-        for powerloss_file in self.powerloss_file_list:
-            with open(powerloss_file, "w") as json_file:
-                json.dump(self.record, json_file)
+        self.powerloss_journal.start(file_name, file_size)
+    
+    def _start_journal(self):
+        # Every SD print (however it was started) is journaled - a print
+        # from the start of the file begins a new journal, while one that
+        # continues mid-file keeps a journal already kept for that file
+        if self.current_file is None:
+            return
+        if self.file_position:
+            self.powerloss_journal.resume(self.current_file.name,
+                                          self.file_size)
+        else:
+            self.start_record(self.current_file.name, self.file_size)
     
     def record_file_position(self,position,line):
-        self.record["MODIFYTIME"] = time.time()
-        self.record["SEEKPOSITION"] = position
-        self.record["RECORD_LINE"] = line
-        powerloss_file = POWERLOSS_FILE_NAME + ".%d" %(self.powerloss_file_index)
-        with open(powerloss_file, "w") as json_file:
-            json.dump(self.record, json_file)
-
-        self.powerloss_file_index += 1
-        if self.powerloss_file_index >= len(self.powerloss_file_list) :
-            self.powerloss_file_index = 0
+        eventtime = self.reactor.monotonic()
+        toolhead = self.printer.lookup_object('toolhead')
+        gcode_move = self.printer.lookup_object('gcode_move')
+        pheaters = self.printer.lookup_object('heaters')
+        extruder_name = toolhead.get_extruder().get_name()
+        extruder = 0
+        if extruder_name.startswith('extruder') and extruder_name[8:]:
+            extruder = int(extruder_name[8:])
+        target_temps = [0., 0., 0.]
+        current_temps = [0., 0., 0.]
+        for i, name in enumerate(['extruder', 'extruder1', 'heater_bed']):
+            heater = pheaters.lookup_heater(name)
+            if heater is not None:
+                current_temps[i], target_temps[i] = heater.get_temp(eventtime)
+        self.powerloss_journal.note_position({
+            'time': time.time(), 'file_position': position,
+            'line_number': self.printed_lineno, 'line': line,
+            'toolhead_position': toolhead.get_position(),
+            'gcode_position': list(gcode_move.last_position),
+            'extruder': extruder, 'target_temps': target_temps,
+            'current_temps': current_temps})
     
     def complete_record(self):
-        if os.path.exists(POWERLOSS_FILE_NAME):
-            deleteCommand = "rm -rf " + POWERLOSS_FILE_NAME
-            os.system(deleteCommand)
-        pass
+        self.powerloss_journal.complete()
     
     def cmd_M21(self, gcmd):
         # Initialize SD card
@@ -405,15 +550,23 @@ class VirtualSD:
         self._load_file(gcmd, filename)
     
     def _get_file_notes_size(self, filename):
-        f = open(filename, 'rb')
-        line = f.readline()
-        note_size = 0
-        while line:
-            if line.startswith(';'):
-                note_size += len(line)
-            line = f.readline()
-        f.close()
-        return note_size
+        index = self.indexer.wait(filename)
+        if index is None:
+            return 0
+        return index.get_comment_bytes()
+    
+    def _handle_file_index(self, index):
+        if (index is None or self.current_file is None
+            or self.current_file.name != index.filename):
+            return
+        self.file_index = index
+        if self.pending_lineno_offset is not None:
+            offset = self.pending_lineno_offset
+            self.pending_lineno_offset = None
+            try:
+                self.printed_lineno += index.find_line(offset)[1]
+            except:
+                logging.exception("virtual_sdcard index line lookup")
     
     def _load_file(self, gcmd, filename, check_subdirs=False):
         files = self.get_file_list(check_subdirs)
@@ -439,6 +592,9 @@ class VirtualSD:
         self.file_position = 0
         self.file_size = fsize
         self.print_stats.set_current_file(filename)
+        self.file_index = None
+        self.pending_lineno_offset = None
+        self.indexer.request(fname, self._handle_file_index)
     
     def cmd_M24(self, gcmd):
         # Start/resume SD print
@@ -476,31 +632,85 @@ class VirtualSD:
     def is_cmd_from_sd(self):
         return self.cmd_from_sd
     
+    # Per line handling of batches dispatched from work_handler
+    def _prepare_line(self, next_file_position, line):
+        if self.must_pause_work:
+            return None
+        self.cmd_from_sd = True
+        if line.startswith(";Data start"):
+            self.data_flag = True
+        elif line.startswith(";Data end"):
+            self.data_flag = False
+        self.next_file_position = next_file_position
+        if self.is_recover_print:
+            self.is_recover_print = False
+            self.gcode.respond_raw("recover command line %s"%line)
+        if ((not line.startswith(';') or line.startswith(";LAYER:")
+             or line.startswith("LAYER:")) and not line.startswith("M99123")):
+            self.printed_lineno += 1
+            return True
+        return False
+    
+    def _finish_line(self, next_file_position, line):
+        if not self.is_start_move and (line.startswith('G1') or line.startswith('G0')) :
+            self.gcode.respond_raw("Print move start: %s"%(line))
+            self.is_start_move = True
+        if line.startswith("M2000"):
+            self.gcode.respond_raw("Printing pause by Gcode")
+        self.cmd_from_sd = False
+        self.file_position = self.next_file_position
+        
+        # 100 ms record powerloss file
+        if self.is_start_move:
+            eventtime = self.reactor.monotonic()
+            if (eventtime >= self.powerloss_record_time
+                + POWERLOSS_RECORD_TIME or line.startswith(';Z:')):
+                self.record_file_position(self.file_position, line)
+                self.powerloss_record_time = eventtime
+        
+        # cal print progress
+        if not self.data_flag:
+            temp_print_progress = self.file_position * 1.0 / self.file_size * 100.0
+            if (math.fabs(self.print_progress - temp_print_progress) > 0.1) or (temp_print_progress >= 100.0):
+                self.print_progress = temp_print_progress
+                self.gcode.respond_raw("SD printing progress %d/%d %d" % (self.file_position, self.file_size, self.printed_lineno))
+        # Stop the batch if a command changed the file position
+        return self.next_file_position != next_file_position
+    
+    def _iter_batch(self, lines, line_pos, pos):
+        # Generate (next_file_position, line) entries from lines[line_pos:]
+        for i in xrange(line_pos, len(lines)):
+            line = lines[i]
+            pos += len(line) + 1
+            yield pos, line
+    
     # Background work timer
     def work_handler(self, eventtime):
         logging.info("Starting SD card print (position %d)", self.file_position)
         self.reactor.unregister_timer(self.work_timer)
         try:
-            self.current_file.seek(self.file_position)
+            self.read_ahead = GCodeReadAhead(
+                self.reactor, self.current_file.name, self.file_position)
         except:
             logging.exception("virtual_sdcard seek")
             self.work_timer = None
             return self.reactor.NEVER
         self.print_stats.note_start()
         gcode_mutex = self.gcode.get_mutex()
-        partial_input = ""
         lines = []
+        line_pos = 0
         error_message = None
-        data_flag = False
+        self.data_flag = False
         while not self.must_pause_work:
-            if not lines:
+            if line_pos >= len(lines):
                 # Read more data
+                line_pos = 0
                 try:
-                    data = self.current_file.read(8192)
+                    lines = self.read_ahead.get_lines()
                 except:
                     logging.exception("virtual_sdcard read")
                     break
-                if not data:
+                if lines is None:
                     # End of file
                     self.current_file.close()
                     self.current_file = None
@@ -509,70 +719,44 @@ class VirtualSD:
                     self.printer.send_event("virtul_sd:status",False)
                     self.complete_record()
                     break
-                lines = data.split('\n')
-                lines[0] = partial_input + lines[0]
-                partial_input = lines.pop()
-                lines.reverse()
                 self.reactor.pause(self.reactor.NOW)
                 continue
             # Pause if any other request is pending in the gcode class
             if gcode_mutex.test():
                 self.reactor.pause(self.reactor.monotonic() + 0.100)
                 continue
-            # Dispatch command
-            self.cmd_from_sd = True
-            line = lines.pop()
-            if line.startswith(";Data start"):
-                data_flag = True
-            if line.startswith(";Data end"):
-                data_flag = False
-            next_file_position = self.file_position + len(line) + 1
-            self.next_file_position = next_file_position
-            if self.is_recover_print:
-                self.is_recover_print = False
-                self.gcode.respond_raw("recover command line %s"%line)
+            # Dispatch a chunk of commands
+            pos = self.file_position
+            batch = self._iter_batch(lines, line_pos, pos)
             try:
-                if (not line.startswith(';') or line.startswith(";LAYER:") or line.startswith("LAYER:")) and not line.startswith("M99123"):
-                    self.printed_lineno += 1
-                    self.gcode.run_script(line) 
-                    # self.gcode.respond_raw("print line:%s"%(line))
-                if not self.is_start_move and (line.startswith('G1') or line.startswith('G0')) :
-                    self.gcode.respond_raw("Print move start: %s"%(line))
-                    self.is_start_move = True
-                if line.startswith("M2000"):
-                    self.gcode.respond_raw("Printing pause by Gcode")
-
+                count = self.gcode.run_script_batch(
+                    batch, self._prepare_line, self._finish_line)[0]
             except self.gcode.error as e:
                 logging.exception("virtual_sdcard dispatch")
                 error_message = str(e)
                 break
-            self.cmd_from_sd = False
-            self.file_position = self.next_file_position
-            
-            # 100 ms record powerloss file
-            record_timeout = (datetime.now() - self.powerloss_record_time).microseconds / 1000
-            if self.is_start_move and (record_timeout > 100 or line.startswith(';Z:')):
-                self.record_file_position(self.file_position, line)
-                self.powerloss_record_time = datetime.now()
-
-            # cal print progress
-            if not data_flag:
-                temp_print_progress = self.file_position * 1.0 / self.file_size * 100.0
-                if (math.fabs(self.print_progress - temp_print_progress) > 0.1) or (temp_print_progress >= 100.0):
-                    self.print_progress = temp_print_progress
-                    self.gcode.respond_raw("SD printing progress %d/%d %d" % (self.file_position, self.file_size, self.printed_lineno))
+            finally:
+                self.cmd_from_sd = False
+            for i in xrange(line_pos, line_pos + count):
+                pos += len(lines[i]) + 1
+            line_pos += count
             # Do we need to skip around?
-            if self.next_file_position != next_file_position:
+            if self.file_position != pos:
+                self.read_ahead.stop()
                 try:
-                    self.current_file.seek(self.file_position)
+                    self.read_ahead = GCodeReadAhead(
+                        self.reactor, self.current_file.name,
+                        self.file_position)
                 except:
                     logging.exception("virtual_sdcard seek")
+                    self.read_ahead = None
                     self.work_timer = None
                     return self.reactor.NEVER
                 lines = []
-                partial_input = ""
         
         logging.info("Exiting SD card print (position %d)", self.file_position)
+        self.read_ahead.stop()
+        self.read_ahead = None
         self.work_timer = None
         self.cmd_from_sd = False
         if error_message is not None:
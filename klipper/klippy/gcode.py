@@ -3,8 +3,15 @@
 # Copyright (C) 2016-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, re, logging, collections, shlex
+import os, re, logging, collections, shlex, errno
 
+# Responses queued for the pseudo-tty before new responses are discarded
+OUTPUT_BUFFER_SIZE = 64 * 1024
+# Minimum time between reports of frequent status messages.  Only the
+# most recent message of each class is sent.
+OUTPUT_RATE_LIMITS = [
+    ('ZMove:', .250), ('SD printing progress', 1.), ('Current layer:', .250),
+    ('Filament Sensor [^:]*:', 1.)]
 
 class CommandError(Exception):
     pass
@@ -93,6 +100,7 @@ class GCodeDispatch:
         self.ready_gcode_handlers = {}
         self.mux_commands = {}
         self.gcode_help = {}
+        self.fast_move = None
         # Register commands needed before config file is loaded
         handlers = ['M110', 'M112', 'M115', 'M291','M9999','MTEST','M',
                     'RESTART', 'FIRMWARE_RESTART', 'ECHO', 'STATUS', 'HELP']
@@ -135,6 +143,11 @@ class GCodeDispatch:
             self.base_gcode_handlers[cmd] = func
         if desc is not None:
             self.gcode_help[cmd] = desc
+    def register_fast_move(self, handler, fast_handler):
+        # Plain G0/G1 lines are parsed directly into [X, Y, Z, E, F]
+        # floats (None if not specified) and passed to fast_handler as
+        # long as 'handler' is the registered G0/G1 command handler.
+        self.fast_move = (handler, fast_handler)
     def register_mux_command(self, cmd, key, value, func, desc=None):
         prev = self.mux_commands.get(cmd)
         if prev is None:
@@ -177,8 +190,56 @@ class GCodeDispatch:
         #     print ("try to start monitor ghead")
     # Parse input into commands
     args_r = re.compile('([A-Z_]+|[A-Z*/])')
+    fast_move_r = re.compile(
+        r'\s*(?:N\d+\s+)?(G[01])((?:\s+[XYZEF][-+]?[0-9.]+)*)\s*(?:\*\d*)?$')
+    fast_move_axes = {'X': 0, 'Y': 1, 'Z': 2, 'E': 3, 'F': 4}
+    def _parse_fast_move(self, line):
+        # Parse a plain G0/G1 move (with optional line number and
+        # checksum) - returns None if the generic parser is needed
+        m = self.fast_move_r.match(line)
+        if m is None:
+            return None
+        cmd, args = m.groups()
+        if self.gcode_handlers.get(cmd) != self.fast_move[0]:
+            return None
+        coords = [None, None, None, None, None]
+        axes = self.fast_move_axes
+        try:
+            for arg in args.split():
+                coords[axes[arg[0]]] = float(arg[1:])
+        except ValueError:
+            return None
+        if coords[4] is not None and coords[4] <= 0.:
+            return None
+        return cmd, coords
+    def _handle_command_error(self, cmd, e, need_ack):
+        if e is None:
+            msg = 'Internal error on command:"%s"' % (cmd,)
+            logging.exception(msg)
+            self.printer.invoke_shutdown(msg)
+            self._respond_error(msg)
+        elif "Must home axis first" in str(e):
+            self._respond_warning(str(e))
+        else:
+            self._respond_error(str(e))
+            self.printer.send_event("gcode:command_error")
+        if not need_ack:
+            raise
     def _process_commands(self, commands, need_ack=True):
         for line in commands:
+            if self.fast_move is not None:
+                res = self._parse_fast_move(line)
+                if res is not None:
+                    cmd, coords = res
+                    try:
+                        self.fast_move[1](coords)
+                    except self.error as e:
+                        self._handle_command_error(cmd, e, need_ack)
+                    except:
+                        self._handle_command_error(cmd, None, need_ack)
+                    if need_ack:
+                        self.respond_raw("ok")
+                    continue
             # Ignore comments and leading/trailing spaces
             org_cmd = str(line).strip()
             # self.respond_raw("rec cmd = %s"%org_cmd)
@@ -242,20 +303,9 @@ class GCodeDispatch:
             try:
                 handler(gcmd)
             except self.error as e:
-                if "Must home axis first" in str(e):
-                    self._respond_warning(str(e))
-                else:
-                    self._respond_error(str(e))
-                    self.printer.send_event("gcode:command_error")
-                if not need_ack:
-                    raise
+                self._handle_command_error(cmd, e, need_ack)
             except:
-                msg = 'Internal error on command:"%s"' % (cmd,)
-                logging.exception(msg)
-                self.printer.invoke_shutdown(msg)
-                self._respond_error(msg)
-                if not need_ack:
-                    raise
+                self._handle_command_error(cmd, None, need_ack)
             gcmd.ack()
     def auto_print_background(self,gcode):
         pass
@@ -264,6 +314,31 @@ class GCodeDispatch:
     def run_script(self, script):
         with self.mutex:
             self._process_commands(script.split('\n'), need_ack=False)
+    def run_script_batch(self, batch, prepare_cb, finish_cb):
+        # Run a list of (offset, line) commands (eg, from a file) while
+        # only taking the gcode mutex once.  prepare_cb(offset, line) is
+        # invoked before each entry and returns True to dispatch the
+        # line, False to skip it, or None to stop.  finish_cb(offset,
+        # line) is invoked after each entry and may return True to stop.
+        # The batch also stops if another task is waiting on the mutex.
+        # Returns the number of entries consumed and the offset of the
+        # last executed command.
+        count = 0
+        last_offset = None
+        mutex = self.mutex
+        process_commands = self._process_commands
+        with mutex:
+            for offset, line in batch:
+                res = prepare_cb(offset, line)
+                if res is None:
+                    break
+                if res:
+                    process_commands([line], need_ack=False)
+                    last_offset = offset
+                count += 1
+                if finish_cb(offset, line) or mutex.test_waiting():
+                    break
+        return count, last_offset
     def get_mutex(self):
         return self.mutex
     def create_gcode_command(self, command, commandline, params):
@@ -533,6 +608,8 @@ class GCodeIO:
         self.reactor = self.printer.get_reactor()
         printer.register_event_handler("klippy:ready", self._handle_ready)
         printer.register_event_handler("klippy:shutdown", self._handle_shutdown)
+        printer.register_event_handler("klippy:disconnect",
+                                       self._handle_disconnect)
         self.gcode = printer.lookup_object('gcode')
         self.gcode_mutex = self.gcode.get_mutex()
         self.fd = printer.get_start_args().get("gcode_fd")
@@ -541,26 +618,39 @@ class GCodeIO:
         self.is_printer_ready = False
         self.is_processing_data = False
         self.is_fileinput = not not printer.get_start_args().get("debuginput")
-        self.pipe_is_active = True
         self.fd_handle = None
+        self.fd_wake = (True, False)
+        self.is_input_paused = False
+        # Responses are buffered and written when the pseudo-tty is writable
+        self.output_queue = []
+        self.output_size = 0
+        self.output_held = {}
+        self.output_send_times = {}
+        self.output_timer = self.reactor.register_timer(
+            self._release_held_output)
+        self.is_output_error = False
+        self.bytes_written = self.output_dropped = self.output_limited = 0
         if not self.is_fileinput:
             self.gcode.register_output_handler(self._respond_raw)
-            self.fd_handle = self.reactor.register_fd(self.fd,
-                                                      self._process_data)
+            self._register_fd()
         self.partial_input = ""
         self.pending_commands = []
         self.bytes_read = 0
         self.input_log = collections.deque([], 50)
-        self.timer_handle = self.reactor.register_timer(self.resend, self.reactor.NEVER)
-        self.msg_buff = []
-        self.msg_is_resending = False
-        self.last_msg_resend = None
-        self.resend_count = 0
     def _handle_ready(self):
         self.is_printer_ready = True
         if self.is_fileinput and self.fd_handle is None:
-            self.fd_handle = self.reactor.register_fd(self.fd,
-                                                      self._process_data)
+            self._register_fd()
+    def _register_fd(self):
+        self.fd_handle = self.reactor.register_fd(self.fd, self._process_data,
+                                                  self._flush_output)
+        self.fd_wake = (True, False)
+        self._update_fd_wake()
+    def _update_fd_wake(self):
+        fd_wake = (not self.is_input_paused, not not self.output_queue)
+        if fd_wake != self.fd_wake and self.fd_handle is not None:
+            self.fd_wake = fd_wake
+            self.reactor.set_fd_wake(self.fd_handle, *fd_wake)
     def _dump_debug(self):
         out = []
         out.append("Dumping gcode input %d blocks" % (len(self.input_log),))
@@ -574,6 +664,10 @@ class GCodeIO:
         self._dump_debug()
         if self.is_fileinput:
             self.printer.request_exit('error_exit')
+    def _handle_disconnect(self):
+        # Make a final attempt to send any pending responses
+        if self.output_queue:
+            self._flush_output(self.reactor.monotonic())
     m112_r = re.compile('^(?:[nN][0-9]+)?\s*[mM]112(?:\s|$)')
     def _process_data(self, eventtime):
         # Read input, separate by newline, and add to pending_commands
@@ -593,7 +687,6 @@ class GCodeIO:
         # print ('pending_commands----->',pending_commands)
         pending_commands.extend(lines)
         # print ("pending_commands -->",pending_commands)
-        self.pipe_is_active = True
         # Special handling for debug file input EOF
         if not data and self.is_fileinput:
             if not self.is_processing_data:
@@ -611,8 +704,8 @@ class GCodeIO:
             if self.is_processing_data:
                 if len(pending_commands) >= 20:
                     # Stop reading input
-                    self.reactor.unregister_fd(self.fd_handle)
-                    self.fd_handle = None
+                    self.is_input_paused = True
+                    self._update_fd_wake()
                 return
         # Process commands
         self.is_processing_data = True
@@ -622,45 +715,84 @@ class GCodeIO:
                 self.gcode._process_commands(pending_commands)
             pending_commands = self.pending_commands
         self.is_processing_data = False
+        self.is_input_paused = False
         if self.fd_handle is None:
-            self.fd_handle = self.reactor.register_fd(self.fd,
-                                                      self._process_data)
-    def resend(self,eventtime):
-        logging.exception("try to resend..")
-        if len(self.msg_buff) > 0:
-            msg = self.msg_buff[0]
-            if self.last_msg_resend == msg:
-                self.resend_count = self.resend_count + 1
-                if self.resend_count >= 2:
-                    self.resend_count = 0
-                    self.pipe_is_active = True
-            else:
-                self.last_msg_resend = msg
-                self.resend_count = 0
-            res = self._respond_raw(msg)
-            if res != 'ok':
-                return eventtime + 0.05
-            elif res == 'ok':
-                del self.msg_buff[0]
-                if len(self.msg_buff) > 0:
-                    return eventtime + 0.05
-                else:
-                    self.resend_count = 0
-                    self.msg_is_resending = False
-                    return self.reactor.NEVER
+            self._register_fd()
         else:
-            logging.exception("no msg to been resent..")
-            return self.reactor.NEVER
-        pass
+            self._update_fd_wake()
+    # Response output
+    output_rate_limits = [(re.compile(r), interval)
+                          for r, interval in OUTPUT_RATE_LIMITS]
     def _respond_raw(self, msg):
-        if self.pipe_is_active:
-            try:
-                os.write(self.fd, msg+"\n")
-            except os.error:
-                logging.exception("Write g-code response [%s]" % (msg))
-                self.pipe_is_active = False
+        for regex, interval in self.output_rate_limits:
+            m = regex.match(msg)
+            if m is None:
+                continue
+            key = m.group(0)
+            eventtime = self.reactor.monotonic()
+            waketime = self.output_send_times.get(key, 0.) + interval
+            if eventtime >= waketime:
+                self.output_send_times[key] = eventtime
+                # This message supersedes any held (older) message
+                if self.output_held.pop(key, None) is not None:
+                    self.output_limited += 1
+                break
+            # Hold the message back (replacing any earlier held message)
+            if key in self.output_held:
+                self.output_limited += 1
+            self.output_held[key] = (msg, waketime)
+            if waketime < self.output_timer.waketime:
+                self.reactor.update_timer(self.output_timer, waketime)
+            return 'ok'
+        self._queue_output(msg)
+        return 'ok'
+    def _release_held_output(self, eventtime):
+        next_waketime = self.reactor.NEVER
+        for key, (msg, waketime) in list(self.output_held.items()):
+            if waketime > eventtime:
+                next_waketime = min(next_waketime, waketime)
+                continue
+            del self.output_held[key]
+            self.output_send_times[key] = eventtime
+            self._queue_output(msg)
+        return next_waketime
+    def _queue_output(self, msg):
+        msg += "\n"
+        if self.output_size + len(msg) > OUTPUT_BUFFER_SIZE:
+            # Reader is not keeping up - discard the response
+            self.output_dropped += 1
+            return
+        self.output_queue.append(msg)
+        self.output_size += len(msg)
+        self._update_fd_wake()
+    def _flush_output(self, eventtime):
+        # Coalesce queued responses into a single write
+        data = "".join(self.output_queue)
+        try:
+            count = os.write(self.fd, data)
+        except os.error as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                self.output_queue = [data]
+                return
+            if not self.is_output_error:
+                logging.warning("Write g-code response failed: %s", e)
+                self.is_output_error = True
+            self.output_dropped += len(self.output_queue)
+            count = len(data)
+        else:
+            self.is_output_error = False
+            self.bytes_written += count
+        self.output_size -= count
+        if count < len(data):
+            self.output_queue = [data[count:]]
+        else:
+            self.output_queue = []
+        self._update_fd_wake()
     def stats(self, eventtime):
-        return False, "gcodein=%d" % (self.bytes_read,)
+        return False, "gcodein=%d gcodeout=%d gcodeout_dropped=%d" \
+            " gcodeout_limited=%d" % (
+                self.bytes_read, self.bytes_written, self.output_dropped,
+                self.output_limited)
 
 def add_early_printer_objects(printer):
     printer.add_object('gcode', GCodeDispatch(printer))
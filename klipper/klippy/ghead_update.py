@@ -0,0 +1,168 @@
+# Tool head (ghead) firmware transfer with a sliding acknowledgement window
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import logging
+
+PACKET_SIZE = 32
+BLOCK_SIZE = 256
+BLOCK_PACKETS = BLOCK_SIZE // PACKET_SIZE
+RETRANSMIT_TIME = .250
+MAX_RETRANSMITS = 8
+DUPLICATE_REQUESTS = 3
+
+# Load a firmware image padded with zeros to a multiple of 'unit_len'
+def load_image(filename, unit_len):
+    f = open(filename, 'rb')
+    data = f.read()
+    f.close()
+    size = len(data)
+    padded = ((size + unit_len - 1) // unit_len) * unit_len
+    image = bytearray(padded)
+    image[:size] = data
+    return image
+
+# The tool head addresses a packet by its 256 byte block ("main"
+# pointer) and the packet within that block ("sub" pointer).  A 'ZH'
+# request value is (main_ptr << 8) | sub_ptr.
+def request_index(val):
+    main_ptr = (val >> 8) & 0xffff
+    sub_ptr = val & 0xff
+    return main_ptr * BLOCK_PACKETS + sub_ptr
+
+# Return the (main_ptr, sub_ptr) address of a packet index
+def packet_address(index):
+    return divmod(index, BLOCK_PACKETS)
+
+# The tool head requests firmware packets by index (a 'ZH' response
+# from the move board, converted with request_index()).  A request for
+# packet N acknowledges all packets before N, and a request for an
+# already transmitted packet is a request to retransmit only that
+# packet (once it has been requested repeatedly, as later packets in
+# flight may simply not have been received yet).  Up to 'window'
+# packets are sent ahead of the last acknowledged packet.  A request
+# for packet 'packet_count' acknowledges the whole image.  The packets
+# sent in response to an event are passed to 'send_packets' together
+# as a list of (index, data) tuples.
+class FirmwareTransfer:
+    def __init__(self, reactor, image, send_packets, window=1,
+                 packet_size=PACKET_SIZE, finish_cb=None):
+        self.reactor = reactor
+        self.image = memoryview(image)
+        self.send_packets = send_packets
+        self.pending_packets = []
+        self.finish_cb = finish_cb
+        self.window = max(1, window)
+        self.duplicate_limit = max(1, min(DUPLICATE_REQUESTS, window - 1))
+        self.packet_size = packet_size
+        self.packet_count = len(image) // packet_size
+        self.timer = None
+        # Transfer state
+        self.state = "idle"
+        self.acked = self.next_packet = 0
+        self.last_request = -1
+        self.duplicate_requests = 0
+        self.send_times = {}
+        self.retransmits = {}
+        # Statistics
+        self.start_time = self.end_time = 0.
+        self.packets_sent = self.packets_resent = self.timeouts = 0
+        self.bytes_sent = 0
+    def get_packet(self, index):
+        pos = index * self.packet_size
+        return self.image[pos:pos + self.packet_size]
+    def _send(self, index, eventtime):
+        if index in self.send_times:
+            count = self.retransmits.get(index, 0) + 1
+            if count > MAX_RETRANSMITS:
+                # A tool head that does not request past the last
+                # packet can not confirm the end of the image
+                state = "failed"
+                if self.next_packet >= self.packet_count:
+                    state = "sent"
+                self._finish(state, eventtime)
+                return
+            self.retransmits[index] = count
+            self.packets_resent += 1
+        data = self.get_packet(index)
+        self.pending_packets.append((index, data))
+        self.send_times[index] = eventtime
+        self.packets_sent += 1
+        self.bytes_sent += len(data)
+    def _fill_window(self, eventtime):
+        limit = min(self.acked + self.window, self.packet_count)
+        while self.next_packet < limit and self.state == "active":
+            self._send(self.next_packet, eventtime)
+            self.next_packet += 1
+    def _flush_packets(self):
+        if self.pending_packets:
+            packets = self.pending_packets
+            self.pending_packets = []
+            self.send_packets(packets)
+    def _finish(self, state, eventtime):
+        self._flush_packets()
+        self.state = state
+        self.end_time = eventtime
+        if self.timer is not None:
+            self.reactor.unregister_timer(self.timer)
+            self.timer = None
+        stats = self.get_stats(eventtime)
+        logging.info("ghead firmware transfer %s: %s", state, stats)
+        if self.finish_cb is not None:
+            self.finish_cb(stats)
+    def handle_request(self, index, eventtime):
+        if self.state == "idle":
+            self.state = "active"
+            self.start_time = eventtime
+            self.timer = self.reactor.register_timer(
+                self._retransmit_event, eventtime + RETRANSMIT_TIME)
+        elif self.state != "active":
+            return
+        # Everything before the requested packet has been received
+        for i in range(self.acked, min(index, self.next_packet)):
+            self.send_times.pop(i, None)
+        self.acked = max(self.acked, index)
+        if index >= self.packet_count:
+            self._finish("complete", eventtime)
+            return
+        if index == self.last_request:
+            self.duplicate_requests += 1
+        else:
+            self.last_request = index
+            self.duplicate_requests = 0
+        if index < self.next_packet:
+            if (index not in self.send_times
+                or self.duplicate_requests >= self.duplicate_limit):
+                # Packet was lost - selectively retransmit it
+                self.duplicate_requests = 0
+                self._send(index, eventtime)
+        else:
+            self.next_packet = index
+        self._fill_window(eventtime)
+        self._flush_packets()
+    def _retransmit_event(self, eventtime):
+        # Resend packets not acknowledged within RETRANSMIT_TIME
+        for index, send_time in sorted(self.send_times.items()):
+            if self.state != "active":
+                return self.reactor.NEVER
+            if (index >= self.acked
+                and eventtime >= send_time + RETRANSMIT_TIME):
+                self.timeouts += 1
+                self._send(index, eventtime)
+        self._flush_packets()
+        if self.state != "active":
+            return self.reactor.NEVER
+        return eventtime + RETRANSMIT_TIME
+    def get_stats(self, eventtime):
+        end_time = self.end_time
+        if self.state in ("idle", "active"):
+            end_time = eventtime
+        elapsed = max(0., end_time - self.start_time)
+        throughput = 0.
+        if elapsed > 0.:
+            throughput = self.acked * self.packet_size / elapsed
+        return {
+            'state': self.state, 'packets': self.packet_count,
+            'acked': self.acked, 'sent': self.packets_sent,
+            'retransmits': self.packets_resent, 'timeouts': self.timeouts,
+            'bytes_sent': self.bytes_sent, 'window': self.window,
+            'elapsed': round(elapsed, 3), 'throughput': round(throughput, 1)}
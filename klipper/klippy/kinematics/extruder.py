@@ -60,6 +60,7 @@ class PrinterExtruder:
         ffi_main, ffi_lib = chelper.get_ffi()
         self.trapq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
         self.trapq_append = ffi_lib.trapq_append
+        self.trapq_buffer = chelper.TrapqBuffer(self.trapq)
         self.trapq_finalize_moves = ffi_lib.trapq_finalize_moves
         self.sk_extruder = ffi_main.gc(ffi_lib.extruder_stepper_alloc(),
                                        ffi_lib.free)
@@ -253,11 +254,15 @@ class PrinterExtruder:
         if axis_r > 0. and (move.axes_d[0] or move.axes_d[1]):
             pressure_advance = self.pressure_advance
         # Queue movement (x is extruder movement, y is pressure advance)
-        self.trapq_append(self.trapq, print_time,
-                          move.accel_t, move.cruise_t, move.decel_t,
-                          move.start_pos[3], 0., 0.,
-                          1., pressure_advance, 0.,
-                          start_v, cruise_v, accel)
+        self.trapq_buffer.moves.extend((print_time,
+                                        move.accel_t, move.cruise_t,
+                                        move.decel_t,
+                                        move.start_pos[3], 0., 0.,
+                                        1., pressure_advance, 0.,
+                                        start_v, cruise_v, accel))
+    def flush_moves(self):
+        # Add moves queued by move() to the trapq
+        self.trapq_buffer.flush()
     def find_past_position(self, print_time):
         mcu_pos = self.stepper.get_past_mcu_position(print_time)
         return self.stepper.mcu_to_commanded_position(mcu_pos)
@@ -399,6 +404,8 @@ class DummyExtruder:
         return 0.
     def calc_junction(self, prev_move, move):
         return move.max_cruise_v2
+    def flush_moves(self):
+        pass
     def get_name(self):
         return ""
     def get_heater(self):
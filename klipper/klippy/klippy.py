@@ -308,6 +308,8 @@ def main():
                     help="api server unix domain socket filename")
     opts.add_option("-l", "--logfile", dest="logfile",
                     help="write log to file instead of stderr")
+    opts.add_option("-e", "--eventlog", dest="eventlog",
+                    help="also write a binary event log to the given file")
     opts.add_option("-v", action="store_true", dest="verbose",
                     help="enable debug messages")
     opts.add_option("-o", "--debugoutput", dest="debugoutput",
@@ -315,6 +317,8 @@ def main():
     opts.add_option("-d", "--dictionary", dest="dictionary", type="string",
                     action="callback", callback=arg_dictionary,
                     help="file to read for mcu protocol dictionary")
+    opts.add_option("-p", "--profile", action="store_true", dest="profile",
+                    help="record the time used by each reactor callback")
     options, args = opts.parse_args()
     if len(args) != 1:
         opts.error("Incorrect number of arguments")
@@ -336,7 +340,8 @@ def main():
     bglogger = None
     if options.logfile:
         start_args['log_file'] = options.logfile
-        bglogger = queuelogger.setup_bg_logging(options.logfile, debuglevel)
+        bglogger = queuelogger.setup_bg_logging(options.logfile, debuglevel,
+                                                options.eventlog)
     else:
         logging.basicConfig(level=debuglevel)
     logging.info("Starting Klippy...")
@@ -360,6 +365,7 @@ def main():
             bglogger.set_rollover_info('versions', versions)
         gc.collect()
         main_reactor = reactor.Reactor(gc_checking=True)
+        main_reactor.set_profiling(options.profile)
         printer = Printer(main_reactor, bglogger, start_args)
         res = printer.run()
         if res in ['exit', 'error_exit']:
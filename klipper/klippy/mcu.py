@@ -4,9 +4,9 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 from operator import mod
-import sys, os, zlib, logging, math ,re
+import sys, os, zlib, logging, math ,re, threading
 from klippy import Printer
-import serialhdl, msgproto, pins, chelper, clocksync
+import serialhdl, msgproto, pins, chelper, clocksync, ghead_update
 import time
 import csv
 import binascii
@@ -401,13 +401,173 @@ MAX_TOOL_NUM = 2
 GHEAD_ISP_MODE = 0
 GHEAD_APP_MODE = 1
 UPDATE_SIZE_PERPACKAGE = 256
+GHEAD_UPDATE_WINDOW = 1
+PROBE_POLL_TIME = .100
+GHEAD_TIMEOUT_MSGS = {
+    "caculate_start_response": "no response when try to start caculate",
+    "messure_start_response": "no response when try to start messure",
+    "messure_stop_response": "no response when try to stop messure",
+}
 RECORD_GHEAD_MSG = 1
 GHEAD_FIRMWARE_DIR = "/opt/Raise3D/temp/Pro3-HCB.mcufirm"
 
-class wait_event:
-    def __init__(self,reactor,handle):
+def ghead_mode(chars):
+    return sum([ord(c) for c in chars])
+
+def decode_ghead_respond(params):
+    return int(params['gh_ptr']), int(params['val'])
+
+def decode_ghead_text(params):
+    return (str(params['buff']),)
+
+def decode_ghead_line(params):
+    return (str(params['buff']).strip(),)
+
+def parse_ghead_line(words):
+    return {w[0]: w[1:].strip() for w in words if w}
+
+# Route ghead messages to handlers using per-message mode tables
+class GheadRouter:
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.tables = {}
+        self.counters = {}
+        self.unhandled = 0
+        self.lock = threading.Lock()
+        self.deferred = []
+    def register(self, table, chars, handler, decoder=None, defer=False):
+        # Handlers with gcode side effects should use defer=True so
+        # that they run from the reactor instead of the serial thread
+        mode = label = None
+        if chars is not None:
+            mode = ghead_mode(chars)
+            label = "%s_%s" % (table, chars)
+        else:
+            label = table
+        routes = self.tables.setdefault(table, {})
+        routes[mode] = (label, handler, decoder, defer)
+        self.counters.setdefault(label, [0, 0.])
+    def dispatch(self, table, mode, params):
+        routes = self.tables.get(table)
+        if routes is None:
+            self.unhandled += 1
+            return
+        route = routes.get(mode)
+        if route is None:
+            route = routes.get(None)
+            if route is None:
+                self.unhandled += 1
+                return
+        label, handler, decoder, defer = route
+        if decoder is None:
+            args = (params,)
+        else:
+            args = decoder(params)
+        if not defer:
+            self._run(label, handler, args)
+            return
+        with self.lock:
+            self.deferred.append((label, handler, args))
+            if len(self.deferred) > 1:
+                return
+        self.reactor.register_async_callback(self._run_deferred)
+    def _run(self, label, handler, args):
+        starttime = self.reactor.monotonic()
+        handler(*args)
+        counter = self.counters[label]
+        counter[0] += 1
+        counter[1] += self.reactor.monotonic() - starttime
+    def _run_deferred(self, eventtime):
+        with self.lock:
+            deferred = self.deferred
+            self.deferred = []
+        for label, handler, args in deferred:
+            try:
+                self._run(label, handler, args)
+            except:
+                logging.exception("ghead: Exception in %s handler", label)
+    def get_status(self, eventtime):
+        return {
+            'messages': {l: c[0] for l, c in self.counters.items()},
+            'handler_time': {l: round(c[1], 6)
+                             for l, c in self.counters.items()},
+            'unhandled': self.unhandled, 'deferred': len(self.deferred)}
+
+# An outstanding ghead command awaiting a response
+class GheadRequest:
+    def __init__(self, tracker, key, send, timeout, retries, timeout_msg):
+        self.tracker = tracker
+        self.key = key
+        self.send = send
+        self.timeout = timeout
+        self.retries = retries
+        self.timeout_msg = timeout_msg
+        self.deadline = tracker.reactor.NEVER
+        self.completion = tracker.reactor.completion()
+    def test(self):
+        return self.completion.test()
+    def wait(self, waketime=None):
+        if waketime is None:
+            waketime = self.tracker.reactor.NEVER
+        return self.completion.wait(waketime)
+
+# Track outstanding ghead commands, each with its own deadline and
+# retry policy.  A request completes with the response result, or with
+# None once its retries are exhausted.
+class GheadRequestTracker:
+    def __init__(self, reactor, timeout_cb=None):
+        self.reactor = reactor
+        self.timeout_cb = timeout_cb
+        self.requests = {}
+        self.timer = reactor.register_timer(self._check_deadlines)
+        # Statistics
+        self.completed = self.retried = self.timed_out = 0
+    def start(self, key, send, timeout=1., retries=3, timeout_msg=None,
+              send_now=True):
+        old = self.requests.pop(key, None)
+        if old is not None:
+            old.completion.complete(None)
+        req = GheadRequest(self, key, send, timeout, retries, timeout_msg)
+        self.requests[key] = req
+        if send_now:
+            send()
+        req.deadline = self.reactor.monotonic() + timeout
+        self.reactor.update_timer(self.timer, min(
+            [r.deadline for r in self.requests.values()]))
+        return req
+    def complete(self, key, result=True):
+        req = self.requests.pop(key, None)
+        if req is None:
+            return False
+        self.completed += 1
+        req.completion.complete(result)
+        return True
+    def cancel_all(self):
+        requests = self.requests
+        self.requests = {}
+        for req in requests.values():
+            req.completion.complete(None)
+    def _check_deadlines(self, eventtime):
+        next_deadline = self.reactor.NEVER
+        for key, req in list(self.requests.items()):
+            if eventtime >= req.deadline:
+                if req.retries <= 0:
+                    del self.requests[key]
+                    self.timed_out += 1
+                    if req.timeout_msg is not None and self.timeout_cb:
+                        self.timeout_cb(req.timeout_msg)
+                    req.completion.complete(None)
+                    continue
+                req.retries -= 1
+                self.retried += 1
+                req.send()
+                req.deadline = eventtime + req.timeout
+            next_deadline = min(next_deadline, req.deadline)
+        return next_deadline
+    def get_status(self, eventtime):
+        return {'outstanding': len(self.requests), 'completed': self.completed,
+                'retried': self.retried, 'timed_out': self.timed_out}
 
-        pass
 class MCU_ghead:
     def __init__(self,mcu,ptr,printer,reactor = None):
         self.reactor = reactor
@@ -423,6 +583,7 @@ class MCU_ghead:
         self.start_ghead_moitor = None
         self.set_heater_s = None
         self.handletempcallback = {}
+        self.sample_callbacks = []
         self.printer = printer
         self.gcode = None
         self.endstop = None
@@ -432,23 +593,18 @@ class MCU_ghead:
         self.raw_dat_ptr = 0
         self.psd_num = 0.
         self.firmware_dir = GHEAD_FIRMWARE_DIR
-        self.wait_event_timer = self.reactor.register_timer(
-                self.wait_event_timeout_handle, self.reactor.NEVER)
         self.left_location_shake_timer = self.reactor.register_timer(
                 self.left_location_handle, self.reactor.NEVER)
         self.right_location_shake_timer = self.reactor.register_timer(
                 self.right_location_handle, self.reactor.NEVER)
-        self.wait_event = "idle"
-        self.wait_val = 0
-        self.wait_ptr = 0
-        self.wait_mode = 0
-        self.wait_response_count = 0
+        self.requests = GheadRequestTracker(self.reactor, self.nprintf)
         self.check_version = 0
         self.first_power_on = False
 
-        self.ghead_firmware_list = []
-        self.firmware_buff = []
+        self.firmware_buff = bytearray()
         self.package_n = 0
+        self.fw_transfer = None
+        self.fw_window = GHEAD_UPDATE_WINDOW
         self.package_ptr = 0
         self.errorcount = [0,0]
         self.errortemp  = [0.,0.]
@@ -458,38 +614,26 @@ class MCU_ghead:
 
         self.i2c_test_count = 0
         self.is_i2c_test    = 0
+        # Message routing
+        self.router = GheadRouter(self.reactor)
+        self.respond_table = "respond"
+        self._register_routes()
 
-    def wait_event_timeout_handle(self,eventtime):
-        if self.wait_event == "idle":
-            self.wait_response_count = 0
-            pass
-        elif self.wait_event == "caculate_start_response":
-            self.wait_response_count = self.wait_response_count + 1
-            if self.wait_response_count <= 3:
-                self.set_normal_ghead_ctrl(ord('P')+ord('R'),0,self.wait_val)
-                return eventtime + 1
-            self.nprintf("no response when try to start caculate")
-            self.wait_response_count = 0
-            pass
-        elif self.wait_event == "messure_start_response":
-            self.wait_response_count = self.wait_response_count + 1
-            if self.wait_response_count <= 3:
-                self.set_normal_ghead_ctrl(self.wait_mode,self.wait_ptr,self.wait_val)
-                return eventtime + 1
-            self.nprintf("no response when try to start messure")
-            self.wait_response_count = 0
-        elif self.wait_event == "messure_stop_response":
-            self.wait_response_count = self.wait_response_count + 1
-            if self.wait_response_count <= 3:
-                self.set_normal_ghead_ctrl(self.wait_mode,self.wait_ptr,self.wait_val)
-                return eventtime + 1
-            self.nprintf("no response when try to stop messure")
-            self.wait_response_count = 0
-        return self.reactor.NEVER
     def cancel_wait_event(self):
-        self.wait_event = "idle"
+        self.requests.cancel_all()
     def set_printer_type(self,type):
         self.printer_type = type
+        self.respond_table = {"Pro3": "respond",
+                              "RMF500": "rmf_respond"}.get(type)
+    def register_sample_callback(self,cb):
+        # cb(channel, gh_ptr, print_time, value) from the serial thread
+        self.sample_callbacks.append(cb)
+    def _report_sample(self,channel,params,value,readtime=None):
+        if readtime is None:
+            readclock = self._mcu.clock32_to_clock64(params['clock'])
+            readtime = self._mcu.clock_to_print_time(readclock) - COMM_DELAY_OFFSET
+        for cb in self.sample_callbacks:
+            cb(channel,params['gh_ptr'],readtime,value)
     def register_temphandle(self,ptr,fuc):
         if ptr in self.handletempcallback:
             return
@@ -693,24 +837,24 @@ class MCU_ghead:
         if endstop != None:
             pass         
     def probe_lower(self,endstop = None,wait = False):
-        self.set_normal_ghead_ctrl(ord('T'),0,0)
-        count = 5
+        send = (lambda: self.set_normal_ghead_ctrl(ord('T'),0,0))
         if wait == True and endstop == None:
             endstop = self.endstop
-        if endstop != None :
-            while True:
-                self.reactor.pause(self.reactor.monotonic()+0.5)
-                toolhead = self.printer.lookup_object('toolhead')
-                print_time = toolhead.get_last_move_time()
-                res = endstop.query_endstop(print_time)
-                if res == 1:
-                    count -=1
-                    if count > 0:
-                        self.set_normal_ghead_ctrl(ord('T'),0,0)
-                    else:
-                        return 
-                else:
-                    return 
+        if endstop == None :
+            send()
+            return
+        # Resend the command every 0.5s (up to 5 times) until the
+        # probe reports that it is no longer triggered
+        req = self.requests.start(("probe_lower",0),send,.5,4)
+        toolhead = self.printer.lookup_object('toolhead')
+        while True:
+            req.wait(self.reactor.monotonic() + PROBE_POLL_TIME)
+            if req.test():
+                return
+            print_time = toolhead.get_last_move_time()
+            if endstop.query_endstop(print_time) != 1:
+                self.requests.complete(("probe_lower",0))
+                return
     def switch_tool(self,toolnum):
         if toolnum < MAX_TOOL_NUM:
             self.set_normal_ghead_ctrl(ord('S'),0,toolnum) 
@@ -748,6 +892,7 @@ class MCU_ghead:
                     self.nprintf("new firmarename = %s"%(self.firmware_dir))
         else:
             self.nprintf("default firmarename = %s "%(self.firmware_dir))
+        self.fw_window = gcmd.get_int('W',self.fw_window,minval=1)
         if 'H' in cmdlist:
             cmd_val = int(cmdlist['H'])
             if cmd_val == 0:
@@ -796,7 +941,6 @@ class MCU_ghead:
             self.nprintf("can't find file")
             self.nprintf("M3020 S1")
             return False
-        self.ghead_firmware_list = []
         unit_len = UPDATE_SIZE_PERPACKAGE
         bsize = os.path.getsize(filename)
         if bsize == 0:
@@ -805,61 +949,44 @@ class MCU_ghead:
             return False
         self.nprintf("we have %d unit_len"%unit_len)
         remains = bsize % unit_len
-        if remains == 0:
-            package_n = bsize/unit_len
-        else:
-            package_n = bsize/unit_len + 1
+        package_n = (bsize + unit_len - 1) // unit_len
         if package_n >= 255 :
             self.nprintf("file too large!")
             self.nprintf("M3020 S2")
             return False
         self.set_normal_ghead_ctrl(ord('U') + ord('G') ,0,package_n) 
-        position_b = 0
         self.nprintf("M3020 T%d"%package_n)
         self.nprintf("filename = %s size= %d package n = %d"%(filename,bsize,package_n))
         self.nprintf("we have %d remains"%remains)
-        self.firmware_buff = []
-        with open(filename, "r") as binfile:
-            for i in range(package_n*UPDATE_SIZE_PERPACKAGE):
-                if i < bsize:
-                    data = binfile.read(1)
-                    self.firmware_buff.append(data)
-                else:
-                    self.firmware_buff.append(0)
-                # binfile.seek(position_b)
-                # if i < package_n - 1:
-                #     data = list(binfile.read(unit_len))
-                #     self.ghead_firmware_list.append(data)
-                #     position_b = position_b + unit_len
-                # elif i == (package_n - 1) and remains == 0:
-                #     data = list(binfile.read(unit_len))
-                #     self.ghead_firmware_list.append(data)
-                #     position_b = position_b + unit_len
-                # elif i == (package_n - 1) and remains > 0: 
-                #     pdata = list(binfile.read(remains))
-                #     for j in range(remains,unit_len):
-                #         pdata.append(0)
-                #     self.ghead_firmware_list.append(pdata)
-                #     position_b = position_b + unit_len
-        binfile.close()
+        self.firmware_buff = ghead_update.load_image(filename, unit_len)
         self.package_n = package_n
+        self.fw_transfer = ghead_update.FirmwareTransfer(
+            self.reactor, self.firmware_buff, self._send_firmware_packets,
+            window=self.fw_window, finish_cb=self._firmware_transfer_done)
         return True
+    def _firmware_transfer_done(self,stats):
+        self.nprintf("firmware transfer %s: %d/%d packets sent=%d"
+                     " retransmits=%d %.1f bytes/s"
+                     %(stats['state'],stats['acked'],stats['packets'],
+                       stats['sent'],stats['retransmits'],
+                       stats['throughput']))
+    def _send_firmware_packets(self,packets):
+        cmds = []
+        for index, data in packets:
+            main_ptr, sub_ptr = ghead_update.packet_address(index)
+            cmds.append((main_ptr,ord('U'),sub_ptr,data))
+        self.set_len_dat_cmd.send_batch(cmds)
 
     def debug_firmware_list(self,ptr):
         if self.package_n == 0:
             self.nprintf("firmware has not been loaded")
             return
         if ptr < self.package_n:
-            str_b = "package ptr = %d"%ptr
             start_pos = ptr*UPDATE_SIZE_PERPACKAGE
             buff = self.firmware_buff[start_pos:start_pos+32]
-            strt = ""
-            for c in buff:
-                strt = strt + str(binascii.b2a_hex(c))[2:-1] 
-            self.nprintf(strt)
+            self.nprintf(binascii.b2a_hex(bytes(buff)))
         else:
             self.nprintf("exceed range %d:%d"%(ptr,self.package_n))
-        pass
     def ghead_start(self,ptr):
         self.gcode = self.printer.lookup_object('gcode')
         self.gcode.register_command('M5100',self.ctrl_ghead,desc = None)
@@ -896,15 +1023,15 @@ class MCU_ghead:
             self.fan_speed['left']=0
             self.fan_speed['right']=0
     
-        self._mcu.register_response(self.handle_ghead_temp,
+        self._mcu.register_response(self._route_response('temp'),
                                     "ghead_temp")
-        self._mcu.register_response(self.handle_ghead_sensor_s,
+        self._mcu.register_response(self._route_response('ksensor'),
                                     "ghead_ksensor_s")
-        self._mcu.register_response(self.handle_ghead_location_s,
+        self._mcu.register_response(self._route_response('location'),
                                     "ghead_location_s")
-        self._mcu.register_response(self.handle_ghead_in_s,
+        self._mcu.register_response(self._route_response('ghead_in'),
                                     "ghead_in_s")
-        self._mcu.register_response(self.handle_setfan_res,
+        self._mcu.register_response(self._route_response('fanset'),
                                     "ghead_fanset_s")
         self._mcu.register_response(self.handle_respond,
                                     "ghead_respond_s")
@@ -935,232 +1062,242 @@ class MCU_ghead:
     def start_monitor_ghead(self,ptr = 0):
         val = (ptr,)
         self.start_ghead_moitor.send(val)
-    def response_wait(self,event,mode,val,ptr):
-        self.wait_event = event
-        self.wait_val = val
-        self.wait_ptr = ptr
-        self.wait_mode = mode
-        eventtime = self.reactor.monotonic()
-        self.wait_response_count = 0
-        self.reactor.update_timer(self.wait_event_timer,eventtime + 1)
-        pass
+    def response_wait(self,event,mode,val,ptr,timeout=1.,retries=3):
+        # The command has already been sent - resend it until answered
+        send = (lambda: self.set_normal_ghead_ctrl(mode,ptr,val))
+        return self.requests.start(event,send,timeout,retries,
+                                   GHEAD_TIMEOUT_MSGS.get(event),
+                                   send_now=False)
     def record_msg_from_ghead(self,msg):
         if RECORD_GHEAD_MSG == 1:
             with open("ghead_record", "a") as record_file:
                 date = datetime.now().strftime('%Y-%m-%d--%H:%M:%S')
                 log = "[%s]%s\n"%(str(date),msg)
                 record_file.write(log)
+    def _register_routes(self):
+        router = self.router
+        # ghead_respond_s messages (Pro3)
+        for chars, handler, defer in [
+                ('R', self._handle_movement_start, True),
+                ('TP', self._handle_temp_error, True),
+                ('A', self._handle_hotend_location, True),
+                ('H', self._handle_power_state, True),
+                ('K', self._handle_hotend_ksensor, True),
+                ('W', self._handle_magnet_state, True),
+                ('D', self._handle_d_state, True),
+                ('ZH', self._handle_firmware_request, True),
+                ('RH', self._handle_reset_state, True),
+                ('UG', self._handle_update_state, False),
+                ('ET', self._handle_temp_filter, True)]:
+            router.register('respond', chars, handler,
+                            decoder=decode_ghead_respond, defer=defer)
+        # ghead_respond_s messages (RMF500)
+        for chars, handler in [
+                ('H', self._handle_rmf_heat), ('B', self._handle_rmf_baud),
+                ('C', self._handle_rmf_aff), ('A', self._handle_rmf_aaf),
+                ('U', self._handle_rmf_motor), ('T', self._handle_rmf_probe),
+                ('Z', self._handle_rmf_zlock),
+                (None, self._handle_rmf_unexpected)]:
+            router.register('rmf_respond', chars, handler, defer=True)
+        # ghead_slen messages
+        router.register('slen', 'GH', self.nprintf,
+                        decoder=decode_ghead_text, defer=True)
+        router.register('slen', 'V', self._handle_mcb_version,
+                        decoder=decode_ghead_text, defer=True)
+        router.register('slen', 'VC', self._handle_hcb_version,
+                        decoder=decode_ghead_text, defer=True)
+        router.register('slen', 'U', self.nprintf,
+                        decoder=decode_ghead_line, defer=True)
+        router.register('slen', 'P', self._handle_board_line,
+                        decoder=decode_ghead_line, defer=True)
+        # Messages without a mode
+        router.register('temp', None, self.handle_ghead_temp)
+        router.register('ksensor', None, self.handle_ghead_sensor_s)
+        router.register('location', None, self.handle_ghead_location_s)
+        router.register('ghead_in', None, self.handle_ghead_in_s)
+        router.register('fanset', None, self.handle_setfan_res)
+        # Calibration board replies (ghead_slen 'P' lines)
+        self.board_handlers = {
+            "M5801": self._handle_board_m5801,
+            "M5802": self._handle_board_m5802,
+            "M5803": self._handle_board_m5803}
+        self.board_status_handlers = {
+            0: self._handle_board_stop, 1: self._handle_board_start,
+            2: self._handle_board_psd_count, 3: self._handle_board_psd_done,
+            4: self._handle_board_present, 5: self._handle_board_message}
+    def _route_response(self, table):
+        router = self.router
+        def route(params):
+            router.dispatch(table, None, params)
+        return route
+    def get_status(self, eventtime):
+        status = self.router.get_status(eventtime)
+        status['requests'] = self.requests.get_status(eventtime)
+        if self.fw_transfer is not None:
+            status['firmware_transfer'] = self.fw_transfer.get_stats(
+                eventtime)
+        return status
     def handle_ghead_slen(self,params):
-        mode = int(params['mode'])
-        ptr  = int(params['gh_ptr'])
-        addr = int(params['addr'])
-        if mode == (ord('G') + ord('H')):
-            self.nprintf(str(params['buff']))
-        elif mode == ord('V'):
-            self.nprintf("MCB V%s"%(str(params['buff'],)))
-        elif mode == (ord('V') + ord('C')):
-            self.nprintf("HCB V%s"%(str(params['buff'],)))
-        elif mode == ord('U'):
-            msg = str(params['buff']).strip()
-            self.nprintf(msg)
-        elif mode == ord('P'):
-            msg = str(params['buff']).strip()
-            # self.nprintf(msg)
-            cmd_msg = msg.split(" ")
-            if cmd_msg[0] == "M5802":
-                psd_params = { part[0]: part[1:].strip()
-                                    for part in cmd_msg }
-                if 'H' in psd_params:
-                    head_ptr = int(psd_params['H'])
-                else:
-                    head_ptr = 1
-                if head_ptr == 0:
-                    headname = "left"
-                else:
-                    headname = "right"
-                if 'P' in psd_params:
-                    psd_msg = str(psd_params["P"])
-                    psdv = psd_msg.split(':')
-                    if int(psdv[0]) == 0:
-                        self.m5802_list = []
-                        self.m5802_list.append(psdv)
-                    else:
-                        self.m5802_list.append(psdv)
-                    transmit_pro = float(psdv[0])*100/self.psd_num
-                    self.nprintf("%s board transmit proc: %.1f"%(headname,transmit_pro,))
-                    # if "end":
-                    #     file_name = "file_{}.csv".format(int(time.time()))
-                    #     with open(file_name, "w") as csvfile:
-                    #         writer = csv.writer(csvfile,lineterminator='\n')
-                    #         for p in self.m5802_list:
-                    #             writer.writerow([p])
-            elif cmd_msg[0] == "M5803":
-                #self.nprintf("Calibration board: %s"%(msg,))
-                # raw_params = { part[0]: part[1:].strip()
-                #                     for part in cmd_msg }
-                raw_msg =  cmd_msg[1][1:].strip()         
-                raw_dat = raw_msg.split(':')
-                for dat in raw_dat:
-                    self.raw_dat_list.append(int(dat))
-                self.raw_dat_ptr = self.raw_dat_ptr + 1
-                self.nprintf("p%d %s"%(self.raw_dat_ptr,msg))
-
+        self.router.dispatch('slen', params['mode'], params)
+    def _handle_mcb_version(self,msg):
+        self.nprintf("MCB V%s"%(msg,))
+    def _handle_hcb_version(self,msg):
+        self.nprintf("HCB V%s"%(msg,))
+    def _handle_board_line(self,msg):
+        words = msg.split(" ")
+        handler = self.board_handlers.get(words[0])
+        if handler is not None:
+            handler(msg, words)
+    def _board_headname(self,cmd_params):
+        if 'H' in cmd_params and int(cmd_params['H']) == 0:
+            return "left"
+        return "right"
+    def _handle_board_m5802(self,msg,words):
+        psd_params = parse_ghead_line(words)
+        headname = self._board_headname(psd_params)
+        if 'P' in psd_params:
+            psdv = psd_params["P"].split(':')
+            if int(psdv[0]) == 0:
+                self.m5802_list = []
+            self.m5802_list.append(psdv)
+            transmit_pro = float(psdv[0])*100/self.psd_num
+            self.nprintf("%s board transmit proc: %.1f"%(headname,transmit_pro,))
+    def _handle_board_m5803(self,msg,words):
+        raw_dat = words[1][1:].strip().split(':')
+        for dat in raw_dat:
+            self.raw_dat_list.append(int(dat))
+        self.raw_dat_ptr = self.raw_dat_ptr + 1
+        self.nprintf("p%d %s"%(self.raw_dat_ptr,msg))
+    def _handle_board_m5801(self,msg,words):
+        self.nprintf(msg)
+        cmd_params = parse_ghead_line(words)
+        headname = self._board_headname(cmd_params)
+        if 'P' in cmd_params:
+            handler = self.board_status_handlers.get(int(cmd_params['P']))
+            if handler is not None:
+                handler(msg, cmd_params, headname)
+        elif 'C' in cmd_params:
+            try:
+                self._handle_board_calculate(cmd_params, headname)
+            except:
                 pass
-            elif cmd_msg[0] == "M5801":
-                self.nprintf(msg)
-                cmd_params = { part[0]: part[1:].strip()
-                        for part in cmd_msg }
-                if 'H' in cmd_params:
-                    head_ptr = int(cmd_params['H'])
-                else:
-                    head_ptr = 1
-                if head_ptr == 0:
-                    headname = "left"
-                else:
-                    headname = "right"
-                if 'P' in cmd_params:
-                    val = int(cmd_params['P'])
-                    if val == 3:
-                        if 'S' in cmd_params:
-                            sval = int(cmd_params['S'])
-                            if sval == 88:
-                                #check whether if the data is ok
-                                x_data_is_ok = True
-                                y_data_is_ok = True
-                                self.nprintf("lets jest check it")
-                                p1 = self.m5802_list[1]
-                                p2 = self.m5802_list[2]
-                                p3 = self.m5802_list[3]
-                                self.nprintf("check it %s %s %s "%(str(p1[3]),str(p2[3]),str(p3[3])))
-                                if float(p1[2]) == 0 and float(p2[2]) == 0 and float(p3[2]) == 0:
-                                    x_data_is_ok = False
-                                if float(p1[3]) == 0 and float(p2[3]) == 0 and float(p3[3]) == 0:
-                                    y_data_is_ok = False
-                                if x_data_is_ok == False and y_data_is_ok == True:
-                                    if self.retry_count < 2:
-                                        self.retry_count = self.retry_count + 1
-                                        self.nprintf("X psd data is bad! try calibrate again!")
-                                        self.record_msg_from_ghead("x psd data is bad! try calibrate again!")
-                                        self.printer.send_event("ghead:response","messure_reshake_x")
-                                        return
-                                    else:
-                                        self.nprintf("can't get right psd data please check if calibrate board is ok")
-                                        self.retry_count = 0 
-                                elif y_data_is_ok == False and x_data_is_ok == True:
-                                    if self.retry_count < 2:
-                                        self.retry_count = self.retry_count + 1
-                                        self.nprintf("Y psd data is bad! try calibrate again!")
-                                        self.record_msg_from_ghead("y psd data is bad! try calibrate again!")
-                                        self.printer.send_event("ghead:response","messure_reshake_y")
-                                        return
-                                    else:
-                                        self.nprintf("can't get right psd data please check if calibrate board is ok")
-                                        self.retry_count = 0
-                                elif y_data_is_ok == False and x_data_is_ok == False:
-                                    if self.retry_count < 2:
-                                        self.retry_count = self.retry_count + 1
-                                        self.nprintf("XY psd data is all bad! try calibrate again!")
-                                        self.record_msg_from_ghead("xy psd data is all bad! try calibrate again!")
-                                        self.printer.send_event("ghead:response","messure_reshake_xy")
-                                        return
-                                    else:
-                                        self.nprintf("can't get right psd data please check if calibrate board is ok")
-                                        self.retry_count = 0
-                                file_name = "/opt/Raise3D/file_{}.csv".format(int(time.time()))
-                                with open(file_name, "w") as csvfile:
-                                    writer = csv.writer(csvfile,lineterminator='\n')
-                                    self.nprintf("start save dat to %s"%file_name)
-                                    writer.writerow(("freq","psd_x","psd_y"))
-                                    for p in self.m5802_list:
-                                        writer.writerow((p[1],p[2],p[3]))
-                                csvfile.close()
-                                self.m5802_list = []
-                                self.nprintf("psd tranmit complete,file name is %s"%file_name)
-                                self.printer.send_event("ghead:response","run_to_end")
-                            elif sval == -1:
-                                self.nprintf("transmit failed,lost communication with Calibration board")
-
-                    elif val == 0:
-                        sval = int(cmd_params['S'])
-                        if sval == 0 or sval == 1:
-                            self.cancel_wait_event()
-                            self.nprintf("stop messure adxl345 on%s"%headname)
-                            if self.check_version == 0:
-                                self.printer.send_event("ghead:response","messure_stop")
-                        elif sval == -1:
-                            self.nprintf("lose connection with adxl345 on%s"%headname)
-                        
-                        
-                    elif val == 1:
-                        sval = int(cmd_params['S'])
-                        if sval == 0 or sval == 1: 
-                            self.nprintf("start messure adxl345 on%s"%headname)
-                            self.cancel_wait_event()
-                            if self.check_version == 0:
-                                self.printer.send_event("ghead:response","messure_start")
-                        elif sval == -1:
-                            self.nprintf("lose connection with adxl345 on%s"%headname)
-                        
-                        
-                    elif val == 5:
-                        self.nprintf("Calibration board %s : %s"%(headname,msg,))
-                    
-                    elif val == 4:
-                        if 'S' in cmd_params:
-                            sval = int(cmd_params['S'])
-                            if sval == 1:
-                                self.nprintf("Calibration board on %s is in"%headname)
-                            else:
-                                self.nprintf("Calibration board on %s is not in"%headname)
-                    elif val == 2:
-                        if 'S' in cmd_params:
-                            sval = int(cmd_params['S'])
-                            self.psd_num = sval
-                elif 'C' in cmd_params:
-                        try:
-                            val = int(cmd_params['C'])
-                            if val == 1:
-                                sval = int(cmd_params['S'])
-                                if sval == 8:
-                                    self.nprintf("complete caculate on %s"%headname) 
-                                    self.set_normal_ghead_ctrl(ord('P')+ord('R'),0,5)
-                                elif sval == 9:
-                                    self.nprintf("retry to caculate on %s"%headname)
-                                    if self.check_version == 0:
-                                        self.nprintf("notify resonace..")
-                                        self.printer.send_event("ghead:response","caculate_fail_event")
-                                elif sval == 2:
-                                    self.cancel_wait_event()
-                                    self.nprintf("Calibration board on the %s is caculating"%headname)
-                                    self.printer.send_event("ghead:response","caculating")
-                        except:
-                            pass                    
-                elif 'R' in cmd_params:
-                    sval = int(cmd_params['S'])
-                    if sval == 88:
-                        file_name = "/opt/Raise3D/file_raw_{}.csv".format(int(time.time()))
-                        with open(file_name, "w") as csvfile:
-                            writer = csv.writer(csvfile,lineterminator='\n')
-                            self.nprintf("start save raw dat to %s"%file_name)
-                            writer.writerow(("raw_dat",))
-                            for p in self.raw_dat_list:
-                                writer.writerow((p,float(p)*38.2459))
-                        csvfile.close()
-                        self.raw_dat_list = []
-                        self.raw_dat_ptr = 0
-                        self.nprintf("raw dat transmit complete,file name is %s"%file_name)
-                    elif sval == -2 :
-                        self.raw_dat_ptr = 0
-                        self.nprintf("fail to tramsmit raw dat %s"%file_name)
+        elif 'R' in cmd_params:
+            self._handle_board_raw_done(cmd_params)
+        else:
+            self.nprintf("fetet:" + msg)
+    def _handle_board_psd_done(self,msg,cmd_params,headname):
+        if 'S' not in cmd_params:
+            return
+        sval = int(cmd_params['S'])
+        if sval == -1:
+            self.nprintf("transmit failed,lost communication with Calibration board")
+            return
+        if sval != 88:
+            return
+        #check whether if the data is ok
+        self.nprintf("lets jest check it")
+        p1 = self.m5802_list[1]
+        p2 = self.m5802_list[2]
+        p3 = self.m5802_list[3]
+        self.nprintf("check it %s %s %s "%(str(p1[3]),str(p2[3]),str(p3[3])))
+        x_data_is_ok = not (float(p1[2]) == 0 and float(p2[2]) == 0
+                            and float(p3[2]) == 0)
+        y_data_is_ok = not (float(p1[3]) == 0 and float(p2[3]) == 0
+                            and float(p3[3]) == 0)
+        bad_axes = None
+        if not x_data_is_ok and y_data_is_ok:
+            bad_axes = ("X", "x", "messure_reshake_x")
+        elif not y_data_is_ok and x_data_is_ok:
+            bad_axes = ("Y", "y", "messure_reshake_y")
+        elif not y_data_is_ok and not x_data_is_ok:
+            bad_axes = ("XY", "xy", "messure_reshake_xy")
+        if bad_axes is not None:
+            if self.retry_count < 2:
+                self.retry_count = self.retry_count + 1
+                if bad_axes[0] == "XY":
+                    self.nprintf("XY psd data is all bad! try calibrate again!")
+                    self.record_msg_from_ghead("xy psd data is all bad! try calibrate again!")
                 else:
-                    self.nprintf("fetet:" + msg)
-                    pass
-                pass
-        # data = bytearray(params['buff'])
-        # lens = int(params['len'])
-        # self.nprintf("dat --> %s"%str(data))
-        # self.nprintf("len = %d"%lens)
-        pass
+                    self.nprintf("%s psd data is bad! try calibrate again!"%(bad_axes[0],))
+                    self.record_msg_from_ghead("%s psd data is bad! try calibrate again!"%(bad_axes[1],))
+                self.printer.send_event("ghead:response",bad_axes[2])
+                return
+            self.nprintf("can't get right psd data please check if calibrate board is ok")
+            self.retry_count = 0
+        file_name = "/opt/Raise3D/file_{}.csv".format(int(time.time()))
+        with open(file_name, "w") as csvfile:
+            writer = csv.writer(csvfile,lineterminator='\n')
+            self.nprintf("start save dat to %s"%file_name)
+            writer.writerow(("freq","psd_x","psd_y"))
+            for p in self.m5802_list:
+                writer.writerow((p[1],p[2],p[3]))
+        self.m5802_list = []
+        self.nprintf("psd tranmit complete,file name is %s"%file_name)
+        self.printer.send_event("ghead:response","run_to_end")
+    def _handle_board_stop(self,msg,cmd_params,headname):
+        sval = int(cmd_params['S'])
+        if sval == 0 or sval == 1:
+            self._complete_measure_requests(sval)
+            self.nprintf("stop messure adxl345 on%s"%headname)
+            if self.check_version == 0:
+                self.printer.send_event("ghead:response","messure_stop")
+        elif sval == -1:
+            self.nprintf("lose connection with adxl345 on%s"%headname)
+    def _handle_board_start(self,msg,cmd_params,headname):
+        sval = int(cmd_params['S'])
+        if sval == 0 or sval == 1:
+            self.nprintf("start messure adxl345 on%s"%headname)
+            self._complete_measure_requests(sval)
+            if self.check_version == 0:
+                self.printer.send_event("ghead:response","messure_start")
+        elif sval == -1:
+            self.nprintf("lose connection with adxl345 on%s"%headname)
+    def _complete_measure_requests(self,result):
+        self.requests.complete("messure_start_response",result)
+        self.requests.complete("messure_stop_response",result)
+    def _handle_board_message(self,msg,cmd_params,headname):
+        self.nprintf("Calibration board %s : %s"%(headname,msg,))
+    def _handle_board_present(self,msg,cmd_params,headname):
+        if 'S' in cmd_params:
+            if int(cmd_params['S']) == 1:
+                self.nprintf("Calibration board on %s is in"%headname)
+            else:
+                self.nprintf("Calibration board on %s is not in"%headname)
+    def _handle_board_psd_count(self,msg,cmd_params,headname):
+        if 'S' in cmd_params:
+            self.psd_num = int(cmd_params['S'])
+    def _handle_board_calculate(self,cmd_params,headname):
+        if int(cmd_params['C']) != 1:
+            return
+        sval = int(cmd_params['S'])
+        if sval == 8:
+            self.nprintf("complete caculate on %s"%headname)
+            self.set_normal_ghead_ctrl(ord('P')+ord('R'),0,5)
+        elif sval == 9:
+            self.nprintf("retry to caculate on %s"%headname)
+            if self.check_version == 0:
+                self.nprintf("notify resonace..")
+                self.printer.send_event("ghead:response","caculate_fail_event")
+        elif sval == 2:
+            self.requests.complete("caculate_start_response",sval)
+            self.nprintf("Calibration board on the %s is caculating"%headname)
+            self.printer.send_event("ghead:response","caculating")
+    def _handle_board_raw_done(self,cmd_params):
+        sval = int(cmd_params['S'])
+        if sval == 88:
+            file_name = "/opt/Raise3D/file_raw_{}.csv".format(int(time.time()))
+            with open(file_name, "w") as csvfile:
+                writer = csv.writer(csvfile,lineterminator='\n')
+                self.nprintf("start save raw dat to %s"%file_name)
+                writer.writerow(("raw_dat",))
+                for p in self.raw_dat_list:
+                    writer.writerow((p,float(p)*38.2459))
+            self.raw_dat_list = []
+            self.raw_dat_ptr = 0
+            self.nprintf("raw dat transmit complete,file name is %s"%file_name)
+        elif sval == -2 :
+            self.raw_dat_ptr = 0
+            self.nprintf("fail to tramsmit raw dat")
 
     def left_location_handle(self,eventtime):
         sta = 1
@@ -1183,146 +1320,104 @@ class MCU_ghead:
         return self.reactor.NEVER
 
     def handle_respond(self,params):
-        if self.printer_type == "Pro3":
-            ptr = int(params['gh_ptr'])
-            mode = int(params['mode'])
-            if mode == ord('R'):
-                self.nprintf("movement start ok!!!!!!!!!!!!!!!..")
-                self.ghead.set_normal_ghead_ctrl(mode = ord('L'),hs = 0)
-                self.gcode.run_script_from_command("M5100 G0 SCAN")
-            elif mode == (ord('T') + ord('P')):
-                if ptr == 0 :
-                    val = int(params['val'])
-                    if val == 2:
-                        self.nprintf("left hotend temp error")
-                elif ptr == 1:
-                    val = int(params['val'])
-                    if val == 2:
-                        self.nprintf("right hotend temp error")
-                pass
-            elif mode == ord('A'):
-                # check hotend is in
-                val = int(params['val'])
-                self.first_poweron_handle()
-                self.gcode.respond_raw("M5100 H%d A%d"%(ptr,val))
-                if ptr == 0:
-                    hotend = "left"
-                else:
-                    hotend = "right"
-                eventtime = self.reactor.monotonic()
-                sta = False
-                if val == 0:
-                    sta = True
-                else:
-                    sta = False
-                # if self._location_s[hotend] != sta:
-                self._location_s[hotend] = sta
-                if hotend == "left":
-                    self.reactor.update_timer(self.left_location_shake_timer,eventtime + 1.)
-                elif hotend == "right":
-                    self.reactor.update_timer(self.right_location_shake_timer,eventtime + 1.)
-            elif mode == ord('H'):
-                # check 24vpower is in
-                val = int(params['val'])
-                self.first_poweron_handle()
-                self.gcode.respond_raw("M5100 H%d H%d"%(ptr,val))
-                pass
-            elif mode == ord('K'):
-                val = int(params['val'])
-                self.first_poweron_handle()
-                self.gcode.respond_raw("Heater status: H%d K%d"%(ptr,val))
-                if ptr == 0:
-                    hotend = "left"
-                else:
-                    hotend = "right"
-                self.printer.send_event("ghead:hotend",hotend,val)
-                pass
-            elif mode == ord('W'):
-                # check megnet is in
-                val = int(params['val'])
-                self.gcode.respond_raw("M5100 S0 W%d"%(val,))
-                pass
-            elif mode == ord('D'):
-                # check megnet is in
-                val = int(params['val'])
-                self.gcode.respond_raw("M5100 T0 D%d"%(val,))
-                pass
-            elif mode == (ord('Z') + ord('H')):
-                val = int(params['val'])
-                sub_ptr  = val&0xff
-                main_ptr = (val >> 8)&0xffff
-                package_ptr = main_ptr*256 + sub_ptr*32
-                tranmit_package = self.firmware_buff[package_ptr:package_ptr+32]
-                self.set_len_dat_cmd.send((main_ptr,(ord('U')),sub_ptr,list(tranmit_package)))
-                pass
-            elif mode == (ord('R') + ord('H')):
-                val = int(params['val'])
-                if val == 1:
-                    self.nprintf("moveboard try to reset ghead ")
-                elif val == 0:
-                    self.nprintf("ghead boad has been reset ")
-                    self.nprintf("ghead restart")
-                elif val == 3:
-                    self.nprintf("ghead hardware has down!!")
-                elif val == 4:
-                    self.nprintf("mcu ready")
-            elif mode == (ord('U') + ord('G')):
-                # update ghead response
-
-                val = int(params['val'])
-                if ptr == 0:
-                    # set ghead bootloader mode
-                    # self.set_normal_ghead_ctrl(ord('U')+ord('G'),1,0)
-                    pass
-                elif ptr == 1:
-                    val = int(params['val'])         
-                    if val == 1:
-                        # has reset to isp mode try to erase
-                        #self.set_normal_ghead_ctrl(ord('U')+ord('G'),2,0)
-                        pass       
-                else:
-                    pass
-                pass
-            elif mode == (ord('E') + ord('T')):
-                val = int(params['val'])
-                if val == 0:
-                    self.nprintf("new temp in filter %d buff"%(ptr))
-                else:
-                    self.nprintf("heater %d temp jump to %.2f"%(ptr,float(val)/10))
-                pass
-        elif self.printer_type == "RMF500":
-            if params['mode'] == ord('H'):
-                self.gcode.respond_raw("ok heat set")
-            elif params['mode'] == ord('B'):
-                self.gcode.respond_raw("ok baud set")
-            elif params['mode'] == ord('C') and 'ptr' in params and 'val' in params:
-                ptr = int(params['ptr'])
-                if ptr == 0:
-                    self.gcode.respond_raw("ok xmode aff set%s"%(str(params['val'])))
-                else:
-                    self.gcode.respond_raw("ok ymode aff set%s"%(str(params['val'])))
-            elif params['mode'] == ord('A'):
-                ptr = int(params['ptr'])
-                if ptr == 0:
-                    self.gcode.respond_raw("ok xmotor aaf = %s"%(str(params['val'])))
-                else:
-                    self.gcode.respond_raw("ok ymotor aaf = %s"%(str(params['val'])))
-            elif params['mode'] == ord('U'):
-                ptr = int(params['ptr'])
-                if ptr == 0:
-                    self.gcode.respond_raw("ok xmotor status = %s"%(str(params['val'])))
-                else:
-                    self.gcode.respond_raw("ok ymotor status = %s"%(str(params['val'])))
-            elif params['mode'] == ord('T'):
-                self.gcode.respond_raw("ok probe set = %s"%(str(params['val'])))
-            elif params['mode'] == ord('Z'):
-                self.gcode.respond_raw("ok z_lock set = %s"%(str(params['val'])))
-            else:
-                self.gcode.respond_raw("unexpected mode = "%str(params['mode']))
+        if self.respond_table is not None:
+            self.router.dispatch(self.respond_table, params['mode'], params)
+    def _handle_movement_start(self,ptr,val):
+        self.nprintf("movement start ok!!!!!!!!!!!!!!!..")
+        self.set_normal_ghead_ctrl(mode = ord('L'),hs = 0)
+        self.gcode.run_script("M5100 G0 SCAN")
+    def _handle_temp_error(self,ptr,val):
+        if val == 2:
+            if ptr == 0:
+                self.nprintf("left hotend temp error")
+            elif ptr == 1:
+                self.nprintf("right hotend temp error")
+    def _handle_hotend_location(self,ptr,val):
+        # check hotend is in
+        self.first_poweron_handle()
+        self.gcode.respond_raw("M5100 H%d A%d"%(ptr,val))
+        eventtime = self.reactor.monotonic()
+        if ptr == 0:
+            self._location_s["left"] = (val == 0)
+            self.reactor.update_timer(self.left_location_shake_timer,eventtime + 1.)
+        else:
+            self._location_s["right"] = (val == 0)
+            self.reactor.update_timer(self.right_location_shake_timer,eventtime + 1.)
+    def _handle_power_state(self,ptr,val):
+        # check 24vpower is in
+        self.first_poweron_handle()
+        self.gcode.respond_raw("M5100 H%d H%d"%(ptr,val))
+    def _handle_hotend_ksensor(self,ptr,val):
+        self.first_poweron_handle()
+        self.gcode.respond_raw("Heater status: H%d K%d"%(ptr,val))
+        if ptr == 0:
+            hotend = "left"
+        else:
+            hotend = "right"
+        self.printer.send_event("ghead:hotend",hotend,val)
+    def _handle_magnet_state(self,ptr,val):
+        # check megnet is in
+        self.gcode.respond_raw("M5100 S0 W%d"%(val,))
+    def _handle_d_state(self,ptr,val):
+        self.gcode.respond_raw("M5100 T0 D%d"%(val,))
+    def _handle_firmware_request(self,ptr,val):
+        eventtime = self.reactor.monotonic()
+        if self.fw_transfer is None:
+            self.nprintf("firmware has not been loaded")
+            return
+        self.fw_transfer.handle_request(ghead_update.request_index(val),
+                                        eventtime)
+    def _handle_reset_state(self,ptr,val):
+        if val == 1:
+            self.nprintf("moveboard try to reset ghead ")
+        elif val == 0:
+            self.nprintf("ghead boad has been reset ")
+            self.nprintf("ghead restart")
+        elif val == 3:
+            self.nprintf("ghead hardware has down!!")
+        elif val == 4:
+            self.nprintf("mcu ready")
+    def _handle_update_state(self,ptr,val):
+        # update ghead response (progress is driven by 'ZH' requests)
+        pass
+    def _handle_temp_filter(self,ptr,val):
+        if val == 0:
+            self.nprintf("new temp in filter %d buff"%(ptr))
+        else:
+            self.nprintf("heater %d temp jump to %.2f"%(ptr,float(val)/10))
+    def _rmf_axis_respond(self,params,xmsg,ymsg):
+        if int(params['ptr']) == 0:
+            self.gcode.respond_raw(xmsg%(str(params['val']),))
+        else:
+            self.gcode.respond_raw(ymsg%(str(params['val']),))
+    def _handle_rmf_heat(self,params):
+        self.gcode.respond_raw("ok heat set")
+    def _handle_rmf_baud(self,params):
+        self.gcode.respond_raw("ok baud set")
+    def _handle_rmf_aff(self,params):
+        if 'ptr' in params and 'val' in params:
+            self._rmf_axis_respond(params,"ok xmode aff set%s",
+                                   "ok ymode aff set%s")
+        else:
+            self._handle_rmf_unexpected(params)
+    def _handle_rmf_aaf(self,params):
+        self._rmf_axis_respond(params,"ok xmotor aaf = %s","ok ymotor aaf = %s")
+    def _handle_rmf_motor(self,params):
+        self._rmf_axis_respond(params,"ok xmotor status = %s",
+                               "ok ymotor status = %s")
+    def _handle_rmf_probe(self,params):
+        self.gcode.respond_raw("ok probe set = %s"%(str(params['val'])))
+    def _handle_rmf_zlock(self,params):
+        self.gcode.respond_raw("ok z_lock set = %s"%(str(params['val'])))
+    def _handle_rmf_unexpected(self,params):
+        self.gcode.respond_raw("unexpected mode = %s"%str(params['mode']))
     def handle_ghead_temp(self,params):    
         readclock= self._mcu.clock32_to_clock64(params['clock'])
         readtime = self._mcu.clock_to_print_time(readclock) - COMM_DELAY_OFFSET
         self.first_poweron_handle()
+        if self.sample_callbacks:
+            self._report_sample('temperature',params,
+                                float(params['value'])/10,readtime)
         #sendtime = params['#sent_time']
         #print ("ghead readtime = %0.3f"%self._mcu.clock_to_print_time(readtime))
         if params['gh_ptr'] == 0 and self._tempv['left'] != None:
@@ -1359,6 +1454,8 @@ class MCU_ghead:
                     self.nprintf("start ghead and mcu")
 
     def handle_ghead_sensor_s(self,params):
+        if self.sample_callbacks:
+            self._report_sample('ksensor',params,params['sensor'])
         if params['gh_ptr'] == 0 and self._ksensor_s['left'] != None:
             self._ksensor_s['left'] = params['sensor']
             self.record_msg_from_ghead("heat0 k%d"%self._ksensor_s['left'])
@@ -1382,6 +1479,8 @@ class MCU_ghead:
                 self.first_poweron_handle()
                         
     def handle_setfan_res(self,params):
+        if self.sample_callbacks:
+            self._report_sample('fan',params,params['f_speed'])
         if params['gh_ptr'] == 0 and self.fan_speed['left'] != None:
             self.fan_speed['left'] = params['f_speed']
             #print ("this set fan res is from left ghead %d"%self._ghead_in_s['left'])
@@ -1523,7 +1622,9 @@ class CommandWrapper:
         
         cmd = self._cmd.encode(data)
         self._serial.raw_send(cmd, minclock, reqclock, self._cmd_queue)
-        
+    def send_batch(self, data_list, minclock=0, reqclock=0):
+        cmds = [self._cmd.encode(data) for data in data_list]
+        self._serial.raw_send_batch(cmds, minclock, reqclock, self._cmd_queue)
 
 class MCU:
     error = error
@@ -1749,14 +1850,11 @@ class MCU:
             if prev_crc is None:
                 logging.info("Sending MCU '%s' printer configuration...",
                              self._name)
-                for c in self._config_cmds:
-                    self._serial.send(c)
+                cmds = self._config_cmds
             else:
-                for c in self._restart_cmds:
-                    self._serial.send(c)
-            # Transmit init messages
-            for c in self._init_cmds:
-                self._serial.send(c)
+                cmds = self._restart_cmds
+            # Transmit (along with the init messages) in one batch
+            self._serial.send_batch(cmds + self._init_cmds)
         except msgproto.enumeration_error as e:
             enum_name, enum_value = e.get_enum_params()
             if enum_name == 'pin':
@@ -1919,6 +2017,8 @@ class MCU:
         self._serial.register_response(cb, msg, oid)
     def alloc_command_queue(self):
         return self._serial.alloc_command_queue()
+    def alloc_bulk_queue(self, msgformat, oid, block_size):
+        return self._serial.alloc_bulk_queue(msgformat, oid, block_size)
     def lookup_command(self, msgformat, cq=None):
         return CommandWrapper(self._serial, msgformat, cq)
     def lookup_query_command(self, msgformat, respformat, oid=None,
@@ -2028,8 +2128,13 @@ class MCU:
                      self._name, eventtime)
         self._printer.invoke_shutdown("Lost communication with MCU '%s'" % (
             self._name,))
+    def get_latency_stats(self):
+        return self._serial.get_latency_stats()
     def get_status(self, eventtime=None):
-        return dict(self._get_status_info)
+        status = dict(self._get_status_info)
+        if self.ghead is not None:
+            status['ghead'] = self.ghead.get_status(eventtime)
+        return status
     def stats(self, eventtime):
         load = "mcu_awake=%.03f mcu_task_avg=%.06f mcu_task_stddev=%.06f" % (
             self._mcu_tick_awake, self._mcu_tick_avg, self._mcu_tick_stddev)
@@ -2038,6 +2143,7 @@ class MCU:
         parts = [s.split('=', 1) for s in stats.split()]
         last_stats = {k:(float(v) if '.' in v else int(v)) for k, v in parts}
         self._get_status_info['last_stats'] = last_stats
+        self._get_status_info['latency'] = self.get_latency_stats()
         return False, '%s: %s' % (self._name, stats)
 
 Common_MCU_errors = {
@@ -2071,11 +2177,15 @@ def error_help(msg):
 def add_printer_objects(config):
     printer = config.get_printer()
     reactor = printer.get_reactor()
-    mainsync = clocksync.ClockSync(reactor)
-    printer.add_object('mcu', MCU(config.getsection('mcu'), mainsync))
+    estimators = {e: e for e in clocksync.ESTIMATORS}
+    mcu_config = config.getsection('mcu')
+    mainsync = clocksync.ClockSync(reactor, mcu_config.getchoice(
+        'clock_sync', estimators, 'decay'))
+    printer.add_object('mcu', MCU(mcu_config, mainsync))
     for s in config.get_prefix_sections('mcu '):
-        printer.add_object(s.section, MCU(
-            s, clocksync.SecondarySync(reactor, mainsync)))
+        printer.add_object(s.section, MCU(s, clocksync.SecondarySync(
+            reactor, mainsync, s.getchoice('clock_sync', estimators,
+                                           'decay'))))
 
 def get_printer_mcu(printer, name):
     if name == 'mcu':
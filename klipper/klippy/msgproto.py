@@ -39,6 +39,7 @@ MESSAGE_PAYLOAD_MAX = MESSAGE_MAX - MESSAGE_MIN
 MESSAGE_SEQ_MASK = 0x0f
 MESSAGE_DEST = 0x10
 MESSAGE_SYNC = '\x7E'
+COMMAND_CACHE_SIZE = 1024
 
 class error(Exception):
     pass
@@ -178,6 +179,67 @@ def convert_msg_format(msgformat):
         msgformat = msgformat.replace(c, '%s')
     return msgformat
 
+# Generate python source to parse the integer parameter 'var'
+def _gen_parse_int(var, signed):
+    out = ["c = s[pos]", "pos += 1",
+           "if c < 0x60:", "    %s = c" % (var,), "else:",
+           "    %s = c & 0x7f" % (var,),
+           "    if (c & 0x60) == 0x60:", "        %s |= -0x20" % (var,),
+           "    while c & 0x80:", "        c = s[pos]", "        pos += 1",
+           "        %s = (%s<<7) | (c & 0x7f)" % (var, var)]
+    if not signed:
+        out.append("    %s = int(%s & 0xffffffff)" % (var, var))
+    return out
+
+# Generate python source to encode the integer in 'v' onto 'out'
+def _gen_encode_int():
+    out = []
+    for shift, maxv, minv in [(28, 0xc000000, -0x4000000),
+                              (21, 0x180000, -0x80000),
+                              (14, 0x3000, -0x1000), (7, 0x60, -0x20)]:
+        out.append("if v >= %#x or v < %d: out.append((v>>%d) & 0x7f | 0x80)"
+                   % (maxv, minv, shift))
+    out.append("out.append(v & 0x7f)")
+    return out
+
+# Build specialized encode(), encode_by_name(), and parse() functions
+# for a message.  The functions are equivalent to the generic
+# MessageFormat methods, but avoid a per-parameter method call.
+def compile_message(msgid, param_names):
+    glbs = {'msgid': msgid}
+    parse = ["def parse(s, pos):", "    pos += 1"]
+    encode = ["def encode(params):", "    out = [msgid]"]
+    encode_by_name = ["def encode_by_name(**params):", "    out = [msgid]"]
+    results = []
+    for i, (name, t) in enumerate(param_names):
+        var = "p%d" % (i,)
+        results.append("%s: %s" % (repr(name), var))
+        if isinstance(t, PT_uint32):
+            parse_lines = _gen_parse_int(var, t.signed)
+            encode_lines = _gen_encode_int()
+        elif isinstance(t, PT_string):
+            parse_lines = ["l = s[pos]",
+                           "%s = bytes(bytearray(s[pos+1:pos+l+1]))" % (var,),
+                           "pos += l + 1"]
+            encode_lines = ["out.append(len(v))", "out.extend(bytearray(v))"]
+        else:
+            # Enumerations (and unknown types) use the type's methods
+            tname = "t%d" % (i,)
+            glbs[tname] = t
+            parse_lines = ["%s, pos = %s.parse(s, pos)" % (var, tname)]
+            encode_lines = ["%s.encode(out, v)" % (tname,)]
+        parse.extend(["    " + l for l in parse_lines])
+        encode.append("    v = params[%d]" % (i,))
+        encode.extend(["    " + l for l in encode_lines])
+        encode_by_name.append("    v = params[%s]" % (repr(name),))
+        encode_by_name.extend(["    " + l for l in encode_lines])
+    parse.append("    return {%s}, pos" % (", ".join(results),))
+    encode.append("    return out")
+    encode_by_name.append("    return out")
+    code = "\n".join(parse + encode + encode_by_name) + "\n"
+    exec(compile(code, "<msgproto %s>" % (msgid,), "exec"), glbs)
+    return glbs['encode'], glbs['encode_by_name'], glbs['parse']
+
 class MessageFormat:
     def __init__(self, msgid, msgformat, enumerations={}):
         self.msgid = msgid
@@ -187,6 +249,9 @@ class MessageFormat:
         self.param_names = lookup_params(msgformat, enumerations)
         self.param_types = [t for name, t in self.param_names]
         self.name_to_type = dict(self.param_names)
+        # Replace the generic methods below with specialized versions
+        self.encode, self.encode_by_name, self.parse = compile_message(
+            msgid, self.param_names)
     def encode(self, params):
         out = []
         out.append(self.msgid)
@@ -244,6 +309,86 @@ class UnknownFormat:
     def format_params(self, params):
         return "#unknown %s" % (repr(params['#msg']),)
 
+# Parsed contents of an mcu data dictionary
+class DataDictionary:
+    def __init__(self, identify_data, decompress):
+        self.identify_data = identify_data
+        self.decompress = decompress
+        data = identify_data
+        if decompress:
+            data = zlib.decompress(data)
+        self.raw_data = data
+        data = json.loads(data)
+        self.enumerations = data.get('enumerations', {})
+        commands = data.get('commands')
+        responses = data.get('responses')
+        output = data.get('output', {})
+        self.messages = dict(commands)
+        self.messages.update(responses)
+        self.messages.update(output)
+        self.command_tags = set(commands.values())
+        self.output_tags = set(output.values())
+        self.config = data.get('config', {})
+        self.version = data.get('version', '')
+        self.build_versions = data.get('build_versions', '')
+        # Message formats built from this dictionary
+        self.formats = {}
+        self.formats_enumerations = None
+    def get_formats(self, enumerations):
+        # Formats may only be reused with identical enumerations
+        if enumerations != self.formats_enumerations:
+            self.formats = {}
+            self.formats_enumerations = {
+                name: dict(enums) for name, enums in enumerations.items()}
+        return self.formats
+
+# Data dictionaries are cached by crc so that a reconnect (or
+# FIRMWARE_RESTART) does not need to parse the same dictionary again
+DICTIONARY_CACHE_SIZE = 4
+dictionary_cache = {}
+
+def load_data_dictionary(identify_data, decompress=True):
+    key = (zlib.crc32(identify_data) & 0xffffffff, decompress)
+    dd = dictionary_cache.get(key)
+    if dd is not None and dd.identify_data == identify_data:
+        return dd
+    dd = DataDictionary(identify_data, decompress)
+    if len(dictionary_cache) >= DICTIONARY_CACHE_SIZE:
+        dictionary_cache.clear()
+    dictionary_cache[key] = dd
+    return dd
+
+# Formats of the DefaultMessages (which do not use enumerations)
+default_formats = {}
+
+# Extract the ghead messages from a build's data dictionary file
+user_defined_cache = {}
+
+def load_user_defined_messages(filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    key = (filename, st.st_mtime, st.st_size)
+    messages = user_defined_cache.get(key)
+    if messages is not None:
+        return messages
+    f = open(filename, 'rb')
+    try:
+        data = json.loads(f.read())
+    finally:
+        f.close()
+    if not isinstance(data, dict):
+        raise error("Data dictionary %s is not a dictionary" % (filename,))
+    messages = {}
+    for msgtype in ['commands', 'responses']:
+        for msgformat, msgtag in data.get(msgtype, {}).items():
+            if msgformat.startswith("ghead"):
+                messages[str(msgformat)] = msgtag
+    user_defined_cache.clear()
+    user_defined_cache[key] = messages
+    return messages
+
 class MessageParser:
     error = error
     def __init__(self, warn_prefix=""):
@@ -256,8 +401,9 @@ class MessageParser:
         self.config = {}
         self.version = self.build_versions = ""
         self.raw_identify_data = ""
+        self.command_cache = {}
         #self.load_user_defined_cmd()
-        self._init_messages(DefaultMessages)
+        self._init_messages(DefaultMessages, formats=default_formats)
     def _error(self, msg, *params):
         raise error(self.warn_prefix + (msg % params))
     def check_packet(self, s):
@@ -337,6 +483,9 @@ class MessageParser:
                         msgformat, mp.msgformat)
         return mp
     def create_command(self, msg):
+        cmd = self.command_cache.get(msg)
+        if cmd is not None:
+            return list(cmd)
         parts = msg.strip().split()
         if not parts:
             return ""
@@ -367,32 +516,25 @@ class MessageParser:
         except:
             #logging.exception("Unable to encode")
             self._error("Unable to encode: %s", msgname)
-        return cmd
+        if len(self.command_cache) >= COMMAND_CACHE_SIZE:
+            self.command_cache.clear()
+        self.command_cache[msg] = cmd
+        return list(cmd)
     def check_msg_cmd(self):
         for tag,msg ,format in self.messages:
             if format.startswith("ghead"):
                 print (tag,msg,format)
         pass
-    def load_user_defined_cmd(self):
-        dir = "out/klipper.dict"
-        if not os.path.isfile(dir):
-            print ("file not exist")
+    def load_user_defined_cmd(self, filename="out/klipper.dict"):
+        try:
+            messages = load_user_defined_messages(filename)
+        except (IOError, ValueError, error) as e:
+            logging.warning("Unable to load %s: %s", filename, str(e))
             return
-        with  open(dir,"r") as f:
-            data = f.read()
-        dict_data = eval(data)
-        if isinstance(dict_data, dict):
-            for key,val in dict_data.items():
-                if key == "responses" or key == "commands":
-                    msg_list = eval(str(val))
-                    if isinstance(msg_list, dict):
-                        #print (key)
-                        for msg_key,msg_v in msg_list.items(): 
-                            if msg_key.startswith("ghead"):
-                                DefaultMessages[msg_key] = msg_v
-        else:
-            print ("file not dict")
-
+        if messages is None:
+            logging.info("Data dictionary %s does not exist", filename)
+            return
+        DefaultMessages.update(messages)
     def fill_enumerations(self, enumerations):
         for add_name, add_enums in enumerations.items():
             enums = self.enumerations.setdefault(add_name, {})
@@ -411,7 +553,11 @@ class MessageParser:
                 start_value, count = value
                 for i in range(count):
                     enums[enum_root + str(start_enum + i)] = start_value + i
-    def _init_messages(self, messages, command_tags=[], output_tags=[]):
+    def _init_messages(self, messages, command_tags=(), output_tags=(),
+                       formats=None):
+        self.command_cache.clear()
+        if formats is None:
+            formats = {}
         for msgformat, msgtag in messages.items():
             msgtype = 'response'
             if msgtag in command_tags:
@@ -422,30 +568,26 @@ class MessageParser:
             if msgtag < -32 or msgtag > 95:
                 self._error("Multi-byte msgtag not supported")
             msgid = msgtag & 0x7f
-            if msgtype == 'output':
-                self.messages_by_id[msgid] = OutputFormat(msgid, msgformat)
-            else:
-                msg = MessageFormat(msgid, msgformat, self.enumerations)
-                self.messages_by_id[msgid] = msg
+            msg = formats.get((msgtag, msgtype, msgformat))
+            if msg is None:
+                if msgtype == 'output':
+                    msg = OutputFormat(msgid, msgformat)
+                else:
+                    msg = MessageFormat(msgid, msgformat, self.enumerations)
+                formats[(msgtag, msgtype, msgformat)] = msg
+            self.messages_by_id[msgid] = msg
+            if msgtype != 'output':
                 self.messages_by_name[msg.name] = msg
     def process_identify(self, data, decompress=True):
         try:
-            if decompress:
-                data = zlib.decompress(data)
-            self.raw_identify_data = data
-            data = json.loads(data)
-            self.fill_enumerations(data.get('enumerations', {}))
-            commands = data.get('commands')
-            responses = data.get('responses')
-            output = data.get('output', {})
-            all_messages = dict(commands)
-            all_messages.update(responses)
-            all_messages.update(output)
-            self._init_messages(all_messages, commands.values(),
-                                output.values())
-            self.config.update(data.get('config', {}))
-            self.version = data.get('version', '')
-            self.build_versions = data.get('build_versions', '')
+            dd = load_data_dictionary(data, decompress)
+            self.raw_identify_data = dd.raw_data
+            self.fill_enumerations(dd.enumerations)
+            self._init_messages(dd.messages, dd.command_tags, dd.output_tags,
+                                dd.get_formats(self.enumerations))
+            self.config.update(dd.config)
+            self.version = dd.version
+            self.build_versions = dd.build_versions
         except error as e:
             raise
         except Exception as e:
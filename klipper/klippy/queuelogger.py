@@ -4,8 +4,12 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, logging.handlers, threading, Queue as queue, time
+import os, re, struct
 from datetime import datetime
 
+# Message arguments that may be formatted later in the background thread
+DEFER_ARG_TYPES = (int, long, float, str, bool, type(None))
+
 # Class to forward all messages through a queue to a background thread
 class QueueHandler(logging.Handler):
     def __init__(self, queue):
@@ -13,33 +17,274 @@ class QueueHandler(logging.Handler):
         self.queue = queue
     def emit(self, record):
         try:
-            self.format(record)
-            timeStamp = datetime.now().strftime("[%Y-%m-%d %H:%M:%S.%f] ")
-            record.msg = timeStamp+record.message  
-            record.args = None
-            record.exc_info = None
-            self.queue.put_nowait(record)
+            # Queue (time, level, format, args) - the message is
+            # formatted in the background thread when the arguments
+            # can not change before then
+            msg, args = record.msg, record.args
+            if record.exc_info:
+                msg, args = self.format(record), None
+            elif not args:
+                if type(msg) is not str:
+                    msg = record.getMessage()
+            elif (type(msg) is not str or type(args) is not tuple or [
+                    1 for a in args if type(a) not in DEFER_ARG_TYPES]):
+                msg, args = record.getMessage(), None
+            event = (record.created, record.levelno, msg, args)
+            self.queue.put_nowait(event)
         except Exception:
             self.handleError(record)
 
+# Format the "[date time] " prefix of log lines (caching the date)
+class LogTimeFormatter:
+    def __init__(self):
+        self.last_second = None
+        self.prefix = ""
+    def format(self, created):
+        second = int(created)
+        if second != self.last_second:
+            self.last_second = second
+            self.prefix = datetime.fromtimestamp(second).strftime(
+                "[%Y-%m-%d %H:%M:%S.")
+        return "%s%06d] " % (self.prefix, int((created - second) * 1000000.))
+
+def format_event(msg, args):
+    if not args:
+        return msg
+    try:
+        return msg % args
+    except Exception:
+        return "Unable to format log message %s with %s" % (
+            repr(msg), repr(args))
+
+
+######################################################################
+# Binary event log
+######################################################################
+
+# The event log starts with EVENTLOG_MAGIC followed by records:
+#   'D' <event_id:u32> <len:u32> <format>
+#   'E' <time:f64> <level:u8> <event_id:u32> <arg count:u8> <args>
+# Event id 0 is a pre-formatted message (a single string argument).
+# Other event ids are defined (once per file) by a 'D' record.  Each
+# argument is a type code followed by its value:
+#   'i' <i64>, 'f' <f64>, 's' <len:u32> <bytes>, 'b' <u8>, 'n',
+#   'L' <len:u32> <decimal digits> (integers that do not fit in an i64)
+EVENTLOG_MAGIC = "KLOGEV01"
+EVENT_RAW = 0
+
+def _encode_args(args):
+    out = []
+    for a in args:
+        t = type(a)
+        if t is bool:
+            out.append(struct.pack("<cB", 'b', a))
+        elif t is int or t is long:
+            if -(1 << 63) <= a < (1 << 63):
+                out.append(struct.pack("<cq", 'i', a))
+            else:
+                s = str(a)
+                out.append(struct.pack("<cI", 'L', len(s)) + s)
+        elif t is float:
+            out.append(struct.pack("<cd", 'f', a))
+        elif a is None:
+            out.append('n')
+        else:
+            s = str(a)
+            out.append(struct.pack("<cI", 's', len(s)) + s)
+    return "".join(out)
+
+class EventLogWriter:
+    def __init__(self, filename, max_bytes, backup_count):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.file = None
+        self.event_ids = {}
+        self.defined = set()
+        self._open()
+    def _open(self):
+        self.file = open(self.filename, 'ab')
+        if not self.file.tell():
+            self.file.write(EVENTLOG_MAGIC)
+        self.defined = set()
+    def should_rollover(self):
+        return self.file.tell() >= self.max_bytes
+    def do_rollover(self):
+        self.file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            src = "%s.%d" % (self.filename, i)
+            if os.path.exists(src):
+                os.rename(src, "%s.%d" % (self.filename, i + 1))
+        if self.backup_count:
+            os.rename(self.filename, self.filename + ".1")
+        else:
+            os.remove(self.filename)
+        self._open()
+    def write(self, created, levelno, msg, args):
+        if not args:
+            if type(msg) is unicode:
+                msg = msg.encode('utf-8')
+            event_id = EVENT_RAW
+            args = (msg,)
+        else:
+            event_id = self.event_ids.get(msg)
+            if event_id is None:
+                event_id = self.event_ids[msg] = len(self.event_ids) + 1
+            if event_id not in self.defined:
+                self.defined.add(event_id)
+                self.file.write(struct.pack("<cII", 'D', event_id, len(msg))
+                                + msg)
+        self.file.write(struct.pack("<cdBIB", 'E', created, levelno,
+                                    event_id, len(args))
+                        + _encode_args(args))
+    def close(self):
+        self.file.close()
+
+def _decode_args(data, pos, count):
+    args = []
+    for i in range(count):
+        code = data[pos]
+        pos += 1
+        if code == 'i':
+            args.append(struct.unpack_from("<q", data, pos)[0])
+            pos += 8
+        elif code == 'f':
+            args.append(struct.unpack_from("<d", data, pos)[0])
+            pos += 8
+        elif code == 's' or code == 'L':
+            length = struct.unpack_from("<I", data, pos)[0]
+            s = data[pos+4:pos+4+length]
+            args.append(long(s) if code == 'L' else s)
+            pos += 4 + length
+        elif code == 'b':
+            args.append(not not ord(data[pos]))
+            pos += 1
+        elif code == 'n':
+            args.append(None)
+        else:
+            raise ValueError("Invalid event log argument type %s"
+                             % (repr(code),))
+    return tuple(args), pos
+
+# Generate (time, level, message) tuples from a binary event log
+def read_event_log(filename):
+    f = open(filename, 'rb')
+    data = f.read()
+    f.close()
+    if not data.startswith(EVENTLOG_MAGIC):
+        raise ValueError("%s is not an event log" % (filename,))
+    formats = {}
+    pos = len(EVENTLOG_MAGIC)
+    size = len(data)
+    while pos < size:
+        code = data[pos]
+        if code == 'D':
+            if pos + 9 > size:
+                break
+            event_id, length = struct.unpack_from("<II", data, pos + 1)
+            formats[event_id] = data[pos+9:pos+9+length]
+            pos += 9 + length
+            continue
+        if code != 'E':
+            raise ValueError("Invalid event log record at offset %d" % (pos,))
+        if pos + 15 > size:
+            break
+        created, levelno, event_id, count = struct.unpack_from(
+            "<dBIB", data, pos + 1)
+        try:
+            args, pos = _decode_args(data, pos + 15, count)
+        except (IndexError, struct.error):
+            args = None
+        if args is None or pos > size:
+            # Truncated final record
+            break
+        if event_id == EVENT_RAW:
+            yield created, levelno, args[0]
+        else:
+            yield created, levelno, format_event(formats[event_id], args)
+
+def is_event_log(filename):
+    f = open(filename, 'rb')
+    magic = f.read(len(EVENTLOG_MAGIC))
+    f.close()
+    return magic == EVENTLOG_MAGIC
+
+# Sort rotated logs from oldest to newest (eg, klippy.log.2,
+# klippy.log.1, klippy.log)
+rotate_r = re.compile(r"^(?P<base>.*)\.(?P<num>[0-9]+)$")
+def order_logs(filenames):
+    def sort_key(filename):
+        m = rotate_r.match(filename)
+        if m is None:
+            return (filename, 0)
+        return (m.group('base'), -int(m.group('num')))
+    return sorted(filenames, key=sort_key)
+
+# Remove the "[date time] " prefix from a text log line
+def strip_time_prefix(line):
+    if line.startswith('[') and line[27:29] == '] ':
+        return line[29:]
+    return line
+
+# Generate the lines of a text log or binary event log (without the
+# "[date time] " prefix of text log lines)
+def log_lines(filename):
+    if is_event_log(filename):
+        for created, levelno, msg in read_event_log(filename):
+            for line in msg.split('\n'):
+                yield line
+        return
+    f = open(filename, 'rb')
+    for line in f:
+        yield strip_time_prefix(line.rstrip('\r\n'))
+    f.close()
+
+
+######################################################################
+# Background logging thread
+######################################################################
+
 # Class to poll a queue in a background thread and log each message
 class QueueListener(logging.handlers.RotatingFileHandler):
-    def __init__(self, filename):
+    def __init__(self, filename, eventlog_filename=None):
         logging.handlers.RotatingFileHandler.__init__(
             self, filename, maxBytes=1024*1024*2, backupCount=5,)
+        self.time_formatter = LogTimeFormatter()
+        self.event_log = None
+        if eventlog_filename is not None:
+            self.event_log = EventLogWriter(
+                eventlog_filename, 1024*1024*2, 5)
         self.bg_queue = queue.Queue()
         self.bg_thread = threading.Thread(target=self._bg_thread)
         self.bg_thread.start()
         self.rollover_info = {}
     def _bg_thread(self):
         while 1:
-            record = self.bg_queue.get(True)
-            if record is None:
+            event = self.bg_queue.get(True)
+            if event is None:
                 break
-            self.handle(record)
+            self._handle_event(event)
+    def _handle_event(self, event):
+        created, levelno, msg, args = event
+        event_log = self.event_log
+        if event_log is not None:
+            try:
+                if event_log.should_rollover():
+                    event_log.do_rollover()
+                    event_log.write(time.time(), logging.INFO,
+                                    self._rollover_message(), None)
+                event_log.write(created, levelno, msg, args)
+            except (IOError, OSError) as e:
+                self.event_log = None
+                self.handle(logging.makeLogRecord({
+                    'msg': "Unable to write event log: %s" % (e,)}))
+        msg = self.time_formatter.format(created) + format_event(msg, args)
+        self.handle(logging.makeLogRecord({'msg': msg, 'levelno': levelno}))
     def stop(self):
         self.bg_queue.put_nowait(None)
         self.bg_thread.join()
+        if self.event_log is not None:
+            self.event_log.close()
     def set_rollover_info(self, name, info):
         if info is None:
             self.rollover_info.pop(name, None)
@@ -47,21 +292,23 @@ class QueueListener(logging.handlers.RotatingFileHandler):
         self.rollover_info[name] = info
     def clear_rollover_info(self):
         self.rollover_info.clear()
-    def doRollover(self):
-        logging.handlers.RotatingFileHandler.doRollover(self)
+    def _rollover_message(self):
         lines = [self.rollover_info[name]
                  for name in sorted(self.rollover_info)]
         lines.append(
             "=============== Log rollover at %s ===============" % (
                 time.asctime(),))
+        return "\n".join(lines)
+    def doRollover(self):
+        logging.handlers.RotatingFileHandler.doRollover(self)
         self.emit(logging.makeLogRecord(
-            {'msg': "\n".join(lines), 'level': logging.INFO}))
+            {'msg': self._rollover_message(), 'level': logging.INFO}))
 
 MainQueueHandler = None
 
-def setup_bg_logging(filename, debuglevel):
+def setup_bg_logging(filename, debuglevel, eventlog_filename=None):
     global MainQueueHandler
-    ql = QueueListener(filename)
+    ql = QueueListener(filename, eventlog_filename)
     MainQueueHandler = QueueHandler(ql.bg_queue)
     root = logging.getLogger()
     root.addHandler(MainQueueHandler)
@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, gc, select, math, time, logging, Queue as queue
+import os, gc, select, math, time, logging, heapq, Queue as queue
 import greenlet
 import chelper, util
 
@@ -14,6 +14,7 @@ class ReactorTimer:
     def __init__(self, callback, waketime):
         self.callback = callback
         self.waketime = waketime
+        self.heap_seq = None
 
 class ReactorCompletion:
     class sentinel: pass
@@ -38,6 +39,7 @@ class ReactorCompletion:
         return self.result
 
 class ReactorCallback:
+    profile_kind = 'callback'
     def __init__(self, reactor, callback, waketime):
         self.reactor = reactor
         self.timer = reactor.register_timer(self.invoke, waketime)
@@ -49,10 +51,14 @@ class ReactorCallback:
         self.completion.complete(res)
         return self.reactor.NEVER
 
+class ReactorAsyncCallback(ReactorCallback):
+    profile_kind = 'async'
+
 class ReactorFileHandler:
-    def __init__(self, fd, callback):
+    def __init__(self, fd, read_callback, write_callback):
         self.fd = fd
-        self.callback = callback
+        self.read_callback = read_callback
+        self.write_callback = write_callback
     def fileno(self):
         return self.fd
 
@@ -61,6 +67,103 @@ class ReactorGreenlet(greenlet.greenlet):
         greenlet.greenlet.__init__(self, run=run)
         self.timer = None
 
+# Time accounting for reactor callbacks.  Elapsed time is charged to
+# the most recently entered callback, so time spent while a callback's
+# greenlet is paused is not charged to that callback.
+class ReactorProfile:
+    def __init__(self, reactor):
+        self.monotonic = reactor.monotonic
+        self.cputime = time.clock
+        self.reactor_file = reactor.pause.__func__.__code__.co_filename
+        self.names = {}
+        self.stats = {}
+        self.reactor_stats = self._lookup('reactor')
+        self.idle_stats = self._lookup('idle')
+        self.cur_stats = self.reactor_stats
+        self.start_time = self.last_wall = self.monotonic()
+        self.last_cpu = self.cputime()
+        self.greenlet_switches = 0
+    def _lookup(self, name):
+        s = self.stats.get(name)
+        if s is None:
+            # [count, wall time, cpu time, max wall time, max latency]
+            s = self.stats[name] = [0, 0., 0., 0., 0.]
+        return s
+    def _greenlet_name(self, g):
+        # Report the code (outside the reactor) that paused the greenlet
+        frame = g.gr_frame
+        reactor_file = self.reactor_file
+        while frame is not None and frame.f_code.co_filename == reactor_file:
+            frame = frame.f_back
+        if frame is None:
+            return 'greenlet'
+        code = frame.f_code
+        return "greenlet:%s:%s" % (os.path.basename(code.co_filename),
+                                   code.co_name)
+    def get_name(self, kind, callback):
+        obj = getattr(callback, '__self__', None)
+        if isinstance(obj, ReactorCallback):
+            kind, callback = obj.profile_kind, obj.callback
+            obj = getattr(callback, '__self__', None)
+        if isinstance(obj, greenlet.greenlet):
+            return self._greenlet_name(obj)
+        func = getattr(callback, '__func__', callback)
+        code = getattr(func, '__code__', None)
+        if code is None:
+            return "%s:%s" % (kind, getattr(callback, '__name__', '?'))
+        key = (kind, code, getattr(obj, '__class__', None))
+        name = self.names.get(key)
+        if name is not None:
+            return name
+        if obj is not None:
+            name = "%s.%s" % (obj.__class__.__name__, func.__name__)
+        elif func.__name__ == '<lambda>':
+            name = "%s:%d" % (os.path.basename(code.co_filename),
+                              code.co_firstlineno)
+        else:
+            name = "%s:%s" % (os.path.basename(code.co_filename),
+                              func.__name__)
+        name = self.names[key] = "%s:%s" % (kind, name)
+        return name
+    def _charge(self, next_stats):
+        wall, cpu = self.monotonic(), self.cputime()
+        s = self.cur_stats
+        wall_diff = wall - self.last_wall
+        s[1] += wall_diff
+        s[2] += cpu - self.last_cpu
+        if wall_diff > s[3]:
+            s[3] = wall_diff
+        self.last_wall, self.last_cpu = wall, cpu
+        self.cur_stats = next_stats
+    def run(self, kind, callback, eventtime, latency=0.):
+        s = self._lookup(self.get_name(kind, callback))
+        s[0] += 1
+        if latency > s[4]:
+            s[4] = latency
+        self._charge(s)
+        res = callback(eventtime)
+        self._charge(self.reactor_stats)
+        return res
+    def note_idle(self):
+        self.idle_stats[0] += 1
+        self._charge(self.idle_stats)
+    def note_wake(self):
+        self._charge(self.reactor_stats)
+    def note_switch(self):
+        self.greenlet_switches += 1
+        self._charge(self.reactor_stats)
+    def get_stats(self):
+        self._charge(self.cur_stats)
+        callbacks = {}
+        for name, s in self.stats.items():
+            count, wall, cpu, max_wall, max_latency = s
+            callbacks[name] = {'count': count, 'wall_time': wall,
+                               'cpu_time': cpu, 'max_wall_time': max_wall,
+                               'max_latency': max_latency}
+        return {'duration': self.last_wall - self.start_time,
+                'greenlet_switches': self.greenlet_switches,
+                'callbacks': callbacks}
+
 class ReactorMutex:
     def __init__(self, reactor, is_locked):
         self.reactor = reactor
@@ -71,6 +174,8 @@ class ReactorMutex:
         self.unlock = self.__exit__
     def test(self):
         return self.is_locked
+    def test_waiting(self):
+        return len(self.queue) > 0
     def __enter__(self):
         if not self.is_locked:
             self.is_locked = True
@@ -96,40 +201,77 @@ class SelectReactor:
     def __init__(self, gc_checking=False):
         # Main code
         self._process = False
-        self.monotonic = chelper.get_ffi()[1].get_monotonic
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self.monotonic = ffi_lib.get_monotonic
+        # Timer lateness statistics
+        self._timer_latency = ffi_main.gc(ffi_lib.histogram_alloc(),
+                                          ffi_lib.histogram_free)
+        self._histogram_add = ffi_lib.histogram_add
         # Python garbage collection
         self._check_gc = gc_checking
         self._last_gc_times = [0., 0., 0.]
-        # Timers
-        self._timers = []
+        # Timers (a heap of (waketime, seq, timer) entries - an entry is
+        # only valid if 'seq' matches the timer's heap_seq)
+        self._timer_heap = []
+        self._timer_seq = 0
+        self._stale_timers = 0
         self._next_timer = self.NEVER
         # Callbacks
         self._pipe_fds = None
         self._async_queue = queue.Queue()
+        # Callback time accounting (if enabled)
+        self._profile = None
         # File descriptors
-        self._fds = []
+        self._read_fds = []
+        self._write_fds = []
         # Greenlets
         self._g_dispatch = None
         self._greenlets = []
         self._all_greenlets = []
     def get_gc_stats(self):
         return tuple(self._last_gc_times)
+    def get_timer_latency(self):
+        return util.histogram_to_dict(self._timer_latency)
+    def set_profiling(self, enable):
+        # Enabling the profile (re)starts the time accounting
+        self._profile = None
+        if enable:
+            self._profile = ReactorProfile(self)
+    def get_profile(self):
+        if self._profile is None:
+            return None
+        return self._profile.get_stats()
     # Timers
-    def update_timer(self, timer_handler, waketime):
+    def _schedule_timer(self, timer_handler, waketime):
         timer_handler.waketime = waketime
-        self._next_timer = min(self._next_timer, waketime)
+        if timer_handler.heap_seq is not None:
+            if timer_handler.heap_seq < 0:
+                # Timer was unregistered
+                return
+            self._stale_timers += 1
+        if waketime >= self.NEVER:
+            timer_handler.heap_seq = None
+            return
+        self._timer_seq += 1
+        timer_handler.heap_seq = seq = self._timer_seq
+        heapq.heappush(self._timer_heap, (waketime, seq, timer_handler))
+        if waketime < self._next_timer:
+            self._next_timer = waketime
+    def _compact_timers(self):
+        # Drop entries of timers that were since rescheduled
+        timer_heap = self._timer_heap
+        timer_heap[:] = [e for e in timer_heap if e[2].heap_seq == e[1]]
+        heapq.heapify(timer_heap)
+        self._stale_timers = 0
+    def update_timer(self, timer_handler, waketime):
+        self._schedule_timer(timer_handler, waketime)
     def register_timer(self, callback, waketime=NEVER):
-        timer_handler = ReactorTimer(callback, waketime)
-        timers = list(self._timers)
-        timers.append(timer_handler)
-        self._timers = timers
-        self._next_timer = min(self._next_timer, waketime)
+        timer_handler = ReactorTimer(callback, self.NEVER)
+        self._schedule_timer(timer_handler, waketime)
         return timer_handler
     def unregister_timer(self, timer_handler):
-        timer_handler.waketime = self.NEVER
-        timers = list(self._timers)
-        timers.pop(timers.index(timer_handler))
-        self._timers = timers
+        self._schedule_timer(timer_handler, self.NEVER)
+        timer_handler.heap_seq = -1
     def _check_timers(self, eventtime, busy):
         if eventtime < self._next_timer:
             if busy:
@@ -147,18 +289,52 @@ class SelectReactor:
                     gc.collect(gc_level)
                     return 0.
             return min(1., max(.001, self._next_timer - eventtime))
-        self._next_timer = self.NEVER
         g_dispatch = self._g_dispatch
-        for t in self._timers:
-            waketime = t.waketime
-            if eventtime >= waketime:
-                t.waketime = self.NEVER
-                t.waketime = waketime = t.callback(eventtime)
-                if g_dispatch is not self._g_dispatch:
-                    self._next_timer = min(self._next_timer, waketime)
-                    self._end_greenlet(g_dispatch)
-                    return 0.
-            self._next_timer = min(self._next_timer, waketime)
+        latency, histogram_add = self._timer_latency, self._histogram_add
+        profile = self._profile
+        timer_heap = self._timer_heap
+        heappop, heappush = heapq.heappop, heapq.heappush
+        # Each timer runs at most once per pass - timers scheduled during
+        # this pass (seq > start_seq) are deferred to the next pass
+        start_seq = self._timer_seq
+        deferred = []
+        while timer_heap and timer_heap[0][0] <= eventtime:
+            entry = heappop(timer_heap)
+            waketime, seq, t = entry
+            if t.heap_seq != seq:
+                self._stale_timers -= 1
+                continue
+            if seq > start_seq:
+                deferred.append(entry)
+                continue
+            lateness = 0.
+            if waketime > _NOW:
+                lateness = eventtime - waketime
+                histogram_add(latency, lateness)
+            t.waketime = self.NEVER
+            t.heap_seq = None
+            if profile is None:
+                self._schedule_timer(t, t.callback(eventtime))
+            else:
+                self._schedule_timer(t, profile.run(
+                    'timer', t.callback, eventtime, lateness))
+            if g_dispatch is not self._g_dispatch:
+                for entry in deferred:
+                    heappush(timer_heap, entry)
+                self._next_timer = self.NOW
+                self._end_greenlet(g_dispatch)
+                return 0.
+        for entry in deferred:
+            heappush(timer_heap, entry)
+        if self._stale_timers > max(64, len(timer_heap) // 2):
+            self._compact_timers()
+        # Discard stale entries so the next wakeup is accurate
+        while timer_heap and timer_heap[0][2].heap_seq != timer_heap[0][1]:
+            heappop(timer_heap)
+            self._stale_timers -= 1
+        self._next_timer = self.NEVER
+        if timer_heap:
+            self._next_timer = timer_heap[0][0]
         return 0.
     # Callbacks and Completions
     def completion(self):
@@ -169,7 +345,7 @@ class SelectReactor:
     # Asynchronous (from another thread) callbacks and completions
     def register_async_callback(self, callback, waketime=NOW):
         self._async_queue.put_nowait(
-            (ReactorCallback, (self, callback, waketime)))
+            (ReactorAsyncCallback, (self, callback, waketime)))
         try:
             os.write(self._pipe_fds[1], '.')
         except os.error:
@@ -209,6 +385,8 @@ class SelectReactor:
         if g is not self._g_dispatch:
             if self._g_dispatch is None:
                 return self._sys_pause(waketime)
+            if self._profile is not None:
+                self._profile.note_switch()
             # Switch to _check_timers (via g.timer.callback return)
             return self._g_dispatch.switch(waketime)
         # Pausing the dispatch greenlet - prepare a new greenlet to do dispatch
@@ -220,6 +398,8 @@ class SelectReactor:
         g_next.parent = g.parent
         g.timer = self.register_timer(g.switch, waketime)
         self._next_timer = self.NOW
+        if self._profile is not None:
+            self._profile.note_switch()
         # Switch to _dispatch_loop (via _end_greenlet or direct)
         eventtime = g_next.switch()
         # This greenlet activated from g.timer.callback (via _check_timers)
@@ -237,12 +417,23 @@ class SelectReactor:
     def mutex(self, is_locked=False):
         return ReactorMutex(self, is_locked)
     # File descriptors
-    def register_fd(self, fd, callback):
-        file_handler = ReactorFileHandler(fd, callback)
-        self._fds.append(file_handler)
+    def register_fd(self, fd, read_callback, write_callback=None):
+        file_handler = ReactorFileHandler(fd, read_callback, write_callback)
+        self.set_fd_wake(file_handler, True, False)
         return file_handler
     def unregister_fd(self, file_handler):
-        self._fds.pop(self._fds.index(file_handler))
+        self.set_fd_wake(file_handler, False, False)
+    def set_fd_wake(self, file_handler, is_readable=True, is_writeable=False):
+        if file_handler in self._read_fds:
+            if not is_readable:
+                self._read_fds.pop(self._read_fds.index(file_handler))
+        elif is_readable:
+            self._read_fds.append(file_handler)
+        if file_handler in self._write_fds:
+            if not is_writeable:
+                self._write_fds.pop(self._write_fds.index(file_handler))
+        elif is_writeable:
+            self._write_fds.append(file_handler)
     # Main loop
     def _dispatch_loop(self):
         self._g_dispatch = g_dispatch = greenlet.getcurrent()
@@ -251,11 +442,21 @@ class SelectReactor:
         while self._process:
             timeout = self._check_timers(eventtime, busy)
             busy = False
-            res = select.select(self._fds, [], [], timeout)
+            profile = self._profile
+            if profile is not None:
+                profile.note_idle()
+            res = select.select(self._read_fds, self._write_fds, [], timeout)
             eventtime = self.monotonic()
-            for fd in res[0]:
+            if profile is not None:
+                profile.note_wake()
+            callbacks = [fd.read_callback for fd in res[0]]
+            callbacks.extend([fd.write_callback for fd in res[1]])
+            for callback in callbacks:
                 busy = True
-                fd.callback(eventtime)
+                if profile is None:
+                    callback(eventtime)
+                else:
+                    profile.run('fd', callback, eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
@@ -290,11 +491,11 @@ class PollReactor(SelectReactor):
         self._poll = select.poll()
         self._fds = {}
     # File descriptors
-    def register_fd(self, fd, callback):
-        file_handler = ReactorFileHandler(fd, callback)
+    def register_fd(self, fd, read_callback, write_callback=None):
+        file_handler = ReactorFileHandler(fd, read_callback, write_callback)
         logging.info("try to register fd")
         fds = self._fds.copy()
-        fds[fd] = callback
+        fds[fd] = file_handler
         self._fds = fds
         self._poll.register(file_handler, select.POLLIN | select.POLLHUP)
         return file_handler
@@ -303,6 +504,13 @@ class PollReactor(SelectReactor):
         fds = self._fds.copy()
         del fds[file_handler.fd]
         self._fds = fds
+    def set_fd_wake(self, file_handler, is_readable=True, is_writeable=False):
+        flags = select.POLLHUP
+        if is_readable:
+            flags |= select.POLLIN
+        if is_writeable:
+            flags |= select.POLLOUT
+        self._poll.modify(file_handler, flags)
     # Main loop
     def _dispatch_loop(self):
         self._g_dispatch = g_dispatch = greenlet.getcurrent()
@@ -312,15 +520,36 @@ class PollReactor(SelectReactor):
         while self._process:
             timeout = self._check_timers(eventtime, busy)
             busy = False
+            profile = self._profile
+            if profile is not None:
+                profile.note_idle()
             res = self._poll.poll(int(math.ceil(timeout * 1000.)))
             eventtime = self.monotonic()
+            if profile is not None:
+                profile.note_wake()
             for fd, event in res:
                 busy = True
-                self._fds[fd](eventtime)
-                if g_dispatch is not self._g_dispatch:
-                    self._end_greenlet(g_dispatch)
-                    eventtime = self.monotonic()
-                    break
+                hdl = self._fds[fd]
+                # Any event other than POLLOUT (including POLLERR and
+                # POLLNVAL) is reported to the read callback
+                if event & ~select.POLLOUT:
+                    if profile is None:
+                        hdl.read_callback(eventtime)
+                    else:
+                        profile.run('fd', hdl.read_callback, eventtime)
+                    if g_dispatch is not self._g_dispatch:
+                        self._end_greenlet(g_dispatch)
+                        eventtime = self.monotonic()
+                        break
+                if event & select.POLLOUT:
+                    if profile is None:
+                        hdl.write_callback(eventtime)
+                    else:
+                        profile.run('fd', hdl.write_callback, eventtime)
+                    if g_dispatch is not self._g_dispatch:
+                        self._end_greenlet(g_dispatch)
+                        eventtime = self.monotonic()
+                        break
         self._g_dispatch = None
 
 class EPollReactor(SelectReactor):
@@ -329,10 +558,10 @@ class EPollReactor(SelectReactor):
         self._epoll = select.epoll()
         self._fds = {}
     # File descriptors
-    def register_fd(self, fd, callback):
-        file_handler = ReactorFileHandler(fd, callback)
+    def register_fd(self, fd, read_callback, write_callback=None):
+        file_handler = ReactorFileHandler(fd, read_callback, write_callback)
         fds = self._fds.copy()
-        fds[fd] = callback
+        fds[fd] = file_handler
         self._fds = fds
         self._epoll.register(fd, select.EPOLLIN | select.EPOLLHUP)
         return file_handler
@@ -341,6 +570,13 @@ class EPollReactor(SelectReactor):
         fds = self._fds.copy()
         del fds[file_handler.fd]
         self._fds = fds
+    def set_fd_wake(self, file_handler, is_readable=True, is_writeable=False):
+        flags = select.EPOLLHUP
+        if is_readable:
+            flags |= select.EPOLLIN
+        if is_writeable:
+            flags |= select.EPOLLOUT
+        self._epoll.modify(file_handler.fd, flags)
     # Main loop
     def _dispatch_loop(self):
         self._g_dispatch = g_dispatch = greenlet.getcurrent()
@@ -349,15 +585,36 @@ class EPollReactor(SelectReactor):
         while self._process:
             timeout = self._check_timers(eventtime, busy)
             busy = False
+            profile = self._profile
+            if profile is not None:
+                profile.note_idle()
             res = self._epoll.poll(timeout)
             eventtime = self.monotonic()
+            if profile is not None:
+                profile.note_wake()
             for fd, event in res:
                 busy = True
-                self._fds[fd](eventtime)
-                if g_dispatch is not self._g_dispatch:
-                    self._end_greenlet(g_dispatch)
-                    eventtime = self.monotonic()
-                    break
+                hdl = self._fds[fd]
+                # Any event other than EPOLLOUT (including EPOLLERR) is
+                # reported to the read callback
+                if event & ~select.EPOLLOUT:
+                    if profile is None:
+                        hdl.read_callback(eventtime)
+                    else:
+                        profile.run('fd', hdl.read_callback, eventtime)
+                    if g_dispatch is not self._g_dispatch:
+                        self._end_greenlet(g_dispatch)
+                        eventtime = self.monotonic()
+                        break
+                if event & select.EPOLLOUT:
+                    if profile is None:
+                        hdl.write_callback(eventtime)
+                    else:
+                        profile.run('fd', hdl.write_callback, eventtime)
+                    if g_dispatch is not self._g_dispatch:
+                        self._end_greenlet(g_dispatch)
+                        eventtime = self.monotonic()
+                        break
         self._g_dispatch = None
 
 # Use the poll based reactor if it is available
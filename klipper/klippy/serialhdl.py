@@ -10,6 +10,8 @@ import serial
 
 import msgproto, chelper, util
 
+BULK_BLOCK_COUNT = 1024
+
 class error(Exception):
     pass
 
@@ -35,6 +37,8 @@ class SerialReader:
         self.handlers = {}
         self.register_response(self._handle_unknown_init, '#unknown')
         self.register_response(self.handle_output, '#output')
+        # Bulk data queues filled by the background thread
+        self.bulk_queues = []
         # Sent message notification tracking
         self.last_notify_id = 0
         self.pending_notifications = {}
@@ -216,6 +220,9 @@ class SerialReader:
         self.ffi_lib.serialqueue_set_clock_est(
             self.serialqueue, freq, conv_time, conv_clock, last_clock)
     def disconnect(self):
+        for bq in self.bulk_queues:
+            bq.stop()
+        del self.bulk_queues[:]
         if self.serialqueue is not None:
             self.ffi_lib.serialqueue_exit(self.serialqueue)
             if self.background_thread is not None:
@@ -233,6 +240,15 @@ class SerialReader:
         self.ffi_lib.serialqueue_get_stats(
             self.serialqueue, self.stats_buf, len(self.stats_buf))
         return self.ffi_main.string(self.stats_buf)
+    def get_latency_stats(self):
+        if self.serialqueue is None:
+            return {}
+        hists = self.ffi_main.new('struct histogram[3]')
+        count = self.ffi_lib.serialqueue_get_histograms(
+            self.serialqueue, hists, len(hists))
+        names = ['round_trip', 'queue_wait', 'send_margin']
+        return {names[i]: util.histogram_to_dict(hists[i])
+                for i in range(count)}
     def get_reactor(self):
         return self.reactor
     def get_msgparser(self):
@@ -246,17 +262,36 @@ class SerialReader:
                 del self.handlers[name, oid]
             else:
                 self.handlers[name, oid] = callback
+    def alloc_bulk_queue(self, msgformat, oid, block_size,
+                         block_count=BULK_BLOCK_COUNT):
+        msgtag = self.msgparser.lookup_command(msgformat).msgid
+        bq = BulkQueue(self, msgtag, oid, block_size, block_count)
+        self.bulk_queues.append(bq)
+        return bq
     # Command sending
     def raw_send(self, cmd, minclock, reqclock, cmd_queue):
         self.ffi_lib.serialqueue_send(self.serialqueue, cmd_queue,
                                       cmd, len(cmd), minclock, reqclock, 0)
     def raw_send_wait_ack(self, cmd, minclock, reqclock, cmd_queue):
+        return self.raw_send_batch_wait_ack([cmd], minclock, reqclock,
+                                            cmd_queue)
+    def raw_send_batch(self, cmds, minclock, reqclock, cmd_queue, nid=0):
+        # Queue all commands with a single call so that they are
+        # densely packed into message blocks
+        data = []
+        for c in cmds:
+            data.extend(c)
+        self.ffi_lib.serialqueue_send_multi(
+            self.serialqueue, cmd_queue, data, [len(c) for c in cmds],
+            len(cmds), minclock, reqclock, nid)
+    def raw_send_batch_wait_ack(self, cmds, minclock, reqclock, cmd_queue):
+        if not cmds:
+            return {}
         self.last_notify_id += 1
         nid = self.last_notify_id
         completion = self.reactor.completion()
         self.pending_notifications[nid] = completion
-        self.ffi_lib.serialqueue_send(self.serialqueue, cmd_queue,
-                                      cmd, len(cmd), minclock, reqclock, nid)
+        self.raw_send_batch(cmds, minclock, reqclock, cmd_queue, nid)
         params = completion.wait()
         if params is None:
             eventtime = self.reactor.monotonic()
@@ -271,6 +306,12 @@ class SerialReader:
     def send(self, msg, minclock=0, reqclock=0):
         cmd = self.msgparser.create_command(msg)
         self.raw_send(cmd, minclock, reqclock, self.default_cmd_queue)
+    def send_batch(self, msgs, minclock=0, reqclock=0, wait_ack=False):
+        cmds = [self.msgparser.create_command(msg) for msg in msgs]
+        if wait_ack:
+            return self.raw_send_batch_wait_ack(cmds, minclock, reqclock,
+                                                self.default_cmd_queue)
+        self.raw_send_batch(cmds, minclock, reqclock, self.default_cmd_queue)
     def send_with_response(self, msg, response):
         cmd = self.msgparser.create_command(msg)
         src = SerialRetryCommand(self, response)
@@ -345,6 +386,47 @@ class SerialRetryCommand:
             retries -= 1
             retry_delay *= 2.
 
+# Blocks of sensor data stored by the background thread.  Messages of
+# the form "<name> oid=%c sequence=%hu data=%*s" are not passed to
+# response callbacks while the queue is started.  Instead, the data of
+# each message is copied into a ring of fixed size blocks that may be
+# read (without copying) via get_buffer().
+class BulkQueue:
+    def __init__(self, serial, msgtag, oid, block_size, block_count):
+        self.ffi_main, self.ffi_lib = chelper.get_ffi()
+        self.bulkqueue = self.ffi_main.gc(
+            self.ffi_lib.bulkqueue_alloc(serial.serialqueue, msgtag, oid,
+                                         block_size, block_count),
+            self.ffi_lib.bulkqueue_free)
+        if not self.bulkqueue:
+            raise error("Unable to allocate bulk data queue")
+        self.block_size = block_size
+        self.view = self.ffi_main.new('struct bulkqueue_view *')
+        self.ffi_lib.bulkqueue_pull(self.bulkqueue, self.view)
+        self.buffer = self.ffi_main.buffer(self.view.data,
+                                           block_size * block_count)
+    def start(self, next_sequence=0):
+        self.ffi_lib.bulkqueue_start(self.bulkqueue, next_sequence)
+    def stop(self):
+        self.ffi_lib.bulkqueue_stop(self.bulkqueue)
+    def get_buffer(self):
+        return self.buffer
+    def pull(self):
+        # Return (pos, sequences, lengths) of the oldest unread blocks.
+        # The data of block N is at get_buffer()[N*block_size:] until
+        # release() is called.
+        view = self.view
+        self.ffi_lib.bulkqueue_pull(self.bulkqueue, view)
+        pos, count = view.pos, view.count
+        return (pos, self.ffi_main.unpack(view.sequences + pos, count),
+                bytearray(self.ffi_main.buffer(view.lengths + pos, count)))
+    def release(self, count):
+        self.ffi_lib.bulkqueue_release(self.bulkqueue, count)
+    def get_stats(self):
+        view = self.view
+        return {'gaps': view.gaps, 'missing': view.missing,
+                'overflows': view.overflows, 'invalid': view.invalid}
+
 # Attempt to place an AVR stk500v2 style programmer into normal mode
 def stk500v2_leave(ser, reactor):
     util.clear_hupcl(ser.fileno())
@@ -174,7 +174,7 @@ class MCU_stepper:
         return old_tq
     def add_active_callback(self, cb):
         self._active_callbacks.append(cb)
-    def generate_steps(self, flush_time):
+    def generate_steps(self, flush_time, pool=None):
         # Check for activity if necessary
         if self._active_callbacks:
             sk = self._stepper_kinematics
@@ -186,6 +186,10 @@ class MCU_stepper:
                     cb(ret)
         # Generate steps
         sk = self._stepper_kinematics
+        if pool is not None:
+            # Steps are generated (in parallel) by the caller
+            pool.queue(sk)
+            return
         ret = self._itersolve_generate_steps(sk, flush_time)
         if ret:
             raise error("Internal error in stepcompress %d"%ret)
@@ -397,9 +401,9 @@ class PrinterRail:
     def setup_itersolve(self, alloc_func, *params):
         for stepper in self.steppers:
             stepper.setup_itersolve(alloc_func, *params)
-    def generate_steps(self, flush_time):
+    def generate_steps(self, flush_time, pool=None):
         for stepper in self.steppers:
-            stepper.generate_steps(flush_time)
+            stepper.generate_steps(flush_time, pool)
     def set_trapq(self, trapq):
         for stepper in self.steppers:
             stepper.set_trapq(trapq)
@@ -4,8 +4,8 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import json
-import math, logging, importlib
-import mcu, chelper, kinematics.extruder
+import math, logging, importlib, array
+import mcu, chelper, stepper, kinematics.extruder
 
 # Common suffixes: _d is distance (in mm), _v is velocity (in
 #   mm/second), _v2 is velocity squared (mm^2/s^2), _t is time (in
@@ -196,6 +196,61 @@ DRIP_TIME = 0.100
 class DripModeEndSignal(Exception):
     pass
 
+# MoveQueue variant that runs the look-ahead pass in C over a packed
+# array of the queued junction limits (the results are identical to
+# MoveQueue.flush)
+class BatchMoveQueue(MoveQueue):
+    def __init__(self, toolhead):
+        MoveQueue.__init__(self, toolhead)
+        self.ffi_main, self.ffi_lib = chelper.get_ffi()
+        self.move_limits = array.array('d')
+        self.junctions = self.ffi_main.new("struct lookahead_junction[]", 64)
+        self.junctions_size = 64
+    def reset(self):
+        MoveQueue.reset(self)
+        del self.move_limits[:]
+    def flush(self, lazy=False):
+        self.junction_flush = LOOKAHEAD_FLUSH_TIME
+        queue = self.queue
+        if len(queue) > self.junctions_size:
+            while len(queue) > self.junctions_size:
+                self.junctions_size *= 2
+            self.junctions = self.ffi_main.new(
+                "struct lookahead_junction[]", self.junctions_size)
+        junctions = self.junctions
+        move_limits = self.ffi_main.cast(
+            "double *", self.ffi_main.from_buffer(self.move_limits))
+        flush_count = self.ffi_lib.lookahead_plan(
+            move_limits, len(queue), lazy, junctions)
+        if flush_count < 0:
+            raise MemoryError("Unable to allocate look-ahead queue")
+        if not flush_count:
+            return
+        for i in range(flush_count):
+            junction = junctions[i]
+            if junction.is_set:
+                queue[i].set_junction(junction.start_v2, junction.cruise_v2,
+                                      junction.end_v2)
+        # Generate step times for all moves ready to be flushed
+        self.toolhead._process_moves(queue[:flush_count])
+        # Remove processed moves from the queue
+        del queue[:flush_count]
+        del self.move_limits[:flush_count * 5]
+    def add_move(self, move):
+        queue = self.queue
+        queue.append(move)
+        if len(queue) > 1:
+            move.calc_junction(queue[-2])
+        self.move_limits.extend((move.max_start_v2, move.max_cruise_v2,
+                                 move.delta_v2, move.max_smoothed_v2,
+                                 move.smooth_delta_v2))
+        if len(queue) == 1:
+            return
+        self.junction_flush -= move.min_move_t
+        if self.junction_flush <= 0.:
+            # Enough moves have been queued to reach the target flush time.
+            self.flush(lazy=True)
+
 # Main code to track events (and their timing) on the printer toolhead
 DEFAULT_PRINTER_CONFIG_DIR = "/opt/Raise3D/config/printer.cfg"
 class ToolHead:
@@ -208,7 +263,9 @@ class ToolHead:
         self.can_pause = True
         if self.mcu.is_fileoutput():
             self.can_pause = False
-        self.move_queue = MoveQueue(self)
+        lookahead_modes = {'python': MoveQueue, 'batch': BatchMoveQueue}
+        self.move_queue = config.getchoice('lookahead', lookahead_modes,
+                                           'batch')(self)
         self.commanded_pos = [0., 0., 0., 0.]
         self.printer.register_event_handler("klippy:shutdown",
                                             self._handle_shutdown)
@@ -270,8 +327,17 @@ class ToolHead:
         ffi_main, ffi_lib = chelper.get_ffi()
         self.trapq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
         self.trapq_append = ffi_lib.trapq_append
+        self.trapq_buffer = chelper.TrapqBuffer(self.trapq)
         self.trapq_finalize_moves = ffi_lib.trapq_finalize_moves
         self.step_generators = []
+        self.step_gen_pool = None
+        step_gen_threads = config.getint('step_generation_threads', 0,
+                                         minval=0)
+        if step_gen_threads:
+            self.step_gen_pool = chelper.StepGenPool(step_gen_threads)
+            if not self.step_gen_pool.pool:
+                raise config.error("Unable to start %d step generation threads"
+                                   % (step_gen_threads,))
         # Create kinematics class
         self.gcode = gcode = self.printer.lookup_object('gcode')
         self.Coord = gcode.Coord
@@ -353,8 +419,16 @@ class ToolHead:
         while 1:
             self.print_time = min(self.print_time + batch_time, next_print_time)
             sg_flush_time = max(lkft, self.print_time - kin_flush_delay)
-            for sg in self.step_generators:
-                sg(sg_flush_time)
+            if self.step_gen_pool is None:
+                for sg in self.step_generators:
+                    sg(sg_flush_time)
+            else:
+                for sg in self.step_generators:
+                    sg(sg_flush_time, self.step_gen_pool)
+                ret = self.step_gen_pool.generate_steps(sg_flush_time)
+                if ret:
+                    raise stepper.error("Internal error in stepcompress %d"
+                                        % (ret,))
             free_time = max(lkft, sg_flush_time - kin_flush_delay)
             self.trapq_finalize_moves(self.trapq, free_time)
             self.extruder.update_move_time(free_time)
@@ -384,20 +458,30 @@ class ToolHead:
             self._calc_print_time()
         # Queue moves into trapezoid motion queue (trapq)
         next_move_time = self.print_time
+        trapq_buffer = self.trapq_buffer
+        queue_move = trapq_buffer.moves.extend
+        extruder = self.extruder
         for move in moves:
             if move.is_kinematic_move:
-                self.trapq_append(
-                    self.trapq, next_move_time,
-                    move.accel_t, move.cruise_t, move.decel_t,
-                    move.start_pos[0], move.start_pos[1], move.start_pos[2],
-                    move.axes_r[0], move.axes_r[1], move.axes_r[2],
-                    move.start_v, move.cruise_v, move.accel)
+                start_pos = move.start_pos
+                axes_r = move.axes_r
+                queue_move((next_move_time,
+                            move.accel_t, move.cruise_t, move.decel_t,
+                            start_pos[0], start_pos[1], start_pos[2],
+                            axes_r[0], axes_r[1], axes_r[2],
+                            move.start_v, move.cruise_v, move.accel))
             if move.axes_d[3]:
-                self.extruder.move(next_move_time, move)
+                extruder.move(next_move_time, move)
             next_move_time = (next_move_time + move.accel_t
                               + move.cruise_t + move.decel_t)
-            for cb in move.timing_callbacks:
-                cb(next_move_time)
+            if move.timing_callbacks:
+                # Callbacks may inspect the trapq - add pending moves first
+                trapq_buffer.flush()
+                extruder.flush_moves()
+                for cb in move.timing_callbacks:
+                    cb(next_move_time)
+        trapq_buffer.flush()
+        extruder.flush_moves()
         # Generate steps for moves
         if self.special_queuing_state:
             self._update_drip_move_time(next_move_time)
@@ -90,6 +90,25 @@ def dump_mcu_build():
     dump_file_stats(build_dir, 'out/klipper.elf')
 
 
+######################################################################
+# Latency histograms
+######################################################################
+
+# Upper bound of the first bucket of a chelper 'struct histogram' (the
+# bound doubles for each following bucket and the last is unbounded)
+HISTOGRAM_BASE = .0001
+
+# Convert a chelper 'struct histogram' to a dictionary
+def histogram_to_dict(h):
+    counts = list(h.counts)
+    bounds = [HISTOGRAM_BASE * (1 << i) for i in range(len(counts) - 1)]
+    avg = 0.
+    if h.count:
+        avg = h.sum / h.count
+    return {'bounds': bounds, 'counts': counts, 'count': h.count,
+            'negative': h.negative, 'avg': avg, 'min': h.min, 'max': h.max}
+
+
 ######################################################################
 # General system and software information
 ######################################################################
@@ -7,6 +7,8 @@ import logging, socket, os, sys, errno, json, collections
 import gcode
 
 REQUEST_LOG_SIZE = 20
+SEND_COALESCE_SIZE = 65536
+STATUS_BACKLOG_SIZE = 256 * 1024
 
 # Json decodes strings as unicode types in Python 2.x.  This doesn't
 # play well with some parts of Klipper (particuarly displays), so we
@@ -24,6 +26,9 @@ def byteify(data, ignore_dicts=False):
                 for k, v in data.items()}
     return data
 
+def encode_frame(data):
+    return json.dumps(data, separators=(',', ':')) + "\x03"
+
 class WebRequestError(gcode.CommandError):
     def __init__(self, message,):
         Exception.__init__(self, message)
@@ -169,9 +174,14 @@ class ClientConnection:
         self.uid = id(self)
         self.sock = sock
         self.fd_handle = self.reactor.register_fd(
-            self.sock.fileno(), self.process_received)
+            self.sock.fileno(), self.process_received, self._do_send)
         self.partial_data = self.send_buffer = ""
-        self.is_sending_data = False
+        self.send_queue = collections.deque()
+        self.send_pending = 0
+        self.is_sending_data = self.is_write_wait = False
+        # Status frames dropped because the client fell behind
+        self.need_full_status = False
+        self.status_dropped = 0
         self.set_client_info("?", "New connection")
         self.request_log = collections.deque([], REQUEST_LOG_SIZE)
 
@@ -200,6 +210,9 @@ class ClientConnection:
         self.set_client_info(None, "Disconnected")
         self.reactor.unregister_fd(self.fd_handle)
         self.fd_handle = None
+        self.send_queue.clear()
+        self.send_buffer = ""
+        self.send_pending = 0
         try:
             self.sock.close()
         except socket.error:
@@ -255,33 +268,69 @@ class ClientConnection:
         self.send(result)
 
     def send(self, data):
-        self.send_buffer += json.dumps(data, separators=(',', ':')) + "\x03"
+        self.send_raw(encode_frame(data))
+
+    def send_raw(self, frame, is_status=False):
+        if is_status and self.send_pending > STATUS_BACKLOG_SIZE:
+            # Client is not keeping up - discard its queued status
+            # frames and send it a complete status on a later tick
+            self._drop_status_frames()
+            return False
+        self.send_queue.append((frame, is_status))
+        self.send_pending += len(frame)
         if not self.is_sending_data:
             self.is_sending_data = True
             self.reactor.register_callback(self._do_send)
+        return True
+
+    def _drop_status_frames(self):
+        frames = [f for f in self.send_queue if not f[1]]
+        dropped = len(self.send_queue) - len(frames) + 1
+        self.send_queue = collections.deque(frames)
+        self.send_pending = len(self.send_buffer) + sum(
+            [len(f[0]) for f in frames])
+        self.status_dropped += dropped
+        self.need_full_status = True
+
+    def _fill_send_buffer(self):
+        # Coalesce queued frames into a single socket write
+        frames = [self.send_buffer]
+        size = len(self.send_buffer)
+        send_queue = self.send_queue
+        while send_queue and size < SEND_COALESCE_SIZE:
+            frame = send_queue.popleft()[0]
+            frames.append(frame)
+            size += len(frame)
+        self.send_buffer = "".join(frames)
+
+    def _set_write_wait(self, is_write_wait):
+        if is_write_wait != self.is_write_wait and self.fd_handle is not None:
+            self.is_write_wait = is_write_wait
+            self.reactor.set_fd_wake(self.fd_handle, True, is_write_wait)
 
     def _do_send(self, eventtime):
-        retries = 10
-        while self.send_buffer:
+        while self.send_buffer or self.send_queue:
+            if self.send_queue and len(self.send_buffer) < SEND_COALESCE_SIZE:
+                self._fill_send_buffer()
             try:
                 sent = self.sock.send(self.send_buffer)
             except socket.error as e:
-                if e.errno == errno.EBADF or e.errno == errno.EPIPE \
-                        or not retries:
+                if e.errno == errno.EBADF or e.errno == errno.EPIPE:
                     sent = 0
                 else:
-                    retries -= 1
-                    waketime = self.reactor.monotonic() + .001
-                    self.reactor.pause(waketime)
-                    continue
-            retries = 10
+                    # Socket buffer is full - continue sending from the
+                    # fd write handler once the socket is writable
+                    self._set_write_wait(True)
+                    return
             if sent > 0:
                 self.send_buffer = self.send_buffer[sent:]
+                self.send_pending -= sent
             else:
                 logging.info(
                     "webhooks: Error sending server data,  closing socket")
                 self.close()
                 break
+        self._set_write_wait(False)
         self.is_sending_data = False
 
 class WebHooks:
@@ -373,6 +422,9 @@ class WebHooks:
         state_message, state = self.printer.get_state_message()
         return {'state': state, 'state_message': state_message}
 
+    def get_status_version(self, eventtime):
+        return self.printer.get_state_message()
+
     def call_remote_method(self, method, **kwargs):
         if method not in self._remote_methods:
             raise self.printer.command_error(
@@ -440,6 +492,10 @@ class QueryStatusHelper:
         self.pending_queries = []
         self.query_timer = None
         self.last_query = {}
+        self.last_versions = {}
+        # Statistics
+        self.query_ticks = self.objects_queried = self.objects_skipped = 0
+        self.clients_sent = self.frames_encoded = self.frames_dropped = 0
         # Register webhooks
         webhooks = printer.lookup_object('webhooks')
         webhooks.register_endpoint("objects/list", self._handle_list)
@@ -449,45 +505,98 @@ class QueryStatusHelper:
         objects = [n for n, o in self.printer.lookup_objects()
                    if hasattr(o, 'get_status')]
         web_request.send({'objects': objects})
+    def _query_object(self, obj_name, eventtime, query, versions, changes):
+        # Objects may implement get_status_version() returning a value
+        # that only compares equal if get_status() is unchanged
+        po = self.printer.lookup_object(obj_name, None)
+        if po is None or not hasattr(po, 'get_status'):
+            res = query[obj_name] = {}
+            changes[obj_name] = {}
+            return res
+        lres = self.last_query.get(obj_name)
+        get_version = getattr(po, 'get_status_version', None)
+        if get_version is not None:
+            version = versions[obj_name] = get_version(eventtime)
+            if (lres is not None and obj_name in self.last_versions
+                and self.last_versions[obj_name] == version):
+                self.objects_skipped += 1
+                query[obj_name] = lres
+                changes[obj_name] = {}
+                return lres
+        self.objects_queried += 1
+        res = query[obj_name] = po.get_status(eventtime)
+        if lres is None:
+            lres = {}
+        # Determine the fields that changed since the last query
+        changed = {k: v for k, v in res.items() if v != lres.get(k)}
+        for k, v in lres.items():
+            if v is not None and k not in res:
+                changed[k] = None
+        changes[obj_name] = changed
+        return res
     def _do_query(self, eventtime):
-        last_query = self.last_query
-        query = self.last_query = {}
+        query = {}
+        versions = {}
+        changes = {}
         msglist = self.pending_queries
         self.pending_queries = []
         msglist.extend(self.clients.values())
+        self.query_ticks += 1
+        # Clients with the same template and status share an encoding
+        frames = {}
         # Generate get_status() info for each client
-        for cconn, subscription, send_func, template in msglist:
+        for cconn, subscription, send_func, template, tkey in msglist:
             is_query = cconn is None
             if not is_query and cconn.is_closed():
                 del self.clients[cconn]
                 continue
+            # Resend all subscribed fields if status frames were dropped
+            is_full = is_query or cconn.need_full_status
             # Query each requested printer object
             cquery = {}
             for obj_name, req_items in subscription.items():
                 res = query.get(obj_name, None)
                 if res is None:
-                    po = self.printer.lookup_object(obj_name, None)
-                    if po is None or not hasattr(po, 'get_status'):
-                        res = query[obj_name] = {}
-                    else:
-                        res = query[obj_name] = po.get_status(eventtime)
+                    res = self._query_object(obj_name, eventtime, query,
+                                             versions, changes)
                 if req_items is None:
                     req_items = list(res.keys())
                     if req_items:
                         subscription[obj_name] = req_items
-                lres = last_query.get(obj_name, {})
-                cres = {}
-                for ri in req_items:
-                    rd = res.get(ri, None)
-                    if is_query or rd != lres.get(ri):
-                        cres[ri] = rd
-                if cres or is_query:
-                    cquery[obj_name] = cres
+                if is_full:
+                    cquery[obj_name] = {ri: res.get(ri, None)
+                                        for ri in req_items}
+                    continue
+                changed = changes[obj_name]
+                if changed:
+                    cres = {ri: changed[ri] for ri in req_items
+                            if ri in changed}
+                    if cres:
+                        cquery[obj_name] = cres
             # Send data
-            if cquery or is_query:
+            if is_query:
                 tmp = dict(template)
                 tmp['params'] = {'eventtime': eventtime, 'status': cquery}
                 send_func(tmp)
+                self.clients_sent += 1
+                continue
+            if not cquery and not is_full:
+                continue
+            key = (tkey, is_full, tuple([(n, tuple(sorted(cquery[n])))
+                                         for n in sorted(cquery)]))
+            frame = frames.get(key)
+            if frame is None:
+                tmp = dict(template)
+                tmp['params'] = {'eventtime': eventtime, 'status': cquery}
+                frame = frames[key] = encode_frame(tmp)
+                self.frames_encoded += 1
+            cconn.need_full_status = False
+            if cconn.send_raw(frame, is_status=True):
+                self.clients_sent += 1
+            else:
+                self.frames_dropped += 1
+        self.last_query = query
+        self.last_versions = versions
         if not query:
             # Unregister timer if there are no longer any subscriptions
             reactor = self.printer.get_reactor()
@@ -495,6 +604,15 @@ class QueryStatusHelper:
             self.query_timer = None
             return reactor.NEVER
         return eventtime + SUBSCRIPTION_REFRESH_TIME
+    def stats(self, eventtime):
+        msg = "status_ticks=%d status_queried=%d status_skipped=%d" \
+              " status_sent=%d status_encoded=%d status_dropped=%d" % (
+                  self.query_ticks, self.objects_queried,
+                  self.objects_skipped, self.clients_sent,
+                  self.frames_encoded, self.frames_dropped)
+        self.query_ticks = self.objects_queried = self.objects_skipped = 0
+        self.clients_sent = self.frames_encoded = self.frames_dropped = 0
+        return False, msg
     def _handle_query(self, web_request, is_subscribe=False):
         objects = web_request.get_dict('objects')
         # Validate subscription format
@@ -512,7 +630,8 @@ class QueryStatusHelper:
             del self.clients[cconn]
         reactor = self.printer.get_reactor()
         complete = reactor.completion()
-        self.pending_queries.append((None, objects, complete.complete, {}))
+        self.pending_queries.append((None, objects, complete.complete, {},
+                                     None))
         # Start timer if needed
         if self.query_timer is None:
             qt = reactor.register_timer(self._do_query, reactor.NOW)
@@ -521,11 +640,12 @@ class QueryStatusHelper:
         msg = complete.wait()
         web_request.send(msg['params'])
         if is_subscribe:
-            self.clients[cconn] = (cconn, objects, cconn.send, template)
+            tkey = json.dumps(template, sort_keys=True)
+            self.clients[cconn] = (cconn, objects, cconn.send, template, tkey)
     def _handle_subscribe(self, web_request):
         self._handle_query(web_request, is_subscribe=True)
 
 def add_early_printer_objects(printer):
     printer.add_object('webhooks', WebHooks(printer))
     GCodeHelper(printer)
-    QueryStatusHelper(printer)
+    printer.add_object('query_status', QueryStatusHelper(printer))
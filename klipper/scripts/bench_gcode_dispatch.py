@@ -0,0 +1,108 @@
+#!/usr/bin/env python2
+# Benchmark g-code line dispatch with and without the G0/G1 fast path
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '../klippy'))
+import gcode
+from extras import gcode_move
+
+class BenchMutex:
+    def __enter__(self):
+        pass
+    def __exit__(self, type=None, value=None, tb=None):
+        pass
+
+class BenchReactor:
+    def mutex(self, is_locked=False):
+        return BenchMutex()
+
+class BenchPrinter:
+    def __init__(self):
+        self.reactor = BenchReactor()
+    def register_event_handler(self, event, callback):
+        pass
+    def get_start_args(self):
+        return {}
+    def get_reactor(self):
+        return self.reactor
+    def send_event(self, event, *params):
+        pass
+    def invoke_shutdown(self, msg):
+        raise Exception(msg)
+
+# GCodeMove with the toolhead and host responses stubbed out
+class BenchMove(gcode_move.GCodeMove):
+    def __init__(self):
+        self.absolute_coord = self.absolute_extrude = True
+        self.base_position = [0.0, 0.0, 0.0, 0.0]
+        self.last_position = [0.0, 0.0, 0.0, 0.0]
+        self.speed = 25.
+        self.speed_factor = 1. / 60.
+        self.extrude_factor = 1.
+        self.move_count = 0
+    def move_with_transform(self, newpos, speed):
+        self.move_count += 1
+    def checkFilamentState(self):
+        pass
+    def nprintf(self, msg):
+        pass
+
+def setup_dispatch(fast_path):
+    dispatch = gcode.GCodeDispatch(BenchPrinter())
+    move = BenchMove()
+    dispatch.register_command('G1', move.cmd_G1)
+    dispatch.register_command('G0', move.cmd_G1)
+    for cmd in ['M82', 'M83', 'G90', 'G91', 'G92', 'M104', 'M106', 'M107',
+                'M109', 'M140', 'M190', 'G28', 'M204', 'M205', 'T0', 'T1']:
+        dispatch.register_command(cmd, (lambda gcmd: None))
+    if fast_path:
+        dispatch.register_fast_move(move.cmd_G1, move.move_G1)
+    dispatch.respond_raw = (lambda msg: None)
+    dispatch._handle_ready()
+    return dispatch, move
+
+def run_bench(lines, fast_path, repeat):
+    best = None
+    for i in range(repeat):
+        dispatch, move = setup_dispatch(fast_path)
+        start = time.time()
+        for line in lines:
+            dispatch._process_commands([line], need_ack=False)
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return best, move
+
+def main():
+    usage = "%prog [options] <gcode file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--repeat", type="int", dest="repeat", default=3,
+                    help="number of runs (best time is reported)")
+    opts.add_option("-l", "--lines", type="int", dest="lines", default=0,
+                    help="only use the first LINES lines of the file")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    f = open(args[0], 'rb')
+    lines = [line.strip() for line in f]
+    f.close()
+    # Skip lines that virtual_sdcard would not dispatch
+    lines = [line for line in lines if line and (not line.startswith(';')
+                                                 or line.startswith(";LAYER:"))]
+    if options.lines:
+        lines = lines[:options.lines]
+    results = {}
+    for fast_path in [False, True]:
+        duration, move = run_bench(lines, fast_path, options.repeat)
+        results[fast_path] = move.last_position
+        print("%-9s %8d lines %8.3fs %10.0f lines/sec" % (
+            ["generic", "fast"][fast_path], len(lines), duration,
+            len(lines) / duration))
+    if results[False] != results[True]:
+        print("Final positions differ: %s vs %s" % (results[False],
+                                                    results[True]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python2
+# Benchmark message encoding/decoding with the generic and compiled parsers
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, random, json, types, gc
+# Use klippy/msgproto.py (and not the copy in this directory)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '../klippy'))
+import msgproto
+
+# Typical high rate messages (used when no data dictionary is given)
+SAMPLE_DICTIONARY = {
+    'commands': {
+        "queue_step oid=%c interval=%u count=%hu add=%hi": 10,
+        "set_next_step_dir oid=%c dir=%c": 11,
+        "get_clock": 12,
+        "tmcuart_send oid=%c write=%*s read=%c": 13,
+        "ghead_set_fan_speed ptr=%c fans=%u": 32,
+        "ghead_set_normal_cmd mode=%c ptr=%c h_s=%u": 58,
+    },
+    'responses': {
+        "clock clock=%u": 80,
+        "analog_in_state oid=%c next_clock=%u value=%hu": 81,
+        "stepper_position oid=%c pos=%i": 82,
+        "tmcuart_response oid=%c read=%*s": 83,
+        "ghead_temp gh_ptr=%c value=%hu clock=%u": 92,
+        "ghead_ksensor_s gh_ptr=%c sensor=%c clock=%u": 90,
+        "ghead_fanset_s gh_ptr=%c f_speed=%u clock=%u": 88,
+        "ghead_respond_s gh_ptr=%c mode=%c val=%c clock=%u": 87,
+    },
+}
+
+def random_value(t):
+    if isinstance(t, msgproto.Enumeration):
+        return random.choice(sorted(t.enums.keys()))
+    if t.is_dynamic_string:
+        return bytes(bytearray([random.randrange(256)
+                                for i in range(random.randrange(12))]))
+    bits = {5: 32, 3: 16, 2: 8}[t.max_length]
+    if t.signed:
+        return random.randrange(-(1 << (bits - 1)), 1 << (bits - 1))
+    return random.randrange(1 << bits)
+
+# Build message blocks containing randomly generated messages
+def synthesize_blocks(mp, count):
+    formats = [m for m in mp.messages_by_name.values()
+               if isinstance(m, msgproto.MessageFormat)]
+    blocks = []
+    for i in range(count):
+        mid = random.choice(formats)
+        params = [random_value(t) for t in mid.param_types]
+        cmd = msgproto.MessageFormat.encode(mid, params)
+        blocks.append(bytearray(mp.encode(i, ''.join(map(chr, cmd)))))
+    return blocks
+
+# Read message blocks from a serial port data dump (see parsedump.py)
+def read_blocks(mp, filename):
+    f = open(filename, 'rb')
+    data = f.read()
+    f.close()
+    blocks = []
+    while 1:
+        l = mp.check_packet(data)
+        if l == 0:
+            break
+        if l < 0:
+            data = data[-l:]
+            continue
+        blocks.append(bytearray(data[:l]))
+        data = data[l:]
+    return blocks
+
+# Locate each message in the blocks (as dump() would)
+def split_messages(mp, blocks):
+    msgs = []
+    for s in blocks:
+        pos = msgproto.MESSAGE_HEADER_SIZE
+        while pos < len(s) - msgproto.MESSAGE_TRAILER_SIZE:
+            mid = mp.messages_by_id.get(s[pos], mp.unknown)
+            msgs.append((mid, s, pos))
+            params, pos = mid.parse(s, pos)
+    return msgs
+
+def generic_funcs(mid):
+    if isinstance(mid, msgproto.MessageFormat):
+        return (types.MethodType(msgproto.MessageFormat.parse, mid),
+                types.MethodType(msgproto.MessageFormat.encode, mid))
+    return mid.parse, None
+
+def compiled_funcs(mid):
+    if isinstance(mid, msgproto.MessageFormat):
+        return mid.parse, mid.encode
+    return mid.parse, None
+
+def time_best(func, repeat):
+    best = None
+    for i in range(repeat):
+        # Garbage collection of the results would dominate the timing
+        gc.collect()
+        gc.disable()
+        start = time.time()
+        result = func()
+        duration = time.time() - start
+        gc.enable()
+        if best is None or duration < best:
+            best = duration
+    return best, result
+
+def run_bench(msgs, encode_msgs, repeat):
+    results = {}
+    for name, get_funcs in [("generic", generic_funcs),
+                            ("compiled", compiled_funcs)]:
+        parse_list = [(get_funcs(mid)[0], s, pos) for mid, s, pos in msgs]
+        encode_list = [(get_funcs(mid)[1], params)
+                       for mid, params in encode_msgs]
+        parse_time, parsed = time_best(
+            (lambda: [parse(s, pos) for parse, s, pos in parse_list]), repeat)
+        encode_time, encoded = time_best(
+            (lambda: [encode(params) for encode, params in encode_list]),
+            repeat)
+        print("%-9s parse %8d msgs %8.3fs %10.0f msgs/sec"
+              "   encode %8d msgs %8.3fs %10.0f msgs/sec" % (
+                  name, len(msgs), parse_time, len(msgs) / parse_time,
+                  len(encode_msgs), encode_time,
+                  len(encode_msgs) / encode_time))
+        results[name] = (parsed, encoded)
+    if results["generic"] != results["compiled"]:
+        print("Results differ between generic and compiled parsers")
+        return False
+    return True
+
+def main():
+    usage = "%prog [options] [<dictionary file> [<data dump file>]]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--repeat", type="int", dest="repeat", default=3,
+                    help="number of runs (best time is reported)")
+    opts.add_option("-c", "--count", type="int", dest="count", default=100000,
+                    help="number of messages to generate (if no dump file)")
+    opts.add_option("--seed", type="int", dest="seed", default=0,
+                    help="random seed")
+    options, args = opts.parse_args()
+    if len(args) > 2:
+        opts.error("Incorrect number of arguments")
+    random.seed(options.seed)
+    mp = msgproto.MessageParser()
+    if args:
+        f = open(args[0], 'rb')
+        dictionary = f.read()
+        f.close()
+    else:
+        dictionary = json.dumps(SAMPLE_DICTIONARY)
+    mp.process_identify(dictionary, decompress=False)
+    if len(args) > 1:
+        blocks = read_blocks(mp, args[1])
+    else:
+        blocks = synthesize_blocks(mp, options.count)
+    msgs = split_messages(mp, blocks)
+    encode_msgs = []
+    for mid, s, pos in msgs:
+        if isinstance(mid, msgproto.MessageFormat):
+            params, pos = mid.parse(s, pos)
+            encode_msgs.append((mid, [params[name]
+                                      for name, t in mid.param_names]))
+    if not msgs:
+        opts.error("No messages found")
+    if not run_bench(msgs, encode_msgs, options.repeat):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python2
+# Benchmark reactor timer dispatch with many registered timers
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, random
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '../klippy'))
+import reactor
+
+# Run 'setup' in a new reactor and count busy timer callbacks
+def run_reactor(idle_count, duration, setup):
+    r = reactor.Reactor()
+    start = r.monotonic()
+    # Registered timers that are not due during the test
+    for i in range(idle_count):
+        r.register_timer((lambda e: r.NEVER),
+                         start + duration + 1. + random.random())
+    counts = [0]
+    setup(r, counts)
+    r.register_timer((lambda e: r.end() or r.NEVER), start + duration)
+    r.run()
+    r.finalize()
+    return counts[0]
+
+# A single timer that is always due
+def setup_dispatch(r, counts):
+    def busy(eventtime):
+        counts[0] += 1
+        return r.NOW
+    r.register_timer(busy, r.NOW)
+
+# Callbacks that each register the next one (a register, dispatch
+# and unregister of a timer per callback)
+def setup_callbacks(r, counts):
+    def callback(eventtime):
+        counts[0] += 1
+        r.register_callback(callback)
+    r.register_callback(callback)
+
+# Two tasks waking each other through a completion (greenlet switches)
+def setup_completions(r, counts):
+    state = {'completion': r.completion()}
+    def waiter(eventtime):
+        while 1:
+            state['completion'].wait()
+            state['completion'] = r.completion()
+            counts[0] += 1
+    def waker(eventtime):
+        state['completion'].complete(None)
+        return r.NOW
+    r.register_callback(waiter)
+    r.register_timer(waker, r.NOW)
+
+TESTS = [("dispatch", setup_dispatch), ("callbacks", setup_callbacks),
+         ("completions", setup_completions)]
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-t", "--timers", type="string", dest="timers",
+                    default="0,10,100,1000,10000",
+                    help="comma separated counts of idle timers")
+    opts.add_option("-d", "--duration", type="float", dest="duration",
+                    default=.5, help="duration of each test (seconds)")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    random.seed(0)
+    print("%-8s %s" % ("timers", "".join(["%16s" % (name,)
+                                          for name, setup in TESTS])))
+    for idle_count in [int(c) for c in options.timers.split(',')]:
+        res = []
+        for name, setup in TESTS:
+            count = run_reactor(idle_count, options.duration, setup)
+            res.append("%13.2fus" % (options.duration * 1000000. / count,))
+        print("%-8d %s" % (idle_count, "".join(res)))
+
+if __name__ == '__main__':
+    main()
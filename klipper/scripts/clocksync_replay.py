@@ -0,0 +1,158 @@
+#!/usr/bin/env python2
+# Replay mcu clock samples through the clocksync estimators
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, re, math, random
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '../klippy'))
+import clocksync
+
+# Clock samples are logged by klippy when run with the -v option
+sample_r = re.compile(r"^(?P<prefix>.*)clock sample sent=(?P<sent>[0-9.]+)"
+                      r" receive=(?P<receive>[0-9.]+) clock=(?P<clock>[0-9]+)$")
+
+# Read (sent_time, clock) samples for each mcu from a log file
+def read_log(filename):
+    samples = {}
+    f = open(filename, 'r')
+    for line in f:
+        m = sample_r.match(line.rstrip())
+        if m is None:
+            continue
+        samples.setdefault(m.group('prefix'), []).append(
+            (float(m.group('sent')), int(m.group('clock'))))
+    f.close()
+    return samples
+
+# Approximate the mcu frequency from the first and last samples
+def estimate_freq(samples):
+    (first_time, first_clock), (last_time, last_clock) = samples[0], samples[-1]
+    if last_time <= first_time:
+        return 1.
+    return (last_clock - first_clock) / (last_time - first_time)
+
+# Generate samples from a drifting clock with transmit jitter and
+# occasional transmit delays (which make the mcu clock appear early)
+class SimClock:
+    def __init__(self, freq, drift, jitter, spike_rate, spike_time):
+        self.freq = freq
+        self.drift = drift
+        self.jitter = jitter
+        self.spike_rate = spike_rate
+        self.spike_time = spike_time
+    def true_clock(self, systime):
+        # Frequency drifts linearly (in parts per million per hour)
+        drift = self.drift * 1e-6 / 3600.
+        return self.freq * (systime + .5 * drift * systime**2)
+    def sample(self, systime):
+        delay = abs(random.gauss(0., self.jitter))
+        if random.random() < self.spike_rate:
+            delay += random.uniform(.5, 1.) * self.spike_time
+        return int(self.true_clock(systime + delay))
+
+def replay(est_class, samples, freq, sim=None, duration=0.):
+    est = est_class(freq)
+    residuals = []
+    truth_errors = []
+    margins = []
+    rejected = resets = 0
+    def handle(sent_time, clock, first):
+        if first:
+            est.reset(sent_time, clock)
+            return "accept"
+        diff = clock - est.predict(sent_time)
+        status = est.update(sent_time, clock)
+        if status == "reject":
+            return status
+        residuals.append(diff / freq)
+        if sim is not None:
+            truth_errors.append(
+                (est.predict(sent_time) - sim.true_clock(sent_time)) / freq)
+        margins.append(3. * est.get_estimate()[3] / freq)
+        return status
+    if sim is None:
+        for i, (sent_time, clock) in enumerate(samples):
+            status = handle(sent_time, clock, i == 0)
+            rejected += status == "reject"
+            resets += status == "reset"
+        count = len(samples)
+    else:
+        random.seed(0)
+        systime = 1.
+        count = 0
+        while systime < duration:
+            status = handle(systime, sim.sample(systime), count == 0)
+            rejected += status == "reject"
+            resets += status == "reset"
+            count += 1
+            systime += est.get_query_time()
+    return {'samples': count, 'rejected': rejected, 'resets': resets,
+            'residuals': residuals, 'truth_errors': truth_errors,
+            'margins': margins}
+
+def summarize(values):
+    if not values:
+        return 0., 0., 0.
+    values = sorted([abs(v) for v in values])
+    rms = math.sqrt(sum([v**2 for v in values]) / len(values))
+    p99 = values[min(len(values) - 1, int(len(values) * .99))]
+    return rms, p99, values[-1]
+
+def report(name, result):
+    rms, p99, peak = summarize(result['residuals'])
+    margin = 0.
+    if result['margins']:
+        margin = sum(result['margins']) / len(result['margins'])
+    msg = ("%-6s samples=%-6d rejected=%-4d resets=%-3d"
+           " resid rms=%8.1fus p99=%8.1fus max=%8.1fus margin=%8.1fus" % (
+               name, result['samples'], result['rejected'], result['resets'],
+               rms * 1e6, p99 * 1e6, peak * 1e6, margin * 1e6))
+    if result['truth_errors']:
+        rms, p99, peak = summarize(result['truth_errors'])
+        msg += " true err rms=%6.1fus max=%6.1fus" % (rms * 1e6, peak * 1e6)
+    print(msg)
+
+def main():
+    usage = "%prog [options] [<klippy.log>]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-f", "--freq", type="float", dest="freq",
+                    help="mcu clock frequency (default is estimated from"
+                    " the samples or 72000000 with --simulate)")
+    opts.add_option("--simulate", action="store_true", dest="simulate",
+                    help="replay a synthetic clock instead of a log file")
+    opts.add_option("--duration", type="float", dest="duration",
+                    default=3600., help="simulated time (seconds)")
+    opts.add_option("--drift", type="float", dest="drift", default=5.,
+                    help="simulated drift (ppm per hour)")
+    opts.add_option("--jitter", type="float", dest="jitter", default=.00005,
+                    help="simulated transmit jitter (seconds)")
+    opts.add_option("--spike-rate", type="float", dest="spike_rate",
+                    default=.02, help="probability of a delayed sample")
+    opts.add_option("--spike-time", type="float", dest="spike_time",
+                    default=.005, help="maximum transmit delay (seconds)")
+    options, args = opts.parse_args()
+    names = sorted(clocksync.ESTIMATORS.keys())
+    if options.simulate:
+        if args:
+            opts.error("Log file not used with --simulate")
+        freq = options.freq or 72000000.
+        sim = SimClock(freq, options.drift, options.jitter,
+                       options.spike_rate, options.spike_time)
+        for name in names:
+            report(name, replay(clocksync.ESTIMATORS[name], None, freq,
+                                sim, options.duration))
+        return
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    all_samples = read_log(args[0])
+    if not all_samples:
+        opts.error("No clock samples found (was klippy run with -v?)")
+    for prefix, samples in sorted(all_samples.items()):
+        freq = options.freq or estimate_freq(samples)
+        print("%s%d samples freq=%.0f" % (prefix or "mcu: ", len(samples),
+                                          freq))
+        for name in names:
+            report(name, replay(clocksync.ESTIMATORS[name], samples, freq))
+
+if __name__ == '__main__':
+    main()
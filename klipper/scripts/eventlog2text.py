@@ -0,0 +1,25 @@
+#!/usr/bin/env python2
+# Convert a binary klippy event log to the text log format
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '../klippy'))
+import queuelogger
+
+def main():
+    usage = "%prog [options] <eventlog> [<output>]"
+    opts = optparse.OptionParser(usage)
+    options, args = opts.parse_args()
+    if len(args) not in (1, 2):
+        opts.error("Incorrect number of arguments")
+    out = sys.stdout
+    if len(args) == 2:
+        out = open(args[1], 'wb')
+    time_formatter = queuelogger.LogTimeFormatter()
+    for created, levelno, msg in queuelogger.read_event_log(args[0]):
+        out.write("%s%s\n" % (time_formatter.format(created), msg))
+    out.close()
+
+if __name__ == '__main__':
+    main()
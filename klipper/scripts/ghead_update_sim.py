@@ -0,0 +1,148 @@
+#!/usr/bin/env python2
+# Run the ghead firmware transfer against a simulated tool head
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, random, heapq
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '../klippy'))
+import ghead_update
+
+# Minimal reactor with a simulated clock
+class SimTimer:
+    def __init__(self, callback, waketime):
+        self.callback = callback
+        self.waketime = waketime
+
+class SimReactor:
+    NOW = 0.
+    NEVER = 9999999999999999.
+    def __init__(self):
+        self.curtime = 0.
+        self.timers = []
+        self.events = []
+        self.event_seq = 0
+    def monotonic(self):
+        return self.curtime
+    def register_timer(self, callback, waketime=NEVER):
+        timer = SimTimer(callback, waketime)
+        self.timers.append(timer)
+        return timer
+    def unregister_timer(self, timer):
+        timer.waketime = self.NEVER
+        if timer in self.timers:
+            self.timers.remove(timer)
+    def update_timer(self, timer, waketime):
+        timer.waketime = waketime
+    def schedule(self, waketime, callback, *args):
+        self.event_seq += 1
+        heapq.heappush(self.events, (waketime, self.event_seq, callback, args))
+    def run(self, max_time):
+        while self.curtime < max_time:
+            next_time = max_time
+            if self.events:
+                next_time = min(next_time, self.events[0][0])
+            for t in self.timers:
+                next_time = min(next_time, t.waketime)
+            self.curtime = next_time
+            for t in list(self.timers):
+                if t.waketime <= self.curtime:
+                    t.waketime = t.callback(self.curtime)
+            while self.events and self.events[0][0] <= self.curtime:
+                waketime, seq, callback, args = heapq.heappop(self.events)
+                callback(*args)
+            if not self.events and not [t for t in self.timers
+                                        if t.waketime < self.NEVER]:
+                break
+
+# Tool head that requests the next missing packet after each reception.
+# Packets are addressed by (main_ptr, sub_ptr) as on the real tool head.
+class SimGhead:
+    def __init__(self, reactor, packet_count, packet_size, latency, loss):
+        self.reactor = reactor
+        self.packet_count = packet_count
+        self.image = bytearray(packet_count * packet_size)
+        self.packet_size = packet_size
+        self.latency = latency
+        self.loss = loss
+        self.received = set()
+        self.expected = (0, 0)
+        self.transfer = None
+        self.link_times = [0., 0.]
+    def _link(self, direction, callback, *args):
+        # Messages may be lost, but the serial link does not reorder them
+        if random.random() < self.loss:
+            return
+        delay = self.latency * (1. + .5 * random.random())
+        waketime = max(self.reactor.monotonic() + delay,
+                       self.link_times[direction])
+        self.link_times[direction] = waketime
+        self.reactor.schedule(waketime, callback, *args)
+    def request(self, main_ptr, sub_ptr):
+        self._link(0, self._deliver_request, (main_ptr << 8) | sub_ptr)
+    def _deliver_request(self, val):
+        # Move board side of a 'ZH' response
+        self.transfer.handle_request(ghead_update.request_index(val),
+                                     self.reactor.monotonic())
+    def send_packets(self, packets):
+        for index, data in packets:
+            main_ptr, sub_ptr = ghead_update.packet_address(index)
+            self._link(1, self._receive, main_ptr, sub_ptr,
+                       bytes(bytearray(data)))
+    def _receive(self, main_ptr, sub_ptr, data):
+        pos = main_ptr * ghead_update.BLOCK_SIZE + sub_ptr * self.packet_size
+        self.image[pos:pos + len(data)] = data
+        self.received.add((main_ptr, sub_ptr))
+        main_ptr, sub_ptr = self.expected
+        while (main_ptr, sub_ptr) in self.received:
+            sub_ptr += 1
+            if sub_ptr >= ghead_update.BLOCK_PACKETS:
+                main_ptr, sub_ptr = main_ptr + 1, 0
+        self.expected = (main_ptr, sub_ptr)
+        self.request(main_ptr, sub_ptr)
+
+def run_transfer(image, window, latency, loss, seed):
+    random.seed(seed)
+    reactor = SimReactor()
+    packet_size = ghead_update.PACKET_SIZE
+    ghead = SimGhead(reactor, len(image) // packet_size, packet_size,
+                     latency, loss)
+    transfer = ghead_update.FirmwareTransfer(reactor, image,
+                                             ghead.send_packets, window)
+    ghead.transfer = transfer
+    ghead.request(0, 0)
+    reactor.run(3600.)
+    stats = transfer.get_stats(reactor.monotonic())
+    stats['verified'] = ghead.image == image
+    return stats
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-s", "--size", type="int", dest="size", default=32768,
+                    help="firmware image size in bytes")
+    opts.add_option("-l", "--latency", type="float", dest="latency",
+                    default=.005, help="one way link latency (seconds)")
+    opts.add_option("-p", "--loss", type="float", dest="loss", default=.01,
+                    help="probability of losing a message")
+    opts.add_option("-w", "--windows", type="string", dest="windows",
+                    default="1,2,4,8", help="comma separated window sizes")
+    opts.add_option("--seed", type="int", dest="seed", default=0,
+                    help="random seed")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    random.seed(options.seed)
+    image = bytearray([random.randrange(256) for i in range(options.size)])
+    image += bytearray(-len(image) % ghead_update.BLOCK_SIZE)
+    for window in [int(w) for w in options.windows.split(',')]:
+        stats = run_transfer(image, window, options.latency, options.loss,
+                             options.seed)
+        print("window=%-3d %-8s %6d packets sent=%-6d retransmits=%-5d"
+              " timeouts=%-5d %8.3fs %9.1f bytes/s %s" % (
+                  window, stats['state'], stats['packets'], stats['sent'],
+                  stats['retransmits'], stats['timeouts'], stats['elapsed'],
+                  stats['throughput'],
+                  ["image MISMATCH", "image ok"][stats['verified']]))
+
+if __name__ == '__main__':
+    main()
@@ -5,7 +5,8 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import optparse, datetime
-import matplotlib
+import matplotlib, numpy as np
+import logindex
 
 MAXBANDWIDTH=25000.
 MAXBUFFER=2.
@@ -18,37 +19,40 @@ APPLY_PREFIX = [
     'target', 'temp', 'pwm'
 ]
 
-def parse_log(logname, mcu):
+# Return a dictionary mapping each stat name to an array of its values
+# (NaN where a sample does not report the stat)
+def parse_log(lognames, mcu):
     if mcu is None:
         mcu = "mcu"
     mcu_prefix = mcu + ":"
     apply_prefix = { p: 1 for p in APPLY_PREFIX }
-    f = open(logname, 'r')
-    out = []
-    for line in f:
-        parts = line.split()
-        if not parts or parts[0] not in ('Stats', 'INFO:root:Stats'):
-            #if parts and parts[0] == 'INFO:root:shutdown:':
-            #    break
-            continue
-        prefix = ""
-        keyparts = {}
-        for p in parts[2:]:
-            if '=' not in p:
-                prefix = p
-                if prefix == mcu_prefix:
-                    prefix = ''
-                continue
-            name, val = p.split('=', 1)
-            if name in apply_prefix:
-                name = prefix + name
-            keyparts[name] = val
-        if 'print_time' not in keyparts:
-            continue
-        keyparts['#sampletime'] = float(parts[1][:-1])
-        out.append(keyparts)
-    f.close()
-    return out
+    index = logindex.LogIndex(lognames)
+    sampletimes, stats, columns = index.get_stats()
+    data = {}
+    for col, key in enumerate(columns):
+        pos = key.rfind(':') + 1
+        prefix, name = key[:pos], key[pos:]
+        if name in apply_prefix and prefix != mcu_prefix:
+            name = prefix + name
+        values = stats[:, col]
+        if name in data:
+            values = np.where(np.isnan(values), data[name], values)
+        data[name] = values
+    if 'print_time' not in data:
+        return {}
+    valid = ~np.isnan(data['print_time'])
+    data = { name: values[valid] for name, values in data.items() }
+    data['#sampletime'] = sampletimes[valid]
+    if not len(data['#sampletime']):
+        return {}
+    return data
+
+# Return the values of a stat with missing samples set to a default
+def get_values(data, name, default=0.):
+    values = data.get(name)
+    if values is None:
+        return [default] * len(data['#sampletime'])
+    return np.where(np.isnan(values), default, values).tolist()
 
 def setup_matplotlib(output_to_file):
     global matplotlib
@@ -61,10 +65,10 @@ def find_print_restarts(data):
     runoff_samples = {}
     last_runoff_start = last_buffer_time = last_sampletime = 0.
     last_print_stall = 0
-    for d in reversed(data):
+    for sampletime, buffer_time, print_stall in reversed(zip(
+            data['#sampletime'].tolist(), get_values(data, 'buffer_time'),
+            get_values(data, 'print_stall'))):
         # Check for buffer runoff
-        sampletime = d['#sampletime']
-        buffer_time = float(d.get('buffer_time', 0.))
         if (last_runoff_start and last_sampletime - sampletime < 5
             and buffer_time > last_buffer_time):
             runoff_samples[last_runoff_start][1].append(sampletime)
@@ -76,7 +80,6 @@ def find_print_restarts(data):
         last_buffer_time = buffer_time
         last_sampletime = sampletime
         # Check for print stall
-        print_stall = int(d['print_stall'])
         if print_stall < last_print_stall:
             if last_runoff_start:
                 runoff_samples[last_runoff_start][0] = True
@@ -87,28 +90,30 @@ def find_print_restarts(data):
 
 def plot_mcu(data, maxbw):
     # Generate data for plot
-    basetime = lasttime = data[0]['#sampletime']
-    lastbw = float(data[0]['bytes_write']) + float(data[0]['bytes_retransmit'])
+    sampletimes = data['#sampletime'].tolist()
+    bws = (np.array(get_values(data, 'bytes_write'))
+           + get_values(data, 'bytes_retransmit')).tolist()
+    task_loads = (np.array(get_values(data, 'mcu_task_avg'))
+                  + 3. * np.array(get_values(data, 'mcu_task_stddev'))).tolist()
+    basetime = lasttime = sampletimes[0]
+    lastbw = bws[0]
     sample_resets = find_print_restarts(data)
     times = []
     bwdeltas = []
     loads = []
     awake = []
     hostbuffers = []
-    for d in data:
-        st = d['#sampletime']
+    for st, bw, load, hb, mcu_awake in zip(
+            sampletimes, bws, task_loads, get_values(data, 'buffer_time'),
+            get_values(data, 'mcu_awake')):
         timedelta = st - lasttime
         if timedelta <= 0.:
             continue
-        bw = float(d['bytes_write']) + float(d['bytes_retransmit'])
         if bw < lastbw:
             lastbw = bw
             continue
-        load = float(d['mcu_task_avg']) + 3*float(d['mcu_task_stddev'])
         if st - basetime < 15.:
             load = 0.
-        pt = float(d['print_time'])
-        hb = float(d['buffer_time'])
         if hb >= MAXBUFFER or st in sample_resets:
             hb = 0.
         else:
@@ -117,7 +122,7 @@ def plot_mcu(data, maxbw):
         times.append(datetime.datetime.utcfromtimestamp(st))
         bwdeltas.append(100. * (bw - lastbw) / (maxbw * timedelta))
         loads.append(100. * load / TASK_MAX)
-        awake.append(100. * float(d.get('mcu_awake', 0.)) / STATS_INTERVAL)
+        awake.append(100. * mcu_awake / STATS_INTERVAL)
         lasttime = st
         lastbw = bw
 
@@ -139,25 +144,27 @@ def plot_mcu(data, maxbw):
 
 def plot_system(data):
     # Generate data for plot
-    lasttime = data[0]['#sampletime']
-    lastcputime = float(data[0]['cputime'])
+    sampletimes = data['#sampletime'].tolist()
+    cputimes = get_values(data, 'cputime')
+    lasttime = sampletimes[0]
+    lastcputime = cputimes[0]
     times = []
     sysloads = []
-    cputimes = []
+    cpudeltas = []
     memavails = []
-    for d in data:
-        st = d['#sampletime']
+    for st, cputime, sysload, memavail in zip(
+            sampletimes, cputimes, get_values(data, 'sysload'),
+            get_values(data, 'memavail')):
         timedelta = st - lasttime
         if timedelta <= 0.:
             continue
         lasttime = st
         times.append(datetime.datetime.utcfromtimestamp(st))
-        cputime = float(d['cputime'])
         cpudelta = max(0., min(1.5, (cputime - lastcputime) / timedelta))
         lastcputime = cputime
-        cputimes.append(cpudelta * 100.)
-        sysloads.append(float(d['sysload']) * 100.)
-        memavails.append(float(d['memavail']))
+        cpudeltas.append(cpudelta * 100.)
+        sysloads.append(sysload * 100.)
+        memavails.append(memavail)
 
     # Build plot
     fig, ax1 = matplotlib.pyplot.subplots()
@@ -166,7 +173,7 @@ def plot_system(data):
     ax1.set_ylabel('Load (% of a core)')
     ax1.plot_date(times, sysloads, '-', label='system load',
                   color='cyan', alpha=0.8)
-    ax1.plot_date(times, cputimes, '-', label='process time',
+    ax1.plot_date(times, cpudeltas, '-', label='process time',
                   color='red', alpha=0.8)
     ax2 = ax1.twinx()
     ax2.set_ylabel('Available memory (KB)')
@@ -180,20 +187,17 @@ def plot_system(data):
     return fig
 
 def plot_frequency(data, mcu):
-    all_keys = {}
-    for d in data:
-        all_keys.update(d)
     one_mcu = mcu is not None
-    graph_keys = { key: ([], []) for key in all_keys
-                   if (key in ("freq", "adj") or (not one_mcu and (
-                           key.endswith(":freq") or key.endswith(":adj")))) }
-    for d in data:
-        st = datetime.datetime.utcfromtimestamp(d['#sampletime'])
-        for key, (times, values) in graph_keys.items():
-            val = d.get(key)
-            if val not in (None, '0', '1'):
-                times.append(st)
-                values.append(float(val))
+    graph_keys = {}
+    for key in data:
+        if not (key in ("freq", "adj") or (not one_mcu and (
+                key.endswith(":freq") or key.endswith(":adj")))):
+            continue
+        values = data[key]
+        valid = ~(np.isnan(values) | (values == 0.) | (values == 1.))
+        times = [datetime.datetime.utcfromtimestamp(st)
+                 for st in data['#sampletime'][valid].tolist()]
+        graph_keys[key] = (times, values[valid].tolist())
 
     # Build plot
     fig, ax1 = matplotlib.pyplot.subplots()
@@ -222,18 +226,15 @@ def plot_temperature(data, heaters):
         temp_key = heater + ':' + 'temp'
         target_key = heater + ':' + 'target'
         pwm_key = heater + ':' + 'pwm'
-        times = []
-        temps = []
-        targets = []
-        pwm = []
-        for d in data:
-            temp = d.get(temp_key)
-            if temp is None:
-                continue
-            times.append(datetime.datetime.utcfromtimestamp(d['#sampletime']))
-            temps.append(float(temp))
-            pwm.append(float(d.get(pwm_key, 0.)))
-            targets.append(float(d.get(target_key, 0.)))
+        temps = data.get(temp_key)
+        if temps is None:
+            temps = np.full(len(data['#sampletime']), np.nan)
+        valid = ~np.isnan(temps)
+        times = [datetime.datetime.utcfromtimestamp(st)
+                 for st in data['#sampletime'][valid].tolist()]
+        temps = temps[valid].tolist()
+        targets = np.array(get_values(data, target_key))[valid].tolist()
+        pwm = np.array(get_values(data, pwm_key))[valid].tolist()
         ax1.plot_date(times, temps, '-', label='%s temp' % (heater,), alpha=0.8)
         if any(targets):
             label = '%s target' % (heater,)
@@ -255,7 +256,7 @@ def plot_temperature(data, heaters):
 
 def main():
     # Parse command-line arguments
-    usage = "%prog [options] <logfile>"
+    usage = "%prog [options] <logfile> [<logfile> ...]"
     opts = optparse.OptionParser(usage)
     opts.add_option("-f", "--frequency", action="store_true",
                     help="graph mcu frequency")
@@ -268,12 +269,11 @@ def main():
     opts.add_option("-m", "--mcu", type="string", dest="mcu", default=None,
                     help="limit stats to the given mcu")
     options, args = opts.parse_args()
-    if len(args) != 1:
+    if not args:
         opts.error("Incorrect number of arguments")
-    logname = args[0]
 
-    # Parse data
-    data = parse_log(logname, options.mcu)
+    # Parse data (rotated logs are joined in order)
+    data = parse_log(args, options.mcu)
     if not data:
         return
 
@@ -4,7 +4,15 @@
 # Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import sys, re, collections, ast
+import sys, os, re, collections, ast
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '../klippy'))
+import queuelogger
+try:
+    import logindex
+except ImportError:
+    # numpy is not available - scan the full log text instead
+    logindex = None
 
 def format_comment(line_num, line):
     return "# %6d: %s" % (line_num, line)
@@ -409,15 +417,13 @@ class GatherShutdown:
 # Startup
 ######################################################################
 
-def main():
-    logname = sys.argv[1]
+# Scan every line of a log for config and shutdown sections
+def parse_log(logname, configs):
     last_git = last_start = None
-    configs = {}
     handler = None
     recent_lines = collections.deque([], 200)
-    # Parse log file
-    f = open(logname, 'rb')
-    for line_num, line in enumerate(f):
+    # Parse log file (text log or binary event log)
+    for line_num, line in enumerate(queuelogger.log_lines(logname)):
         line = line.rstrip()
         line_num += 1
         recent_lines.append((line_num, line))
@@ -441,6 +447,51 @@ def main():
             handler.add_comment(last_start)
     if handler is not None:
         handler.finalize()
+
+# Process the config and shutdown sections found by the log index
+# (only the lines near those sections are read from the log)
+def parse_indexed_log(logfile, configs):
+    logname = logfile.logname
+    last_git = last_start = None
+    next_line = clear_line = 1
+    for kind, line_num, line in logfile.get_sections():
+        if line_num < next_line:
+            # Already processed by the previous handler
+            continue
+        if kind == 'git':
+            last_git = format_comment(line_num, line)
+            continue
+        elif kind == 'start':
+            last_start = format_comment(line_num, line)
+            continue
+        elif kind not in ('config', 'shutdown'):
+            continue
+        first_line = max(clear_line, line_num - 199)
+        lines = logfile.read_lines(first_line)
+        recent_lines = [next(lines) for i in range(line_num + 1 - first_line)]
+        if kind == 'config':
+            handler = GatherConfig(configs, line_num, recent_lines, logname)
+        else:
+            handler = GatherShutdown(configs, line_num, recent_lines, logname)
+        handler.add_comment(last_git)
+        handler.add_comment(last_start)
+        for line_num, line in lines:
+            if not handler.add_line(line_num, line):
+                break
+        else:
+            handler.finalize()
+            return
+        next_line = line_num
+        clear_line = line_num + 1
+
+def main():
+    lognames = sys.argv[1:]
+    configs = {}
+    for logname in queuelogger.order_logs(lognames):
+        if logindex is None or queuelogger.is_event_log(logname):
+            parse_log(logname, configs)
+        else:
+            parse_indexed_log(logindex.LogFileIndex(logname), configs)
     # Write found config files
     for cfg in configs.values():
         cfg.write_file()
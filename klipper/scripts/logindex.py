@@ -0,0 +1,335 @@
+#!/usr/bin/env python2
+# Build and query a cache of the stats and sections of klippy log files
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, re, optparse, array
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '../klippy'))
+import queuelogger
+
+INDEX_VERSION = 1
+# A byte offset is recorded for every LINE_CHECKPOINT lines of a text log
+LINE_CHECKPOINT = 256
+# Length of the start of the log used to detect a replaced log file
+HEAD_SIZE = 256
+
+value_r = re.compile(r"=(\S*)")
+
+SECTION_KINDS = ['git', 'start', 'config', 'shutdown', 'rollover']
+SECTION_IDS = {k: i for i, k in enumerate(SECTION_KINDS)}
+
+# Determine the type of section a log line starts (if any)
+def classify_line(line):
+    if line.startswith('Git version'):
+        return 'git'
+    if line.startswith('Start printer at'):
+        return 'start'
+    if line == '===== Config file =====':
+        return 'config'
+    if 'shutdown: ' in line or line.startswith('Dumping '):
+        return 'shutdown'
+    if line.startswith('=============== Log rollover at'):
+        return 'rollover'
+    return None
+
+# Convert a (possibly empty) array.array to a numpy array
+def to_numpy(data, dtype):
+    if not len(data):
+        return np.zeros(0, dtype)
+    return np.frombuffer(data, dtype=dtype).copy()
+
+
+######################################################################
+# Index creation
+######################################################################
+
+class IndexBuilder:
+    def __init__(self, line_num=0):
+        self.line_num = line_num
+        self.column_ids = {}
+        self.columns = []
+        self.layouts = {}
+        self.stats_time = array.array('d')
+        self.stat_rows = array.array('l')
+        self.stat_cols = array.array('l')
+        self.stat_vals = array.array('d')
+        self.section_kinds = array.array('b')
+        self.section_lines = array.array('l')
+        self.section_text = []
+        self.checkpoints = array.array('l')
+    def add_line(self, line, offset):
+        line_num = self.line_num = self.line_num + 1
+        if offset >= 0 and not (line_num - 1) % LINE_CHECKPOINT:
+            self.checkpoints.append(offset)
+        if line.startswith('Stats ') or line.startswith('INFO:root:Stats '):
+            self._add_stats(line)
+        kind = classify_line(line)
+        if kind is not None:
+            self.section_kinds.append(SECTION_IDS[kind])
+            self.section_lines.append(line_num)
+            self.section_text.append(line)
+    def _add_stats(self, line):
+        parts = line.split(None, 2)
+        try:
+            sampletime = float(parts[1][:-1])
+        except (IndexError, ValueError):
+            return
+        row = len(self.stats_time)
+        self.stats_time.append(sampletime)
+        if len(parts) < 3:
+            return
+        # Stats lines nearly always have the same fields, so the
+        # column ids are cached by the line layout (the line without
+        # its values)
+        fields = parts[2]
+        split_fields = value_r.split(fields)
+        layout = '='.join(split_fields[::2])
+        cols = self.layouts.get(layout)
+        if cols is None:
+            cols = self.layouts[layout] = self._parse_layout(layout)
+        try:
+            vals = array.array('d', map(float, split_fields[1::2]))
+        except ValueError:
+            self._add_fields(row, fields)
+            return
+        self.stat_rows.extend(array.array('l', [row]) * len(cols))
+        self.stat_cols.extend(cols)
+        self.stat_vals.extend(vals)
+    def _get_column(self, key):
+        col = self.column_ids.get(key)
+        if col is None:
+            col = self.column_ids[key] = len(self.columns)
+            self.columns.append(key)
+        return col
+    def _parse_layout(self, layout):
+        cols = array.array('l')
+        prefix = ""
+        for p in layout.split():
+            if '=' not in p:
+                prefix = p
+                continue
+            cols.append(self._get_column(prefix + p.split('=', 1)[0]))
+        return cols
+    def _add_fields(self, row, fields):
+        # Slow path for lines with values that are not numbers
+        prefix = ""
+        for p in fields.split():
+            if '=' not in p:
+                prefix = p
+                continue
+            name, val = p.split('=', 1)
+            try:
+                val = float(val)
+            except ValueError:
+                continue
+            self.stat_rows.append(row)
+            self.stat_cols.append(self._get_column(prefix + name))
+            self.stat_vals.append(val)
+    def get_stats(self):
+        stats = np.full((len(self.stats_time), len(self.columns)), np.nan)
+        rows = to_numpy(self.stat_rows, np.int_)
+        cols = to_numpy(self.stat_cols, np.int_)
+        stats[rows, cols] = to_numpy(self.stat_vals, np.float64)
+        return to_numpy(self.stats_time, np.float64), stats
+
+
+######################################################################
+# Log file index
+######################################################################
+
+# Join stats tables that may have different columns
+def join_stats(tables):
+    if len(tables) == 1:
+        return tables[0]
+    columns = []
+    column_ids = {}
+    for times, stats, cols in tables:
+        for col in cols:
+            if col not in column_ids:
+                column_ids[col] = len(columns)
+                columns.append(col)
+    size = sum([len(times) for times, stats, cols in tables])
+    out_times = np.empty(size)
+    out_stats = np.full((size, len(columns)), np.nan)
+    pos = 0
+    for times, stats, cols in tables:
+        count = len(times)
+        out_times[pos:pos+count] = times
+        out_stats[pos:pos+count, [column_ids[c] for c in cols]] = stats
+        pos += count
+    return out_times, out_stats, columns
+
+class LogFileIndex:
+    def __init__(self, logname, rebuild=False):
+        self.logname = logname
+        self.cachename = logname + ".idx.npz"
+        self.is_event_log = queuelogger.is_event_log(logname)
+        st = os.stat(logname)
+        self.size, self.mtime = st.st_size, st.st_mtime
+        f = open(logname, 'rb')
+        self.head = f.read(HEAD_SIZE)
+        f.close()
+        cache = None
+        if not rebuild:
+            cache = self._load_cache()
+        if cache is None:
+            self._build(IndexBuilder(), 0)
+        elif cache['size'] == self.size and cache['mtime'] == self.mtime:
+            self._set_cache(cache)
+            return
+        elif (not self.is_event_log and cache['head'] == self.head[:len(
+                cache['head'])] and cache['end_offset'] <= self.size):
+            # Log was appended to - only index the new lines
+            self._set_cache(cache)
+            self._build(IndexBuilder(self.num_lines), self.end_offset, True)
+        else:
+            self._build(IndexBuilder(), 0)
+        self._save_cache()
+    def _load_cache(self):
+        try:
+            data = np.load(self.cachename)
+            cache = {k: data[k] for k in data.files}
+            data.close()
+        except Exception:
+            return None
+        if (int(cache.get('version', -1)) != INDEX_VERSION
+            or bool(cache['is_event_log']) != self.is_event_log):
+            return None
+        for k in ['size', 'end_offset', 'num_lines']:
+            cache[k] = int(cache[k])
+        cache['mtime'] = float(cache['mtime'])
+        cache['head'] = str(cache['head'])
+        return cache
+    def _set_cache(self, cache):
+        self.end_offset = cache['end_offset']
+        self.num_lines = cache['num_lines']
+        self.stats_time = cache['stats_time']
+        self.stats = cache['stats']
+        self.columns = [str(c) for c in cache['columns']]
+        self.section_kinds = cache['section_kinds']
+        self.section_lines = cache['section_lines']
+        self.section_text = [str(t) for t in cache['section_text']]
+        self.checkpoints = cache['checkpoints']
+    def _save_cache(self):
+        tmpname = self.cachename[:-4] + ".tmp.npz"
+        try:
+            np.savez(tmpname, version=INDEX_VERSION,
+                     is_event_log=self.is_event_log, size=self.size,
+                     mtime=self.mtime, head=self.head[:self.end_offset],
+                     end_offset=self.end_offset, num_lines=self.num_lines,
+                     stats_time=self.stats_time, stats=self.stats,
+                     columns=np.array(self.columns, dtype=np.str_),
+                     section_kinds=self.section_kinds,
+                     section_lines=self.section_lines,
+                     section_text=np.array(self.section_text, dtype=np.str_),
+                     checkpoints=self.checkpoints)
+            os.rename(tmpname, self.cachename)
+        except (IOError, OSError):
+            # Unable to write the cache (eg, read-only log directory)
+            pass
+    def _build(self, builder, offset, append=False):
+        if self.is_event_log:
+            for line in queuelogger.log_lines(self.logname):
+                builder.add_line(line.rstrip(), -1)
+            offset = self.size
+        else:
+            f = open(self.logname, 'rb')
+            f.seek(offset)
+            strip_time_prefix = queuelogger.strip_time_prefix
+            for raw_line in f:
+                if not raw_line.endswith('\n'):
+                    # Incomplete final line (log still being written)
+                    break
+                line = strip_time_prefix(raw_line.rstrip('\r\n')).rstrip()
+                builder.add_line(line, offset)
+                offset += len(raw_line)
+            f.close()
+        stats_time, stats = builder.get_stats()
+        section_kinds = to_numpy(builder.section_kinds, np.int8)
+        section_lines = to_numpy(builder.section_lines, np.int_)
+        checkpoints = to_numpy(builder.checkpoints, np.int_)
+        if append:
+            # Append to the existing index
+            stats_time, stats, columns = join_stats([
+                (self.stats_time, self.stats, self.columns),
+                (stats_time, stats, builder.columns)])
+            self.stats_time, self.stats, self.columns = (
+                stats_time, stats, columns)
+            self.section_kinds = np.concatenate([self.section_kinds,
+                                                 section_kinds])
+            self.section_lines = np.concatenate([self.section_lines,
+                                                 section_lines])
+            self.section_text = self.section_text + builder.section_text
+            self.checkpoints = np.concatenate([self.checkpoints, checkpoints])
+        else:
+            self.stats_time, self.stats = stats_time, stats
+            self.columns = builder.columns
+            self.section_kinds = section_kinds
+            self.section_lines = section_lines
+            self.section_text = builder.section_text
+            self.checkpoints = checkpoints
+        self.num_lines = builder.line_num
+        self.end_offset = offset
+    # Queries
+    def get_stats(self):
+        return self.stats_time, self.stats, self.columns
+    def get_sections(self):
+        return [(SECTION_KINDS[k], int(l), t) for k, l, t in zip(
+            self.section_kinds, self.section_lines, self.section_text)]
+    def read_lines(self, first_line=1):
+        # Generate (line_num, line) starting at the given line
+        if self.is_event_log:
+            for line_num, line in enumerate(
+                    queuelogger.log_lines(self.logname), 1):
+                if line_num >= first_line:
+                    yield line_num, line.rstrip()
+            return
+        checkpoint = min((first_line - 1) // LINE_CHECKPOINT,
+                         len(self.checkpoints) - 1)
+        if checkpoint < 0:
+            return
+        line_num = checkpoint * LINE_CHECKPOINT
+        f = open(self.logname, 'rb')
+        f.seek(self.checkpoints[checkpoint])
+        for raw_line in f:
+            line_num += 1
+            if line_num >= first_line:
+                yield line_num, queuelogger.strip_time_prefix(
+                    raw_line.rstrip('\r\n')).rstrip()
+        f.close()
+
+# Index of several (rotated) log files
+class LogIndex:
+    def __init__(self, lognames, rebuild=False):
+        self.files = [LogFileIndex(logname, rebuild)
+                      for logname in queuelogger.order_logs(lognames)]
+    def get_stats(self):
+        return join_stats([f.get_stats() for f in self.files])
+
+
+######################################################################
+# Startup
+######################################################################
+
+def main():
+    usage = "%prog [options] <logfile> [<logfile> ...]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-r", "--rebuild", action="store_true",
+                    help="rebuild the index instead of using the cache")
+    opts.add_option("-s", "--sections", action="store_true",
+                    help="list the sections found in the logs")
+    options, args = opts.parse_args()
+    if not args:
+        opts.error("Incorrect number of arguments")
+    index = LogIndex(args, options.rebuild)
+    for f in index.files:
+        print("%s: %d lines, %d stats samples (%d fields), %d sections" % (
+            f.logname, f.num_lines, len(f.stats_time), len(f.columns),
+            len(f.section_lines)))
+        if options.sections:
+            for kind, line_num, text in f.get_sections():
+                print("  %8d %-8s %s" % (line_num, kind, text[:60]))
+
+if __name__ == '__main__':
+    main()